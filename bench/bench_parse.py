@@ -0,0 +1,120 @@
+"""
+Markdown解析のベンチマーク
+
+exported_notes のノートに対して parse_markdown と convert_markdown_to_notion_blocks を繰り返し実行し、
+1ノートあたりの処理時間を表示する。--baseline-ref を指定すると、そのGitリビジョンの
+notion_bulk_upload.py と比較し、解析結果が一致するかも確認する。
+
+$ python bench/bench_parse.py
+$ python bench/bench_parse.py --baseline-ref HEAD~1 --repeat 10
+"""
+import argparse
+import contextlib
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import notion_bulk_upload
+
+
+def load_module_from_git(ref):
+    """指定したGitリビジョンの notion_bulk_upload.py をモジュールとして読み込む"""
+    source = subprocess.run(
+        ["git", "show", f"{ref}:notion_bulk_upload.py"],
+        cwd=REPO_DIR, check=True, capture_output=True
+    ).stdout
+    module_dir = tempfile.mkdtemp(prefix="bench_parse_")
+    module_path = os.path.join(module_dir, "notion_bulk_upload_baseline.py")
+    with open(module_path, "wb") as f:
+        f.write(source)
+    spec = importlib.util.spec_from_file_location("notion_bulk_upload_baseline", module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def parse_all(module, file_paths):
+    """全ノートを解析・変換し、(解析時間, 変換時間, 結果) を返す"""
+    notes = []
+    parse_start = time.perf_counter()
+    for file_path in file_paths:
+        notes.append(module.parse_markdown(file_path))
+    parse_time = time.perf_counter() - parse_start
+
+    results = []
+    convert_start = time.perf_counter()
+    for note in notes:
+        # 旧実装は paragraphs、新実装は tokens を変換の入力にする
+        results.append(module.convert_markdown_to_notion_blocks(note.get("tokens", note.get("paragraphs"))))
+    convert_time = time.perf_counter() - convert_start
+
+    return parse_time, convert_time, list(zip(notes, results))
+
+
+def run(module, file_paths, repeat, use_icon=True):
+    """repeat 回実行し、最速の解析・変換時間を返す（ログ出力は捨てる）"""
+    module.NOTES_DIR = os.path.dirname(file_paths[0])
+    module.USE_ICON = use_icon
+    best_parse = best_convert = float("inf")
+    results = None
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(repeat):
+            parse_time, convert_time, results = parse_all(module, file_paths)
+            best_parse = min(best_parse, parse_time)
+            best_convert = min(best_convert, convert_time)
+    return best_parse, best_convert, results
+
+
+def comparable(results):
+    """作成日時が現在時刻になるノートや中間表現の違いを除いて比較できる形にする"""
+    comparable_results = []
+    for note, blocks in results:
+        note = {k: v for k, v in note.items() if k not in ("tokens", "paragraphs", "created", "updated")}
+        comparable_results.append((note, blocks))
+    return comparable_results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Markdown解析のベンチマーク")
+    parser.add_argument("--notes-dir", default=os.path.join(REPO_DIR, "exported_notes"),
+                        help="マークダウンファイルが格納されているディレクトリのパス")
+    parser.add_argument("--repeat", type=int, default=5, help="繰り返し回数（最速の結果を採用）")
+    parser.add_argument("--no-icon", action="store_true", help="アイコン推測を除いて計測する")
+    parser.add_argument("--baseline-ref", help="比較対象のGitリビジョン（例: HEAD~1）")
+    args = parser.parse_args()
+
+    file_paths = sorted(
+        os.path.join(args.notes_dir, f) for f in os.listdir(args.notes_dir) if f.endswith(".md")
+    )
+    if not file_paths:
+        print(f"❌ エラー: {args.notes_dir} にマークダウンファイルが見つかりません。")
+        sys.exit(1)
+
+    print(f"📊 {len(file_paths)} ノート × {args.repeat} 回")
+
+    parse_time, convert_time, results = run(notion_bulk_upload, file_paths, args.repeat, not args.no_icon)
+    per_note = (parse_time + convert_time) / len(file_paths) * 1e6
+    print(f"⏱ 現在の実装: 解析 {parse_time * 1000:.1f}ms, 変換 {convert_time * 1000:.1f}ms（1ノートあたり {per_note:.0f}µs）")
+
+    if args.baseline_ref:
+        baseline = load_module_from_git(args.baseline_ref)
+        base_parse, base_convert, base_results = run(baseline, file_paths, args.repeat, not args.no_icon)
+        base_per_note = (base_parse + base_convert) / len(file_paths) * 1e6
+        print(f"⏱ {args.baseline_ref}: 解析 {base_parse * 1000:.1f}ms, 変換 {base_convert * 1000:.1f}ms（1ノートあたり {base_per_note:.0f}µs）")
+        print(f"🚀 速度比: {base_per_note / per_note:.2f}倍")
+
+        if comparable(results) == comparable(base_results):
+            print("✅ 解析結果は一致しています")
+        else:
+            print("❌ 解析結果が一致しません")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+アップロード処理全体のベンチマーク
+
+合成UpNoteエクスポートを生成し、ローカルのNotion APIモックサーバーに向けて
+notion_bulk_upload.main() をそのまま実行する。レイテンシーや 429 / 5xx を注入した条件で、
+ノート数/秒、1ノートあたりのレイテンシー（p50/p99）、解析・変換・通信の時間を表示する。
+
+$ python bench/bench_upload.py --notes 500 --latency 150 --concurrency 5 --rate 50
+$ python bench/bench_upload.py --notes 200 --rate-limit-rate 0.02 --error-rate 0.01 --output bench_result.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import notion_bulk_upload
+from generate_notes import generate_export
+from mock_notion_server import MockNotionState, start_mock_server
+
+
+class StageTimer:
+    """関数を包んで、呼び出し回数と合計時間（スレッドをまたいで合算）を記録する"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.samples = {}
+
+    def wrap(self, name, func, keep_samples=False):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    count, total = self.totals.get(name, (0, 0.0))
+                    self.totals[name] = (count + 1, total + elapsed)
+                    if keep_samples:
+                        self.samples.setdefault(name, []).append(elapsed)
+        return timed
+
+
+def percentile(values, ratio):
+    """値のリストのパーセンタイルを返す（最近傍法）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(ratio * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args):
+    work_dir = tempfile.mkdtemp(prefix="bench_upload_")
+    try:
+        notes_dir = os.path.join(work_dir, "notes")
+        generate_export(notes_dir, args.notes, args.paragraphs, args.images, seed=args.seed)
+
+        state = MockNotionState(latency=args.latency / 1000, jitter=args.jitter / 1000,
+                                rate_limit_rate=args.rate_limit_rate, error_rate=args.error_rate, seed=args.seed)
+        server, base_url = start_mock_server(state)
+
+        # 1ノートあたりのレイテンシーと通信時間は関数を包んで計測する（モジュール内の呼び出しも置き換わる）
+        # 解析・変換の時間は notion_bulk_upload 自身の集計（METRICS）を使う
+        timer = StageTimer()
+        module = notion_bulk_upload
+        originals = {
+            "upload_or_sync_note": module.upload_or_sync_note,
+        }
+        original_request = module.NotionClient.request
+        module.upload_or_sync_note = timer.wrap("note", module.upload_or_sync_note, keep_samples=True)
+        module.NotionClient.request = timer.wrap("network", original_request)
+
+        argv = [
+            "notion_bulk_upload.py",
+            "--api-key", "bench", "--database-id", "bench-database",
+            "--no-interactive", "--force",
+            "--notes-dir", notes_dir,
+            "--ledger", os.path.join(work_dir, "ledger.jsonl"),
+            "--parse-cache", os.path.join(work_dir, "parse_cache.sqlite3"),
+            "--schema-cache", os.path.join(work_dir, "database_schema.json"),
+            "--dead-letter", os.path.join(work_dir, "dead_letter.jsonl"),
+            "--spool", os.path.join(work_dir, "dry_run_spool.jsonl"),
+            "--file-upload-cache", os.path.join(work_dir, "file_upload_cache.jsonl"),
+            "--image-cache-dir", os.path.join(work_dir, "image_cache"),
+            "--api-base-url", base_url,
+            "--concurrency", str(args.concurrency),
+            "--rate", str(args.rate),
+        ] + args.extra_args
+
+        saved_argv = sys.argv
+        sys.argv = argv
+        exit_code = 0
+        start = time.perf_counter()
+        try:
+            log = sys.stdout if args.verbose else open(os.devnull, "w")
+            with contextlib.redirect_stdout(log):
+                module.main()
+        except SystemExit as e:
+            exit_code = e.code or 0
+        finally:
+            elapsed = time.perf_counter() - start
+            sys.argv = saved_argv
+            for name, func in originals.items():
+                setattr(module, name, func)
+            module.NotionClient.request = original_request
+            server.shutdown()
+
+        note_latencies = timer.samples.get("note", [])
+        run_report = module.METRICS.to_dict()
+        stage_seconds = {name: total for name, (count, total) in timer.totals.items()}
+        stage_calls = {name: count for name, (count, total) in timer.totals.items()}
+        for name in ("parse", "convert"):
+            stage = run_report["stages"].get(name, {"count": 0, "seconds": 0.0})
+            stage_seconds[name] = stage["seconds"]
+            stage_calls[name] = stage["count"]
+        result = {
+            "revision": git_revision(),
+            "notes": args.notes,
+            "concurrency": args.concurrency,
+            "rate": args.rate,
+            "latency_ms": args.latency,
+            "rate_limit_rate": args.rate_limit_rate,
+            "error_rate": args.error_rate,
+            "exit_code": exit_code,
+            "elapsed_sec": elapsed,
+            "notes_per_sec": args.notes / elapsed if elapsed else 0.0,
+            "note_latency_p50_ms": percentile(note_latencies, 0.50) * 1000,
+            "note_latency_p99_ms": percentile(note_latencies, 0.99) * 1000,
+            "pages_created": len(state.pages),
+            "requests": len(state.requests),
+            "status_counts": {str(status): count for status, count in sorted(state.status_counts.items())},
+            "stage_seconds": stage_seconds,
+            "stage_calls": stage_calls,
+            # notion_bulk_upload 自身が集計した段ごとの処理時間とカウンター（--report と同じ内容）
+            "run_report": run_report,
+        }
+        return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_result(result):
+    stages = result["stage_seconds"]
+    print(f"📊 {result['notes']} ノート / 並列数 {result['concurrency']} / レート上限 {result['rate']}req/s / "
+          f"遅延 {result['latency_ms']}ms")
+    print(f"⏱ 経過時間: {result['elapsed_sec']:.2f}秒（{result['notes_per_sec']:.1f} ノート/秒）")
+    print(f"⏱ 1ノートあたり: p50 {result['note_latency_p50_ms']:.1f}ms, p99 {result['note_latency_p99_ms']:.1f}ms")
+    print(f"⏱ 解析 {stages.get('parse', 0):.2f}秒, 変換 {stages.get('convert', 0):.2f}秒, "
+          f"通信 {stages.get('network', 0):.2f}秒（全スレッドの合計）")
+    print(f"📨 リクエスト数: {result['requests']}, ステータス別: {result['status_counts']}")
+    print(f"📄 作成されたページ: {result['pages_created']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="アップロード処理全体のベンチマーク（モックサーバー使用）")
+    parser.add_argument("--notes", type=int, default=200, help="生成するノート数")
+    parser.add_argument("--paragraphs", type=int, default=20, help="1ノートあたりの本文の行数")
+    parser.add_argument("--images", type=int, default=1, help="1ノートあたりの画像数")
+    parser.add_argument("--latency", type=float, default=100.0, help="モックサーバーの応答遅延（ミリ秒）")
+    parser.add_argument("--jitter", type=float, default=20.0, help="応答遅延のゆらぎ（ミリ秒）")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="429 を返す確率（0〜1）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="500/503 を返す確率（0〜1）")
+    parser.add_argument("--concurrency", type=int, default=3, help="notion_bulk_upload の並列数")
+    parser.add_argument("--rate", type=float, default=3.0, help="notion_bulk_upload のレート上限（req/s）")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    parser.add_argument("--output", help="結果をJSONで書き出すファイル（コミット間の比較用）")
+    parser.add_argument("--verbose", action="store_true", help="notion_bulk_upload のログを表示する")
+    parser.add_argument("extra_args", nargs=argparse.REMAINDER,
+                        help="-- の後に notion_bulk_upload へ渡す追加の引数")
+    args = parser.parse_args()
+    if args.extra_args and args.extra_args[0] == "--":
+        args.extra_args = args.extra_args[1:]
+
+    result = run_benchmark(args)
+    print_result(result)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"✅ 結果を {args.output} に書き出しました")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+ベンチマーク用の合成UpNoteエクスポートを生成する
+
+UpNoteのマークダウンエクスポートと同じ形式（YAMLヘッダー、本文、ハッシュタグ、罫線、
+Files/ 以下の画像への参照）のノートを指定した数だけ作成する。
+
+$ python bench/generate_notes.py /tmp/synthetic_notes --notes 1000 --paragraphs 20 --images 2
+"""
+import argparse
+import os
+import random
+from datetime import datetime, timedelta
+
+SENTENCES = [
+    "今日も朝勉。コーヒーを淹れて静かに勉強開始。",
+    "昨晩は子供と一緒に早めに寝落ちして、3時半頃に起床した。",
+    "外気温12度で少し肌寒く、軽量ダウンを引っ張り出してきた。",
+    "財務会計の過去問を解いたが、キャッシュフロー計算書でつまずいた。",
+    "運営管理の暗記項目は、何かユニークな紐付けで覚えるのが大事っぽい。",
+    "散歩がてら近所の公園まで歩き、季節の花を写真に撮った。",
+    "仕事の資料づくりが山場なので、朝のうちに頭を整理しておく。",
+    "**今日の目標**は、企業経営理論の章末問題を最後まで解くこと。",
+]
+HASHTAGS = ["#資格勉強", "#中小企業診断士試験", "#朝勉", "#朝活", "#春秋要約", "#sjyouyaku"]
+CATEGORIES = ["朝勉春秋", "日記", "読書メモ"]
+
+# 最小のJPEG（1x1ピクセル）
+TINY_JPEG = bytes.fromhex(
+    "ffd8ffe000104a46494600010100000100010000ffdb004300080606070605080707070909080a0c140d0c0b0b0c1912130f141d1a1f1e1d1a1c1c"
+    "20242e2720222c231c1c2837292c30313434341f27393d38323c2e333432ffc0000b080001000101011100ffc4001f000001050101010101010000"
+    "0000000000000102030405060708090a0bffc400b5100002010303020403050504040000017d01020300041105122131410613516107227114328191"
+    "a1082342b1c11552d1f02433627282090a161718191a25262728292a3435363738393a434445464748494a535455565758595a636465666768696a"
+    "737475767778797a838485868788898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5c6c7c8c9cad2d3d4d5d6d7d8"
+    "d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8f9faffda0008010100003f00fbd3ffd9"
+)
+
+
+def generate_note(index, paragraphs, images, image_names, rng):
+    """1件分のノートのマークダウンを生成する"""
+    created = datetime(2024, 1, 1, 5, 0, 0) + timedelta(days=index, minutes=rng.randint(0, 59))
+    updated = created + timedelta(minutes=rng.randint(1, 30))
+    lines = [
+        "---",
+        f"date: {updated:%Y-%m-%d %H:%M:%S}",
+        f"created: {created:%Y-%m-%d %H:%M:%S}",
+        "categories:",
+        f"- {rng.choice(CATEGORIES)}",
+        "---",
+        "",
+        rng.choice(SENTENCES),
+        "",
+        "  ",
+        f"朝勉勤続{index + 1}日目：一次試験まであと{max(0, 337 - index)}日  ",
+        " ".join(rng.sample(HASHTAGS, 4)) + "  ",
+        "\\",
+        "\\-------------------------------------------------------------  ",
+        "\\",
+    ]
+    for _ in range(paragraphs):
+        kind = rng.random()
+        if kind < 0.1:
+            lines.append(f"## {rng.choice(SENTENCES)[:12]}")
+        elif kind < 0.2:
+            lines.append(f"- {rng.choice(SENTENCES)}")
+        elif kind < 0.25:
+            lines.append("<br>")
+        else:
+            lines.append(rng.choice(SENTENCES) + "  ")
+    for image_name in rng.sample(image_names, min(images, len(image_names))):
+        lines.append("")
+        lines.append(f"![](Files/{image_name})")
+    lines.append("")
+    lines.append(" ".join(rng.sample(HASHTAGS, 2)))
+    return "\n".join(lines) + "\n"
+
+
+def generate_export(output_dir, notes=100, paragraphs=20, images=1, image_pool=50, seed=0):
+    """合成エクスポートを output_dir に生成し、作成したノート数を返す"""
+    rng = random.Random(seed)
+    files_dir = os.path.join(output_dir, "Files")
+    os.makedirs(files_dir, exist_ok=True)
+
+    image_names = [f"IMG_{index:04d}.jpeg" for index in range(image_pool)] if images else []
+    for image_name in image_names:
+        with open(os.path.join(files_dir, image_name), "wb") as f:
+            f.write(TINY_JPEG)
+
+    for index in range(notes):
+        with open(os.path.join(output_dir, f"synthetic_{index:06d}.md"), "w", encoding="utf-8") as f:
+            f.write(generate_note(index, paragraphs, images, image_names, rng))
+    return notes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ベンチマーク用の合成UpNoteエクスポートを生成する")
+    parser.add_argument("output_dir", help="出力先ディレクトリ")
+    parser.add_argument("--notes", type=int, default=100, help="ノート数")
+    parser.add_argument("--paragraphs", type=int, default=20, help="1ノートあたりの本文の行数")
+    parser.add_argument("--images", type=int, default=1, help="1ノートあたりの画像数")
+    parser.add_argument("--image-pool", type=int, default=50, help="生成する画像ファイルの種類数（ノート間で共有される）")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    args = parser.parse_args()
+
+    count = generate_export(args.output_dir, args.notes, args.paragraphs, args.images, args.image_pool, args.seed)
+    print(f"✅ {args.output_dir} に {count} 件のノートを生成しました")
+
+
+if __name__ == "__main__":
+    main()
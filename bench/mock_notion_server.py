@@ -0,0 +1,319 @@
+"""
+ベンチマーク用のNotion APIモックサーバー
+
+/v1/pages・/v1/blocks・/v1/databases（スキーマの取得と問い合わせ）・/v1/file_uploads の主要なエンドポイントをメモリ上で再現する。
+レイテンシーや 429 / 5xx エラーを一定の確率で注入できるため、
+実際のNotion APIを使わずにアップロード処理のスループットを計測できる。
+
+単体でも起動できる:
+$ python bench/mock_notion_server.py --port 8765 --latency 150 --error-rate 0.01
+$ python notion_bulk_upload.py --api-base-url http://127.0.0.1:8765/v1 ...
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+# データベースのプロパティ（名前 → 型）。notion_bulk_upload.py の既定の設定に合わせる
+DEFAULT_DATABASE_PROPERTIES = {
+    "タイトル": "title",
+    "作成日": "date",
+    "更新日": "date",
+    "画像": "files",
+    "タグ": "multi_select",
+    "カテゴリー": "multi_select",
+}
+
+
+def parse_date(value):
+    """日付プロパティの値（日付のみ、または "Z" 付きの日時）を比較できる日時に変換する"""
+    value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+class MockNotionState:
+    """
+    モックサーバーの状態（作成されたページとブロック、リクエストの記録）
+    latency: 1リクエストあたりの応答遅延（秒）
+    jitter: 応答遅延のゆらぎ（秒、0〜jitter の一様乱数を加える）
+    rate_limit_rate: 429 を返す確率
+    error_rate: 500 / 503 を返す確率
+    retry_after: 429 の Retry-After ヘッダーの値（秒）
+    database_properties: GET /v1/databases/{id} で返すプロパティ（名前 → 型、全データベース共通）
+    """
+    def __init__(self, latency=0.0, jitter=0.0, rate_limit_rate=0.0, error_rate=0.0, retry_after="1", seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        # 応答の送信（件数の記録）はロックを持ったまま行うため再入可能にする
+        self.lock = threading.RLock()
+        self.pages = {}
+        self.file_uploads = {}
+        self.children = {}
+        self.parents = {}
+        self.requests = []
+        self.status_counts = {}
+        self.database_properties = dict(DEFAULT_DATABASE_PROPERTIES)
+
+    def database(self, database_id):
+        """データベースのオブジェクトを返す（プロパティIDは名前から決まる。タイトルは常に "title"）"""
+        properties = {}
+        for name, kind in self.database_properties.items():
+            property_id = "title" if kind == "title" else hashlib.md5(name.encode("utf-8")).hexdigest()[:4]
+            properties[name] = {"id": property_id, "name": name, "type": kind, kind: {}}
+        return {"object": "database", "id": database_id, "properties": properties}
+
+    def matches(self, page, query_filter):
+        """問い合わせのフィルター（and と日付の is_not_empty / on_or_after / before）にページが一致するか"""
+        if "and" in query_filter:
+            return all(self.matches(page, condition) for condition in query_filter["and"])
+        name = next((name for name, prop in self.database(None)["properties"].items()
+                     if query_filter["property"] in (name, prop["id"])), query_filter["property"])
+        start = ((page["properties"].get(name) or {}).get("date") or {}).get("start")
+        condition = query_filter["date"]
+        if condition.get("is_not_empty"):
+            return bool(start)
+        if not start:
+            return False
+        value = parse_date(start)
+        if "on_or_after" in condition and value < parse_date(condition["on_or_after"]):
+            return False
+        if "before" in condition and value >= parse_date(condition["before"]):
+            return False
+        return True
+
+    def page(self, page_id):
+        """作成されたページを、Notion と同じくプロパティ名をキーにしたページのオブジェクトで返す"""
+        body = self.pages[page_id]
+        names = {prop["id"]: name for name, prop in self.database(None)["properties"].items()}
+        properties = {}
+        for key, value in body.get("properties", {}).items():
+            kind = next(iter(value))
+            if kind in ("title", "rich_text"):
+                value = {kind: [dict(item, plain_text=item["text"]["content"]) for item in value[kind]]}
+            elif kind == "date" and value["date"] and value["date"]["start"].endswith("Z"):
+                # Notion は日時をミリ秒とタイムゾーンのオフセット付きで返す
+                value = {"date": dict(value["date"], start=value["date"]["start"][:-1] + ".000+00:00")}
+            properties[names.get(key, key)] = dict(value, id=key, type=kind)
+        return {"object": "page", "id": page_id, "parent": body.get("parent"),
+                "archived": bool(body.get("archived")), "properties": properties}
+
+    def new_block_ids(self, parent_id, blocks, after=None):
+        """子ブロックを登録し、作成したブロックIDのリストを返す"""
+        created = []
+        for block in blocks:
+            block_id = str(uuid.uuid4())
+            self.parents[block_id] = parent_id
+            created.append((block_id, block))
+        siblings = self.children.setdefault(parent_id, [])
+        if after:
+            index = [block_id for block_id, _ in siblings].index(after) + 1
+            siblings[index:index] = created
+        else:
+            siblings.extend(created)
+        return [block_id for block_id, _ in created]
+
+    def count(self, status):
+        with self.lock:
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+
+class MockNotionHandler(BaseHTTPRequestHandler):
+    """Notion APIのレスポンスを模倣するリクエストハンドラー"""
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        encoded = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(encoded)
+        self.state.count(status)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        # ファイルの送信（multipart/form-data）は内容を確認しない
+        if self.headers.get("Content-Type", "").startswith("multipart/form-data"):
+            return {"_multipart_bytes": len(raw)}
+        return json.loads(raw) if raw else {}
+
+    def handle_request(self, method):
+        state = self.state
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        try:
+            body = self.read_json()
+        except ValueError:
+            return self.send_json(400, {"object": "error", "status": 400, "code": "invalid_json", "message": "Invalid JSON"})
+
+        with state.lock:
+            state.requests.append((method, url.path, time.time()))
+            roll = state.random.random()
+            error_status = state.random.choice((500, 503))
+            delay = state.latency + state.random.random() * state.jitter
+
+        if delay:
+            time.sleep(delay)
+
+        # エラーの注入
+        if roll < state.rate_limit_rate:
+            return self.send_json(429, {"object": "error", "status": 429, "code": "rate_limited", "message": "Rate limited"},
+                                  {"Retry-After": state.retry_after})
+        if roll < state.rate_limit_rate + state.error_rate:
+            return self.send_json(error_status, {"object": "error", "status": error_status,
+                                                 "code": "internal_server_error", "message": "Injected error"})
+
+        path = url.path
+        with state.lock:
+            if method == "POST" and path == "/v1/pages":
+                if len(body.get("children", [])) > 100:
+                    return self.send_json(400, {"object": "error", "status": 400, "code": "validation_error",
+                                                "message": "body.children.length should be ≤ 100"})
+                page_id = str(uuid.uuid4())
+                state.pages[page_id] = body
+                state.new_block_ids(page_id, body.get("children", []))
+                return self.send_json(200, {"object": "page", "id": page_id})
+
+            if method == "POST" and path == "/v1/file_uploads":
+                upload_id = str(uuid.uuid4())
+                state.file_uploads[upload_id] = dict(body, status="pending")
+                return self.send_json(200, {"object": "file_upload", "id": upload_id, "status": "pending",
+                                            "upload_url": f"/v1/file_uploads/{upload_id}/send"})
+            match = re.fullmatch(r"/v1/file_uploads/([^/]+)/send", path)
+            if match and method == "POST":
+                upload = state.file_uploads.get(match.group(1))
+                if upload is None or "_multipart_bytes" not in body:
+                    return self.send_json(400, {"object": "error", "status": 400, "code": "validation_error",
+                                                "message": "Invalid file upload"})
+                upload.update(status="uploaded", size=body["_multipart_bytes"])
+                expiry = datetime.fromtimestamp(time.time() + 3600, timezone.utc).isoformat().replace("+00:00", "Z")
+                return self.send_json(200, {"object": "file_upload", "id": match.group(1), "status": "uploaded",
+                                            "expiry_time": expiry})
+
+            match = re.fullmatch(r"/v1/databases/([^/]+)", path)
+            if match and method == "GET":
+                return self.send_json(200, state.database(match.group(1)))
+
+            match = re.fullmatch(r"/v1/databases/([^/]+)/query", path)
+            if match and method == "POST":
+                # アーカイブされていないページを作成順に返す（フィルターは日付の条件と and のみ対応）
+                pages = [state.page(page_id) for page_id, page in state.pages.items()
+                         if (page.get("parent") or {}).get("database_id") == match.group(1) and not page.get("archived")]
+                query_filter = body.get("filter")
+                if query_filter:
+                    pages = [page for page in pages if state.matches(page, query_filter)]
+                page_size = min(int(body.get("page_size", 100)), 100)
+                start = int(body.get("start_cursor") or 0)
+                has_more = start + page_size < len(pages)
+                return self.send_json(200, {
+                    "object": "list",
+                    "results": pages[start:start + page_size],
+                    "has_more": has_more,
+                    "next_cursor": str(start + page_size) if has_more else None
+                })
+
+            match = re.fullmatch(r"/v1/pages/([^/]+)", path)
+            if match and method == "PATCH":
+                page_id = match.group(1)
+                if page_id not in state.pages:
+                    return self.send_json(404, {"object": "error", "status": 404, "code": "object_not_found", "message": "Not found"})
+                state.pages[page_id].update(body)
+                return self.send_json(200, {"object": "page", "id": page_id})
+
+            match = re.fullmatch(r"/v1/blocks/([^/]+)/children", path)
+            if match and method == "PATCH":
+                children = body.get("children", [])
+                if len(children) > 100:
+                    return self.send_json(400, {"object": "error", "status": 400, "code": "validation_error",
+                                                "message": "body.children.length should be ≤ 100"})
+                block_ids = state.new_block_ids(match.group(1), children, after=body.get("after"))
+                return self.send_json(200, {"object": "list", "results": [{"object": "block", "id": block_id} for block_id in block_ids]})
+            if match and method == "GET":
+                siblings = state.children.get(match.group(1), [])
+                page_size = int(query.get("page_size", ["100"])[0])
+                start = int(query.get("start_cursor", ["0"])[0])
+                results = siblings[start:start + page_size]
+                has_more = start + page_size < len(siblings)
+                return self.send_json(200, {
+                    "object": "list",
+                    "results": [dict(block, id=block_id) for block_id, block in results],
+                    "has_more": has_more,
+                    "next_cursor": str(start + page_size) if has_more else None
+                })
+
+            match = re.fullmatch(r"/v1/blocks/([^/]+)", path)
+            if match and method == "DELETE":
+                block_id = match.group(1)
+                siblings = state.children.get(state.parents.get(block_id), [])
+                for index, (sibling_id, _) in enumerate(siblings):
+                    if sibling_id == block_id:
+                        del siblings[index]
+                        return self.send_json(200, {"object": "block", "id": block_id, "archived": True})
+
+        return self.send_json(404, {"object": "error", "status": 404, "code": "object_not_found", "message": "Not found"})
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+
+def start_mock_server(state, host="127.0.0.1", port=0):
+    """モックサーバーを別スレッドで起動し、(サーバー, ベースURL) を返す"""
+    handler = type("BoundMockNotionHandler", (MockNotionHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Notion APIモックサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="応答遅延（ミリ秒）")
+    parser.add_argument("--jitter", type=float, default=0.0, help="応答遅延のゆらぎ（ミリ秒）")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="429 を返す確率（0〜1）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="500/503 を返す確率（0〜1）")
+    args = parser.parse_args()
+
+    state = MockNotionState(latency=args.latency / 1000, jitter=args.jitter / 1000,
+                            rate_limit_rate=args.rate_limit_rate, error_rate=args.error_rate)
+    server, base_url = start_mock_server(state, args.host, args.port)
+    print(f"✅ モックサーバーを起動しました: {base_url}（Ctrl-C で終了）")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(f"\n📊 リクエスト数: {len(state.requests)}, ステータス別: {state.status_counts}")
+
+
+if __name__ == "__main__":
+    main()
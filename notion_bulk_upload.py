@@ -1,4 +1,5 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import os
 import re
@@ -7,7 +8,36 @@ import time
 import getpass
 import configparser
 import argparse
-from datetime import datetime
+import asyncio
+import hashlib
+import threading
+import queue
+import random
+import collections
+import contextlib
+import mimetypes
+import shutil
+import sqlite3
+import tempfile
+from urllib.parse import quote, urlparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+
+# 高速なJSONエンコーダー（インストールされていれば使う）
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 非同期のHTTPクライアント（--engine async で使う。HTTP/2 には h2 も必要: pip install "httpx[http2]"）
+try:
+    import httpx
+except ImportError:
+    httpx = None
+try:
+    import h2
+except ImportError:
+    h2 = None
 
 # ------------- コマンドライン引数の解析 -------------
 def parse_args():
@@ -24,10 +54,103 @@ def parse_args():
     parser.add_argument('--no-cover-image', action='store_true', help='ページのカバー画像を設定しない')
     parser.add_argument('--no-image-property', action='store_true', help='画像プロパティを設定しない')
     parser.add_argument('--no-icon', action='store_true', help='ページのアイコンを設定しない')
+    parser.add_argument('--no-image-check', action='store_true', help='アップロード前に見つからない画像を確認しない')
+    parser.add_argument('--image-mode', choices=['url', 'upload', 'publish'], default='url',
+                        help='画像の参照方法（url: 公開済みの画像のURL、upload: Notionにアップロード、'
+                             'publish: --image-target に公開してからURLで参照、デフォルト: url）')
+    parser.add_argument('--image-base-url',
+                        help=f'画像を公開しているURL（デフォルト: {BASE_IMAGE_URL_DEFAULT}）')
+    parser.add_argument('--image-target',
+                        help='--image-mode publish の公開先（ローカルのディレクトリ、s3://バケット/プレフィックス、WebDAVのURL）')
+    parser.add_argument('--s3-endpoint-url', help='S3互換ストレージ（MinIOなど）のエンドポイントURL')
+    parser.add_argument('--image-max-width', type=int,
+                        help='画像を指定した幅（px）以下に縮小・再圧縮してから使う（upload / publish のみ、Pillow が必要）')
+    parser.add_argument('--cover-max-width', type=int, help='カバー画像の最大幅（px、デフォルト: --image-max-width と同じ）')
+    parser.add_argument('--image-format', choices=['jpeg', 'webp'], default='jpeg', help='縮小版の形式（デフォルト: jpeg）')
+    parser.add_argument('--image-quality', type=int, default=82, help='縮小版の画質（1〜100、デフォルト: 82）')
+    parser.add_argument('--image-cache-dir', default=IMAGE_CACHE_DIR, help='縮小版を保存するディレクトリ')
+    parser.add_argument('--file-upload-cache', default=FILE_UPLOAD_CACHE_FILE,
+                        help='Notionにアップロードした画像のキャッシュ（JSONL）のパス')
+    parser.add_argument('--image-workers', type=int, default=2, help='画像を同時にアップロードする数（デフォルト: 2）')
+    parser.add_argument('--schema-cache', default=SCHEMA_CACHE_FILE,
+                        help='データベースのスキーマ（プロパティ名・型・ID）のキャッシュ（JSON）のパス')
+    parser.add_argument('--routes', help='カテゴリー・ハッシュタグごとのアップロード先を書いた振り分けファイル（INI形式）')
+    parser.add_argument('--icon-keywords', help='アイコン推測に使うキーワードファイル（1行に「キーワード<タブ>絵文字」）')
+    parser.add_argument('--concurrency', type=int, default=3, help='同時にアップロードするノート数（デフォルト: 3）')
+    parser.add_argument('--rate', type=float, default=3.0, help='1秒あたりの最大APIリクエスト数（デフォルト: 3.0）')
+    parser.add_argument('--max-retries', type=int, default=3,
+                        help='409・429・5xx・通信エラーの最大リトライ回数（デフォルト: 3、400 などはリトライしない）')
+    parser.add_argument('--ledger', default=LEDGER_FILE, help='アップロード台帳（JSONL）のパス')
+    parser.add_argument('--spool', default=SPOOL_FILE,
+                        help='--dry-run で組み立てたリクエストを書き出すスプール（JSONL）のパス')
+    parser.add_argument('--replay', metavar='SPOOL',
+                        help='--dry-run で書き出したスプールのリクエストを送信する（ノートの読み込みと解析は行わない）')
+    parser.add_argument('--dead-letter', default=DEAD_LETTER_FILE,
+                        help='リトライしても送れなかったノートのリクエストと失敗の理由を書き出すファイル（JSONL）のパス')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='デッドレターに書き出された、送れなかったノートだけを再送する')
+    parser.add_argument('--skip-existing', action='store_true',
+                        help='ノートの作成日の月ごとにデータベースの既存ページを取得し、同じタイトル・作成日のノートはアップロードしない')
+    resume_group = parser.add_mutually_exclusive_group()
+    resume_group.add_argument('--resume', action='store_true', help='台帳を参照してアップロード済みのノートをスキップする（デフォルト）')
+    resume_group.add_argument('--force', action='store_true', help='台帳を無視してすべてのノートをアップロードする')
+    resume_group.add_argument('--sync', action='store_true', help='変更されたノートは既存のページを更新する（差分同期）')
+    parser.add_argument('--parse-workers', type=int, default=1,
+                        help='ノートの解析に使うプロセス数（デフォルト: 1、大量のノートではCPUのコア数程度を推奨）')
+    parser.add_argument('--parse-cache', default=PARSE_CACHE_FILE,
+                        help='解析結果のキャッシュ（SQLite）のパス（変わっていないノートは読み込みと解析を省く）')
+    parser.add_argument('--no-parse-cache', action='store_true', help='解析結果のキャッシュを使わない')
+    parser.add_argument('--queue-size', type=int, default=16, help='解析済みでアップロード待ちのノートを保持する上限数（デフォルト: 16）')
+    parser.add_argument('--api-base-url', default=NOTION_API_BASE_URL,
+                        help='Notion APIのベースURL（ベンチマーク用のモックサーバーなどに向ける場合に指定）')
+    parser.add_argument('--json-backend', choices=['auto', 'json', 'orjson'], default='auto',
+                        help='リクエストのJSONエンコーダー（auto: orjson があれば使う、デフォルト: auto）')
+    parser.add_argument('--pool-size', type=int, default=None, help='Notion APIへのHTTP接続プールのサイズ（デフォルト: 並列数と同じ）')
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads',
+                        help='Notion APIとの通信方式（threads: requests の接続プール、async: httpx の HTTP/2 で1本の接続に多重化、デフォルト: threads）')
+    parser.add_argument('--report', help='実行結果（段ごとの処理時間とカウンター）を書き出すファイルのパス')
+    parser.add_argument('--report-format', choices=['json', 'prometheus'], default='json',
+                        help='--report の形式（json または prometheus のテキスト形式、デフォルト: json）')
     parser.add_argument('--readme', action='store_true', help='使用方法の詳細を表示して終了')
 
     args = parser.parse_args()
 
+    if args.concurrency < 1:
+        parser.error('--concurrency には1以上を指定してください')
+    if args.rate <= 0:
+        parser.error('--rate には0より大きい値を指定してください')
+    if args.max_retries < 0:
+        parser.error('--max-retries には0以上を指定してください')
+    if args.queue_size < 1:
+        parser.error('--queue-size には1以上を指定してください')
+    if args.replay and args.dry_run:
+        parser.error('--replay と --dry-run は同時に指定できません')
+    if args.retry_failed and (args.replay or args.dry_run):
+        parser.error('--retry-failed は --replay・--dry-run と同時に指定できません')
+    # --retry-failed はデッドレターをスプールとして再送する（記録の形式は同じ）
+    if args.retry_failed:
+        args.replay = args.dead_letter
+    if args.replay and args.skip_existing:
+        parser.error('--skip-existing は --replay と同時に指定できません（スプールの照合は台帳で行います）')
+    if args.parse_workers < 1:
+        parser.error('--parse-workers には1以上を指定してください')
+    if args.pool_size is not None and args.pool_size < 1:
+        parser.error('--pool-size には1以上を指定してください')
+    if args.image_workers < 1:
+        parser.error('--image-workers には1以上を指定してください')
+    if args.json_backend == 'orjson' and orjson is None:
+        parser.error('--json-backend orjson を使うには orjson をインストールしてください（pip install orjson）')
+    if args.engine == 'async' and httpx is None:
+        parser.error('--engine async を使うには httpx をインストールしてください（pip install "httpx[http2]"）')
+    if args.image_mode == 'publish' and not args.image_target:
+        parser.error('--image-mode publish には --image-target を指定してください')
+    if args.image_max_width is not None and args.image_max_width < 1:
+        parser.error('--image-max-width には1以上を指定してください')
+    if args.cover_max_width is not None and args.cover_max_width < 1:
+        parser.error('--cover-max-width には1以上を指定してください')
+    if not 1 <= args.image_quality <= 100:
+        parser.error('--image-quality には1〜100を指定してください')
+
     # READMEの表示
     if args.readme:
         show_readme()
@@ -52,6 +175,7 @@ Notion APIを使用してNotionデータベースにインポートするツー
 3. Notion APIキーを取得（https://www.notion.so/my-integrations）
 4. NotionデータベースIDを取得
 5. Notionデータベースと統合を接続
+6. データベースにプロパティ「タイトル」（タイトル）・「作成日」「更新日」（日付）・「画像」（ファイル&メディア）を用意
 
 【基本的な使用方法】
 $ python notion_bulk_upload.py
@@ -63,11 +187,48 @@ $ python notion_bulk_upload.py
 --use-config           : 保存された設定を使用
 --save-config          : 設定を保存
 --no-interactive       : 対話モードを無効化
---dry-run              : 実際にアップロードせずに処理内容を確認
+--dry-run              : 実際にアップロードせず、送るリクエストを組み立てて検証し、スプールに書き出す
+--spool PATH           : --dry-run のスプール（JSONL）のパスを指定
+--replay SPOOL         : スプールのリクエストを送信（ノートの読み込みと解析は行わない）
 --image-property NAME  : 画像プロパティ名を指定（デフォルト: 画像）
 --no-cover-image       : ページのカバー画像を設定しない
 --no-image-property    : 画像プロパティを設定しない
 --no-icon              : ページのアイコンを設定しない
+--no-image-check       : アップロード前に見つからない画像を確認しない
+--image-mode MODE      : 画像の参照方法（url: 公開済みの画像のURL、upload: Notionにアップロード、publish: 公開先にアップロード）
+--image-base-url URL   : 画像を公開しているURL（デフォルト: https://www.soratomo.com/img_UpNote_diary/）
+--image-target TARGET  : publish の公開先（ローカルのディレクトリ、s3://バケット/プレフィックス、WebDAVのURL）
+--s3-endpoint-url URL  : S3互換ストレージ（MinIOなど）のエンドポイントURL
+--image-max-width N    : 画像を指定した幅以下に縮小・再圧縮してから使う（upload / publish のみ）
+--cover-max-width N    : カバー画像の最大幅（デフォルト: --image-max-width と同じ）
+--image-format FORMAT  : 縮小版の形式（jpeg または webp、デフォルト: jpeg）
+--image-quality N      : 縮小版の画質（デフォルト: 82）
+--image-cache-dir DIR  : 縮小版を保存するディレクトリを指定
+--file-upload-cache PATH : Notionにアップロードした画像のキャッシュ（JSONL）のパスを指定
+--image-workers N      : 画像を同時にアップロードする数（デフォルト: 2）
+--icon-keywords PATH   : アイコン推測のキーワードファイルを指定（組み込みの表に追加・上書き）
+--routes PATH          : カテゴリー・ハッシュタグごとのアップロード先（データベース）の振り分けファイルを指定
+--schema-cache PATH    : データベースのスキーマ（プロパティID）のキャッシュのパスを指定
+--concurrency N        : 同時にアップロードするノート数（デフォルト: 3）
+--rate N               : 1秒あたりの最大APIリクエスト数（デフォルト: 3.0）
+--max-retries N        : 409・429・5xx・通信エラーの最大リトライ回数（デフォルト: 3）
+--pool-size N          : HTTP接続プールのサイズ（デフォルト: 並列数と同じ）
+--engine NAME          : 通信方式（threads / async、デフォルト: threads。async は httpx が必要）
+--json-backend NAME    : リクエストのJSONエンコーダー（auto / json / orjson、デフォルト: auto）
+--queue-size N         : アップロード待ちの解析済みノートの上限数（デフォルト: 16）
+--parse-workers N      : ノートの解析に使うプロセス数（デフォルト: 1）
+--parse-cache PATH      : 解析結果のキャッシュ（SQLite）のパスを指定
+--no-parse-cache       : 解析結果のキャッシュを使わない
+--api-base-url URL     : Notion APIのベースURL（モックサーバーでの計測用）
+--ledger PATH          : アップロード台帳（JSONL）のパスを指定
+--report PATH          : 段ごとの処理時間・リトライ数・送信バイト数などを記録したレポートを書き出す
+--report-format FORMAT : レポートの形式（json または prometheus、デフォルト: json）
+--resume               : アップロード済みのノートをスキップ（デフォルト）
+--force                : 台帳を無視してすべてのノートをアップロード
+--skip-existing        : データベースの既存ページと同じタイトル・作成日のノートをアップロードしない
+--dead-letter PATH     : 送れなかったノートのリクエストと失敗の理由を書き出すファイルのパスを指定
+--retry-failed         : デッドレターに書き出された、送れなかったノートだけを再送
+--sync                 : 変更されたノートは既存ページを差分更新（新しいページを作らない）
 --readme               : この使用方法を表示
 
 【使用例】
@@ -83,6 +244,9 @@ $ python notion_bulk_upload.py --use-config
 # ドライラン（実際にアップロードせず確認のみ）
 $ python notion_bulk_upload.py --use-config --dry-run
 
+# ドライランで検証・書き出したリクエストを後から送信する
+$ python notion_bulk_upload.py --use-config --replay ~/src/up_note_to_notion/dry_run_spool.jsonl
+
 # カスタムディレクトリを指定
 $ python notion_bulk_upload.py --notes-dir "/path/to/notes"
 
@@ -95,6 +259,39 @@ $ python notion_bulk_upload.py --no-cover-image
 # アイコンを設定しない
 $ python notion_bulk_upload.py --no-icon
 
+# 5並列・毎秒2リクエストでアップロード
+$ python notion_bulk_upload.py --use-config --concurrency 5 --rate 2
+
+# 中断したインポートを再開（アップロード済みのノートはスキップされる）
+$ python notion_bulk_upload.py --use-config --resume
+
+# 台帳を無視して最初からアップロードし直す
+$ python notion_bulk_upload.py --use-config --force
+
+# 再エクスポートしたノートを既存ページに差分同期
+$ python notion_bulk_upload.py --use-config --sync
+
+# 台帳がない環境で、データベースにすでにあるノート（同じタイトル・作成日）を除いてアップロード
+$ python notion_bulk_upload.py --use-config --skip-existing
+
+# 前回の実行で送れなかったノートだけを再送（デッドレターから）
+$ python notion_bulk_upload.py --use-config --retry-failed
+
+# 画像をレンタルサーバーに置かず、Notionに直接アップロードする
+$ python notion_bulk_upload.py --use-config --image-mode upload
+
+# 画像をS3に公開してからURLで参照する（未公開の画像だけを並列でアップロード）
+$ python notion_bulk_upload.py --use-config --image-mode publish --image-target s3://my-bucket/upnote/
+
+# 画像を幅1600px（カバーは2000px）以下のWebPに縮小してからNotionにアップロード
+$ python notion_bulk_upload.py --use-config --image-mode upload --image-max-width 1600 --cover-max-width 2000 --image-format webp
+
+# 処理時間の内訳をJSONで書き出す
+$ python notion_bulk_upload.py --use-config --report run.json
+
+# カテゴリー・ハッシュタグごとに別のデータベースへアップロードする
+$ python notion_bulk_upload.py --use-config --routes routes.ini
+
 【サポートされるマークダウン形式】
 - 見出し（# ## ###）
 - リスト（- * 1.）
@@ -103,17 +300,46 @@ $ python notion_bulk_upload.py --no-icon
 - 太字（**text**）
 - 罫線（---）
 - <br>タグ（空のブロックに変換）
+- 連続する通常の行（間の空行1つを含む）は、改行を含む1つの段落にまとめる（2000文字まで）
 
 【注意事項】
 - 画像ファイルはレンタルサーバーにアップロードされている必要があります
+  （--image-mode upload を指定するとNotionに直接、--image-mode publish を指定すると --image-target の
+    公開先に Files フォルダの画像をアップロードしてから参照します）
 - 画像URLは設定されたベースURLに画像ファイル名を結合して生成されます
+- アップロード前に Files フォルダを1回だけ走査し、ローカルに見つからない画像を一覧表示します
+- アップロード前にデータベースのスキーマを取得し、プロパティ（タイトル・作成日・更新日・画像）の名前と型を
+  確認します。合わない場合はアップロードを始めずに終了します
 - 最初の画像がカバー画像およびプロパティの画像として使用されます
 - 本文の内容から自動的にページアイコン（絵文字）が設定されます
+- アップロードは複数ワーカーで並列に行われ、全ワーカーで1つのレート制限を共有します
+- 429（レート制限）を受けると送信速度を自動的に落とし、成功が続くと徐々に戻します
+- 409・429・5xx・通信エラーはジッター付きの指数バックオフでリトライし、400 などの内容の誤りはリトライしません。
+  5xx や通信エラーが続くと、しばらく全ワーカーの送信を止めます（サーキットブレーカー）
+- Notion API への接続はキープアライブで再利用されます（接続プールのサイズは --pool-size で指定）
+- --engine async を指定すると、httpx の HTTP/2 で全ワーカーのリクエストを1本の接続に多重化して送ります
+- 100ブロックを超えるノートは作成後に追記し、2000文字を超えるテキストは自動的に分割します
+- ノートは1件ずつ読み込み・解析され、アップロードと並行して処理されます（メモリ使用量はノート数によらず一定）
+- --parse-workers を指定すると、解析と本文の変換を複数のプロセスで並列に行います（アップロードの順番は変わりません）
+- 解析結果はキャッシュ（parse_cache.sqlite3）に保存され、前回から変わっていないノートは
+  読み込みと解析を省きます（ドライランや --sync の再実行が速くなります）
+- 解析やアップロードに失敗したノートは報告してスキップし、残りのノートの処理を続けます
+- --routes を指定すると、YAMLヘッダーの categories と本文のハッシュタグに応じてノートを別々の
+  データベースにアップロードし、ハッシュタグ・カテゴリーをマルチセレクトのプロパティに設定します
+- --dry-run ではリクエストを組み立てて Notion API の制限（ブロック数・文字数・プロパティの型・サイズ）を
+  確認し、送るはずのリクエストをスプール（dry_run_spool.jsonl）に書き出します
+- アップロード結果は台帳（upload_ledger.jsonl）に記録され、再実行時は内容が変わっていない
+  アップロード済みのノートをスキップします（失敗したノートと内容が変わったノートのみ再送）
+- --sync を指定すると、内容が変わったノートは新しいページを作らず、既存ページのプロパティと
+  変更されたブロックの範囲だけを更新します
+- 終了時に処理時間の内訳（読み込み・解析・変換・通信・待機）を表示します。--report を指定すると
+  リトライ数や429の回数、送信バイト数を含むレポートをファイルに書き出します
 """
     print(readme)
 
 # ------------- 設定ファイルの読み込み -------------
 CONFIG_FILE = os.path.expanduser("~/src/up_note_to_notion/notion_config.ini")
+LEDGER_FILE = os.path.expanduser("~/src/up_note_to_notion/upload_ledger.jsonl")
 
 def load_config():
     """設定ファイルから設定を読み込む"""
@@ -138,6 +364,8 @@ def load_config():
                         result['use_image_property'] = config['Options'].getboolean('use_image_property')
                     if 'use_icon' in config['Options']:
                         result['use_icon'] = config['Options'].getboolean('use_icon')
+                    if 'icon_keywords' in config['Options']:
+                        result['icon_keywords'] = config['Options']['icon_keywords']
 
                 return result
         except Exception as e:
@@ -145,7 +373,8 @@ def load_config():
 
     return None
 
-def save_config(api_key, database_id, image_property=None, use_cover_image=None, use_image_property=None, use_icon=None):
+def save_config(api_key, database_id, image_property=None, use_cover_image=None, use_image_property=None, use_icon=None,
+                icon_keywords=None):
     """設定をファイルに保存する"""
     try:
         config = configparser.ConfigParser()
@@ -164,6 +393,8 @@ def save_config(api_key, database_id, image_property=None, use_cover_image=None,
             config['Options']['use_image_property'] = str(use_image_property)
         if use_icon is not None:
             config['Options']['use_icon'] = str(use_icon)
+        if icon_keywords is not None:
+            config['Options']['icon_keywords'] = icon_keywords
 
         os.makedirs(os.path.dirname(CONFIG_FILE), exist_ok=True)
         with open(CONFIG_FILE, 'w') as f:
@@ -180,19 +411,29 @@ def main():
     # コマンドライン引数の解析
     args = parse_args()
 
+    # 計測を開始（段ごとの処理時間とカウンター）
+    global METRICS
+    METRICS = RunMetrics()
+
     # ディレクトリの設定
-    global NOTES_DIR, IMAGE_PROPERTY_NAME, USE_COVER_IMAGE, USE_IMAGE_PROPERTY, USE_ICON
+    global NOTES_DIR, IMAGE_PROPERTY_NAME, USE_COVER_IMAGE, USE_IMAGE_PROPERTY, USE_ICON, ICON_KEYWORDS_FILE
     NOTES_DIR = args.notes_dir
     IMAGE_PROPERTY_NAME = args.image_property
     USE_COVER_IMAGE = not args.no_cover_image
     USE_IMAGE_PROPERTY = not args.no_image_property
     USE_ICON = not args.no_icon
+    ICON_KEYWORDS_FILE = args.icon_keywords
 
-    if not os.path.exists(NOTES_DIR):
+    if args.replay:
+        # 再送ではノートを読まず、スプールに記録されたリクエストだけを送る
+        if not os.path.exists(args.replay):
+            print(f"❌ エラー: {'デッドレター' if args.retry_failed else 'スプール'} {args.replay} が存在しません。")
+            sys.exit(1)
+    elif not os.path.exists(NOTES_DIR):
         print(f"❌ エラー: {NOTES_DIR} が存在しません。フォルダを確認してください。")
         sys.exit(1)
-
-    print("✅ ノートフォルダのチェック完了")
+    else:
+        print("✅ ノートフォルダのチェック完了")
     print(f"✅ 画像プロパティ名: {IMAGE_PROPERTY_NAME if USE_IMAGE_PROPERTY else '使用しない'}")
     print(f"✅ カバー画像: {'使用する' if USE_COVER_IMAGE else '使用しない'}")
     print(f"✅ ページアイコン: {'使用する' if USE_ICON else '使用しない'}")
@@ -221,6 +462,8 @@ def main():
                         USE_IMAGE_PROPERTY = config['use_image_property']
                     if 'use_icon' in config and not args.no_icon:
                         USE_ICON = config['use_icon']
+                    if 'icon_keywords' in config and not args.icon_keywords:
+                        ICON_KEYWORDS_FILE = config['icon_keywords']
 
                     print("✅ 保存された設定を読み込みました")
                 else:
@@ -251,6 +494,8 @@ def main():
                         USE_IMAGE_PROPERTY = config['use_image_property']
                     if 'use_icon' in config and not args.no_icon:
                         USE_ICON = config['use_icon']
+                    if 'icon_keywords' in config and not args.icon_keywords:
+                        ICON_KEYWORDS_FILE = config['icon_keywords']
 
                     print("✅ 保存された設定を読み込みました")
                 else:
@@ -266,7 +511,8 @@ def main():
                     image_property=IMAGE_PROPERTY_NAME,
                     use_cover_image=USE_COVER_IMAGE,
                     use_image_property=USE_IMAGE_PROPERTY,
-                    use_icon=USE_ICON
+                    use_icon=USE_ICON,
+                    icon_keywords=ICON_KEYWORDS_FILE
                 )
 
         if not NOTION_API_KEY or not DATABASE_ID:
@@ -280,85 +526,1921 @@ def main():
         print(f"❌ 入力処理中にエラーが発生しました: {e}")
         sys.exit(1)
 
-    # Notion API の設定
-    global url, headers
-    url = "https://api.notion.com/v1/pages"
-    headers = {
-        "Authorization": f"Bearer {NOTION_API_KEY}",
-        "Content-Type": "application/json",
-        "Notion-Version": "2022-06-28"
-    }
-
-    print("✅ Notion API の設定完了")
+    # カテゴリー・ハッシュタグによるアップロード先の振り分け
+    router = None
+    target_database_ids = [DATABASE_ID]
+    if args.routes:
+        try:
+            router = load_note_router(args.routes, DATABASE_ID)
+        except (OSError, ValueError, configparser.Error) as e:
+            print(f"❌ 振り分けファイルを読み込めません: {e}")
+            sys.exit(1)
+        target_database_ids = router.database_ids()
+        print(f"✅ 振り分けのルール: {len(router.routes)}件（アップロード先のデータベース: {len(target_database_ids)}個）")
 
-    # マークダウンファイルの処理
+    # Notion API の設定
+    global NOTION_CLIENT, RATE_LIMITER, JSON_BACKEND, RETRY_POLICY, CIRCUIT_BREAKER
+    JSON_BACKEND = "json" if args.json_backend == "json" or orjson is None else "orjson"
+    # 接続プールは、ページを作るワーカー（アップロード先ごと）と画像を送るスレッドが待たされない大きさにする
+    default_pool_size = (args.concurrency * len(target_database_ids) +
+                         (args.image_workers if args.image_mode == "upload" else 0))
+    if args.engine == "async":
+        NOTION_CLIENT = AsyncNotionClient(NOTION_API_KEY, base_url=args.api_base_url,
+                                          max_connections=args.pool_size or default_pool_size)
+        engine = f"async（httpx、{'HTTP/2' if NOTION_CLIENT.http2 else 'HTTP/1.1'}）"
+    else:
+        NOTION_CLIENT = NotionClient(NOTION_API_KEY, base_url=args.api_base_url, pool_size=args.pool_size or default_pool_size)
+        engine = "threads（requests）"
+
+    # リトライの方針と、API が不調なときに全ワーカーの送信を止めるサーキットブレーカー
+    RETRY_POLICY = RetryPolicy(max_retries=args.max_retries)
+    CIRCUIT_BREAKER = CircuitBreaker()
+
+    print(f"✅ Notion API の設定完了（JSONエンコーダー: {JSON_BACKEND}、通信方式: {engine}）")
+
+    # データベースのスキーマを1回だけ取得し、使うプロパティの名前と型をアップロード前に確認する
+    # （設定の誤りで全ノートの作成が 400 で失敗し、リクエストを無駄にしないようにする）
     try:
-        md_files = [f for f in os.listdir(NOTES_DIR) if f.endswith(".md")]
-        total_files = len(md_files)
+        schemas_ok = preflight_database_schemas(target_database_ids, router, args.schema_cache,
+                                                use_cache_on_error=args.dry_run)
+    except NotionAuthError as e:
+        print(f"❌ {e}")
+        schemas_ok = False
+    if not schemas_ok:
+        NOTION_CLIENT.close()
+        sys.exit(1)
 
-        if total_files == 0:
-            print(f"❌ エラー: {NOTES_DIR} にマークダウンファイルが見つかりません。")
+    # アイコン推測用のキーワード照合器を構築（キーワードファイルの誤りはここで検出する）
+    if USE_ICON:
+        try:
+            matcher = get_icon_matcher()
+        except OSError as e:
+            print(f"❌ キーワードファイルを読み込めません: {e}")
             sys.exit(1)
+        print(f"✅ アイコン用キーワード: {len(matcher.keywords)}件")
 
-        print(f"📊 合計 {total_files} 個のマークダウンファイルを処理します...")
-
-        success_count = 0
-        failed_files = []
+    # マークダウンファイルの処理
+    global IMAGE_UPLOADER
+    file_upload_cache = None
+    parse_cache = None
+    spool_file = None
+    dead_letter = None
+    parse_executor = None
+    total_files = 0
+    success_count = 0
+    skipped_count = 0
+    failed_files = []
+    completed = 0
+    try:
+        # 件数だけを先に数え、ファイル名の一覧はメモリに持たない
+        if args.replay:
+            total_files = count_spool_records(args.replay)
+            if total_files == 0:
+                if args.retry_failed:
+                    print(f"✅ デッドレター {args.replay} に送れなかったノートはありません。")
+                    sys.exit(0)
+                print(f"❌ エラー: スプール {args.replay} に記録がありません。")
+                sys.exit(1)
+            if args.retry_failed:
+                print(f"📊 デッドレターの {total_files} 件のノートを再送します...")
+            else:
+                print(f"📊 スプールの {total_files} 件のノートを送信します...")
+        else:
+            total_files = count_markdown_files(NOTES_DIR)
+            if total_files == 0:
+                print(f"❌ エラー: {NOTES_DIR} にマークダウンファイルが見つかりません。")
+                sys.exit(1)
+            print(f"📊 合計 {total_files} 個のマークダウンファイルを処理します...")
 
-        for index, filename in enumerate(md_files, 1):
-            file_path = os.path.join(NOTES_DIR, filename)
-            print(f"\n📝 処理中 ({index}/{total_files}): {filename}")
-            note_data = parse_markdown(file_path)
+        if not args.replay:
+            prepare_images(args)
 
+        # アップロード台帳の読み込み（--force の場合は参照しないが記録は行う）
+        # 台帳はデータベースごとに記録を分けるため、アップロード先ごとに読み込む
+        ledgers = {database_id: UploadLedger(args.ledger, database_id) for database_id in target_database_ids}
+        if args.force:
+            print("⚠️ --force が指定されたため、台帳を無視してすべてのノートをアップロードします")
+        else:
+            print(f"✅ アップロード台帳: {args.ledger}（記録済み {sum(len(ledger) for ledger in ledgers.values())} 件）")
+
+        def check_ledger(filename, content_hash, database_id=None):
+            """台帳と照合し、(処理内容, 同期対象の記録) を返す（処理内容は skip / create / sync）"""
+            if args.force:
+                return "create", None
+            ledger = ledgers[database_id or DATABASE_ID]
+            entry = ledger.get(filename)
+            if entry and entry.get("page_id"):
+                if entry.get("status") == "success" and entry.get("hash") == content_hash:
+                    print(f"⏭️ アップロード済みのためスキップ: {filename}")
+                    return "skip", None
+                if args.sync:
+                    print(f"🔄 {filename} は前回のアップロード後に変更されています。既存のページを更新します")
+                    return "sync", entry
+                print(f"⚠️ {filename} は前回のアップロード後に変更されています。新しいページとして再アップロードします（--sync で既存ページを更新できます）")
+                return "create", None
+            # ファイル名が変わっただけで同じ内容のノートはアップロード済みとみなす
+            renamed = ledger.find_by_hash(content_hash)
+            if renamed:
+                print(f"⏭️ {renamed['file']} と同じ内容のためスキップ: {filename}")
+                if not args.dry_run:
+                    ledger.record(filename, content_hash, "success", page_id=renamed.get("page_id"),
+                                  blocks=renamed.get("blocks"))
+                return "skip", None
+            return "create", None
+
+        def upload_job(job):
+            """アップロード段：ノートを送り、送れなかった場合は最後に失敗したリクエストの内容をジョブに残す"""
+            REQUEST_FAILURE.last = None
+            try:
+                return send_job(job)
+            finally:
+                job["failure"] = REQUEST_FAILURE.last
+
+        def send_job(job):
+            """ノートを新規作成または同期し、(ページID, 本文ブロックの指紋) を返す"""
+            if "record" in job:
+                return send_spooled_note(job["record"], job["entry"])
             if args.dry_run:
-                print(f"🔍 ドライラン: {note_data['title']} をアップロードします（実際には実行されません）")
+                # 送るはずのリクエストを組み立てて検証し、スプールに書き出す（APIは呼ばない）
+                with METRICS.timer("validate"):
+                    record = build_spool_record(job["filename"], job["hash"], job["note"], job["children"], job["entry"])
+                    problems = validate_spool_record(record)
+                if problems:
+                    for problem in problems:
+                        print(f"❌ {job['note']['title']}: {problem}")
+                    raise ValueError(f"リクエストの検証で {len(problems)} 件の問題が見つかりました")
+                job["spool_record"] = record
+                action = "既存ページを更新" if job["entry"] else "アップロード"
+                print(f"🔍 ドライラン: {job['note']['title']} を{action}するリクエスト {len(record['requests'])} 件を確認しました（実際には送信されません）")
+                return "dry-run", record["blocks"]
+            if "image_futures" in job:
+                # 画像の送信が終わってから、ファイルアップロードIDを使ってブロックを組み立てる
+                with METRICS.timer("image_wait"):
+                    job["note"]["image_uploads"], job["image_hashes"] = IMAGE_UPLOADER.resolve(job.pop("image_futures"))
+                with METRICS.timer("convert"):
+                    job["children"] = job.pop("blocks") + build_image_blocks(job["note"])
+            return upload_or_sync_note(job["note"], job["entry"], job.get("children"))
+
+        def handle_result(job, result, error):
+            """各ノートの結果を集計して台帳に記録する（メインスレッドで呼ばれる）"""
+            nonlocal completed, success_count, skipped_count
+            if isinstance(error, NotionAuthError):
+                # 認証エラーでは残りのノートも成功しないため、パイプライン全体を止める
+                raise error
+            filename = job["filename"]
+            entry = job.get("entry")
+            ledger = ledgers[job.get("target") or DATABASE_ID]
+            if job.get("skip"):
+                skipped_count += 1
+                # データベースにあったページは台帳に記録し、次回からは照合なしでスキップ（--sync では更新）する
+                if job.get("existing_page_id") and not args.dry_run:
+                    ledger.record(filename, job["hash"], "success", page_id=job["existing_page_id"])
+            elif error is None and result and result[0]:
                 success_count += 1
+                if not args.dry_run:
+                    ledger.record(filename, job["hash"], "success", page_id=result[0], blocks=result[1])
+                elif spool_file:
+                    spool_file.write(json.dumps(job["spool_record"], ensure_ascii=False) + "\n")
+                # ページに添付したファイルアップロードは有効期限がなくなり、以後も再利用できる
+                for sha256 in job.get("image_hashes", []):
+                    file_upload_cache.mark_attached(sha256)
             else:
-                if upload_to_notion(note_data):
-                    success_count += 1
-                else:
-                    failed_files.append(filename)
-
-            show_progress(index, total_files)
-            time.sleep(1)  # APIレート制限を考慮した待機時間
+                if error is not None:
+                    print(f"❌ エラー: {filename} の処理中に例外が発生しました。 {error}")
+                failed_files.append(filename)
+                if not args.dry_run and job.get("hash"):
+                    if entry and job.get("stage") == "upload":
+                        # 同期に失敗しても既存ページの対応は残し、次回の同期で再試行する
+                        # （本文が途中まで書き換わっている可能性があるため、次回は本文をすべて置き換える）
+                        ledger.record(filename, job["hash"], "failed", page_id=entry["page_id"])
+                    elif entry:
+                        # アップロード前に失敗した場合はNotion側は変わっていない
+                        ledger.record(filename, job["hash"], "failed", page_id=entry["page_id"],
+                                      blocks=entry.get("blocks"))
+                    else:
+                        ledger.record(filename, job["hash"], "failed")
+                # 送信まで進んで失敗したノートは、リクエストと失敗の理由をデッドレターに書き出す
+                if dead_letter and job.get("stage") == "upload":
+                    write_dead_letter(job, error)
+                elif dead_letter and args.retry_failed and "line" in job:
+                    # 再送しなかった記録（別のデータベース用・読めない行）は、次の再送のためにそのまま残す
+                    dead_letter.keep(job["line"])
+            completed += 1
+            show_progress(completed, total_files)
+
+        def write_dead_letter(job, error):
+            """送れなかったノートのリクエストを組み立て直し、失敗の理由とともにデッドレターに書き出す"""
+            failure = job.get("failure") or {"request": None, "status": None, "error": str(error or "")}
+            try:
+                record = job.get("record")
+                if record is None:
+                    # 変換段で組み立てた子ブロックをそのまま使う（解析結果のキャッシュや解析用プロセスのノートには
+                    # マークダウンのトークンがなく、ここで組み立て直すことはできない）
+                    if job.get("children") is None:
+                        raise ValueError("ページの子ブロックが組み立てられていません")
+                    record = build_spool_record(job["filename"], job["hash"], job["note"], job["children"], job.get("entry"))
+                dead_letter.add(record, failure)
+            except Exception as e:
+                print(f"⚠️ {job['filename']} をデッドレターに書き出せませんでした: {e}")
+
+        if args.dry_run:
+            # ドライランではAPIを呼ばないため、待機やレート制限は不要
+            workers = 1
+        else:
+            # 全ワーカーで1つのレートリミッターを共有する
+            RATE_LIMITER = RateLimiter(rate=args.rate)
+            NOTION_CLIENT.rate_limiter = RATE_LIMITER
+            workers = args.concurrency
+            print(f"✅ 並列数: {args.concurrency}, レート上限: 毎秒{args.rate}リクエスト")
+
+        # ドライランで組み立てたリクエストをスプールに書き出す（画像を送る方式では送信前のURLしか分からないため書き出さない）
+        if args.dry_run:
+            if args.image_mode == "url":
+                spool_file = open_spool(args.spool)
+                print(f"✅ スプール: {args.spool}（--replay で送信できます）")
+            else:
+                print(f"⚠️ --image-mode {args.image_mode} のドライランではリクエストの検証のみ行い、スプールは書き出しません")
+
+        # 送れなかったノートのリクエストを書き出すデッドレター（--retry-failed で再送する）
+        # Notionにアップロードした画像は、ページに添付しないまま時間が経つと期限切れになり再送できないため、
+        # --image-mode upload ではデッドレターを書き出さない（前回のデッドレターはそのまま残す）
+        if not args.dry_run and (args.replay or args.image_mode != "upload"):
+            dead_letter = DeadLetterQueue(args.dead_letter)
+        elif not args.dry_run:
+            print("⚠️ --image-mode upload では送れなかったノートをデッドレターに書き出しません（失敗したノートは台帳に記録され、次回の実行で再送されます）")
+
+        # 画像をNotionにアップロードする場合は、ページ作成と並行して送るスレッドを用意する
+        if args.image_mode == "upload" and not args.dry_run and not args.replay:
+            scope = hashlib.sha256(NOTION_API_KEY.encode("utf-8")).hexdigest()[:16]
+            file_upload_cache = FileUploadCache(args.file_upload_cache, scope)
+            IMAGE_UPLOADER = ImageUploader(file_upload_cache, IMAGE_MANIFEST, workers=args.image_workers)
+            print(f"✅ 画像: Notionにアップロード（キャッシュ済み {len(file_upload_cache)} 件: {args.file_upload_cache}）")
+        elif args.image_mode == "upload":
+            print("🔍 ドライラン: 画像はアップロードせず、外部URLで確認します")
+
+        # 前回から変わっていないノートは、保存済みの解析結果を使って読み込みと解析を省く
+        if not args.no_parse_cache and not args.replay:
+            try:
+                parse_cache = ParseCache(args.parse_cache, parse_cache_settings())
+            except (OSError, sqlite3.Error) as e:
+                print(f"⚠️ 解析結果のキャッシュを開けないため、キャッシュなしで続行します: {e}")
+            else:
+                print(f"✅ 解析結果のキャッシュ: {args.parse_cache}（保存済み {len(parse_cache)} 件）")
+
+        # 同じタイトル・作成日のページがアップロード先のデータベースにあるノートはアップロードしない
+        # （台帳がなくても、重なりのあるエクスポートを取り込み直したときに重複したページを作らない）
+        # 既存ページはノートの作成日の月ごとに、その月のページだけを1回ずつ取得する
+        existing_pages = None
+        if args.skip_existing:
+            existing_pages = {database_id: ExistingPageIndex(database_id) for database_id in target_database_ids}
+            print("✅ 既存ページ: ノートの作成日の月ごとにデータベースのページを取得して照合します")
+
+        if args.replay:
+            # スプールの記録をそのままアップロード段に渡す（ノートの読み込みと解析は行わない）
+            jobs = replay_ledger_stage(spool_stage(args.replay, target_database_ids), ledgers, force=args.force)
+        else:
+            # 走査 → 読み込み → 台帳照合 → キャッシュ照合 → 解析 → 変換 をジェネレーターでつなぎ、1件ずつ流す
+            jobs = scan_markdown_files(NOTES_DIR)
+            jobs = read_stage(jobs, NOTES_DIR, parse_cache)
+            if not router:
+                jobs = ledger_stage(jobs, check_ledger)
+            if parse_cache is not None:
+                jobs = parse_cache_stage(jobs, parse_cache)
+            if args.parse_workers > 1:
+                # 解析と本文の変換を複数のプロセスで行う（設定は各プロセスに引き継ぐ）
+                parse_executor = ProcessPoolExecutor(
+                    max_workers=args.parse_workers, initializer=init_parse_worker,
+                    initargs=({"use_icon": USE_ICON, "icon_keywords_file": ICON_KEYWORDS_FILE},))
+                print(f"✅ 解析プロセス数: {args.parse_workers}")
+                # 各プロセスが1バッチを解析している間に次のバッチを待たせておき、全プロセスを使い続ける
+                jobs = parallel_parse_stage(jobs, parse_executor, window=args.parse_workers * 2)
+            else:
+                jobs = parse_stage(jobs)
+            if router:
+                # アップロード先は解析しないと決まらないため、振り分けてからその台帳と照合する
+                jobs = route_stage(jobs, router)
+                jobs = ledger_stage(jobs, check_ledger)
+            if existing_pages is not None:
+                jobs = existing_page_stage(jobs, existing_pages)
+            if IMAGE_UPLOADER:
+                jobs = image_upload_stage(jobs, IMAGE_UPLOADER)
+            jobs = convert_stage(jobs, parse_cache)
+        run_upload_pipeline(jobs, upload_job, handle_result, workers=workers, queue_size=args.queue_size,
+                            targets=target_database_ids)
+
+        for ledger in ledgers.values():
+            ledger.close()
+        if dead_letter:
+            dead_letter.commit()
 
         # 結果サマリーを表示
         print(f"\n✅ 処理完了！")
         print(f"📊 結果サマリー:")
         print(f"  - 合計ファイル数: {total_files}")
         print(f"  - 成功: {success_count}")
+        print(f"  - スキップ（アップロード済み）: {skipped_count}")
         print(f"  - 失敗: {len(failed_files)}")
 
         if failed_files:
             print("\n❌ 失敗したファイル:")
             for failed_file in failed_files:
                 print(f"  - {failed_file}")
+
+        if dead_letter and dead_letter.count:
+            print(f"\n📮 {dead_letter.count}件のノートのリクエストと失敗の理由をデッドレターに書き出しました: {args.dead_letter}")
+            if dead_letter.kept:
+                print(f"   （うち {dead_letter.kept}件は今回再送しなかった記録をそのまま残しています）")
+            retry_options = "--use-config --retry-failed"
+            if args.routes:
+                # 振り分け先のデータベース用の記録も再送できるように、同じ振り分けファイルを指定する
+                retry_options += f" --routes {args.routes}"
+            if args.dead_letter != DEAD_LETTER_FILE:
+                retry_options += f" --dead-letter {args.dead_letter}"
+            print(f"   失敗したノートだけを再送するには: python {os.path.basename(sys.argv[0])} {retry_options}")
+
+        if router and router.counts:
+            print("\n📂 振り分け:")
+            for route in [router.default] + router.routes:
+                if router.counts[route["name"]]:
+                    print(f"  - {route['name']}: {router.counts[route['name']]}件")
+
+        if spool_file:
+            print(f"\n📝 {success_count}件のノートのリクエストをスプールに書き出しました: {args.spool}")
+            print(f"   送信するには: python {os.path.basename(sys.argv[0])} --use-config --replay {args.spool}")
+
+        show_metrics_summary(METRICS)
     except KeyboardInterrupt:
         print("\n❌ 処理が中断されました。")
         sys.exit(1)
+    except NotionAuthError as e:
+        print(f"\n❌ {e}")
+        sys.exit(1)
     except Exception as e:
         print(f"❌ 処理中に予期せぬエラーが発生しました: {e}")
         sys.exit(1)
+    finally:
+        # 中断された場合に送信中のリクエストを待たないよう、先に Notion API のクライアントを閉じる
+        # （--engine async では送信中のリクエストがキャンセルされ、画像の送信スレッドもすぐに終わる）
+        NOTION_CLIENT.close()
+        if parse_executor:
+            parse_executor.shutdown(wait=True, cancel_futures=True)
+        if IMAGE_UPLOADER:
+            IMAGE_UPLOADER.close()
+            file_upload_cache.close()
+        if parse_cache is not None:
+            parse_cache.close()
+        if spool_file:
+            spool_file.close()
+        if dead_letter:
+            dead_letter.close()
+        # 中断された場合も、そこまでの計測結果を書き出す
+        if args.report:
+            summary = {
+                "total": total_files,
+                "completed": completed,
+                "success": success_count,
+                "skipped": skipped_count,
+                "failed": len(failed_files)
+            }
+            options = {
+                "dry_run": args.dry_run,
+                "replay": bool(args.replay),
+                "retry_failed": args.retry_failed,
+                "concurrency": args.concurrency,
+                "rate": args.rate,
+                "queue_size": args.queue_size,
+                "parse_cache": parse_cache is not None
+            }
+            try:
+                METRICS.write_report(args.report, args.report_format, summary, options)
+                print(f"📝 実行レポートを書き出しました: {args.report}")
+            except OSError as e:
+                print(f"⚠️ 実行レポートを書き出せませんでした: {e}")
+
+def prepare_images(args):
+    """画像の一覧を作り、必要に応じて縮小版の作成と公開先へのアップロードを行う"""
+    # 画像の一覧を1回だけ作り、見つからない画像をアップロード前にまとめて報告する
+    global IMAGE_MANIFEST, BASE_IMAGE_URL
+    BASE_IMAGE_URL = args.image_base_url or BASE_IMAGE_URL_DEFAULT
+    with METRICS.timer("image_manifest"):
+        IMAGE_MANIFEST = ImageManifest(os.path.join(NOTES_DIR, "Files"))
+    print(f"✅ 画像ファイル: {len(IMAGE_MANIFEST)}件")
+    if not args.no_image_check:
+        with METRICS.timer("image_check"):
+            missing_images = find_missing_images(NOTES_DIR, IMAGE_MANIFEST)
+        METRICS.increment("images_missing", len(missing_images))
+        if missing_images:
+            print(f"⚠️ ローカルに見つからない画像が {len(missing_images)} 件あります（サーバー上に存在するか確認してください）:")
+            for image, notes in sorted(missing_images.items()):
+                print(f"  - {image}（{notes[0]}" + (f" ほか{len(notes) - 1}件" if len(notes) > 1 else "") + "）")
+        else:
+            print("✅ ノートが参照している画像はすべてローカルに存在します")
+
+    # 画像の縮小版を作る（公開先やNotionには縮小版を送る）
+    if args.image_max_width or args.cover_max_width:
+        if args.image_mode == "url":
+            print("⚠️ --image-mode url では画像を送らないため、縮小の指定は無視されます")
+        else:
+            try:
+                import PIL
+            except ImportError:
+                print("❌ 画像を縮小するには Pillow が必要です（pip install Pillow）")
+                sys.exit(1)
+            # カバーの最大幅が本文用と同じなら、カバーにも本文用の縮小版を使う
+            widths = {"inline": args.image_max_width or args.cover_max_width}
+            if (args.cover_max_width or widths["inline"]) != widths["inline"]:
+                widths["cover"] = args.cover_max_width
+            with METRICS.timer("image_process"):
+                process_images(IMAGE_MANIFEST, widths, cache_dir=args.image_cache_dir,
+                               image_format=args.image_format, quality=args.image_quality)
+
+    # 画像を公開先にアップロードし、画像URLを公開先のURLに差し替える
+    if args.image_mode == "publish":
+        try:
+            publisher = create_image_publisher(args.image_target, args.image_base_url,
+                                               s3_endpoint_url=args.s3_endpoint_url)
+        except (ValueError, ImportError) as e:
+            print(f"❌ 画像の公開先を設定できません: {e}")
+            sys.exit(1)
+        print(f"✅ 画像の公開先: {publisher.describe()}")
+        if args.dry_run:
+            print("🔍 ドライラン: 画像は公開せず、従来のURLで確認します")
+        else:
+            with METRICS.timer("image_publish"):
+                publish_images(IMAGE_MANIFEST, publisher, workers=args.image_workers)
+
+# ------------- Notion APIクライアント -------------
+NOTION_API_BASE_URL = "https://api.notion.com/v1"
+NOTION_VERSION = "2022-06-28"
+NOTION_CLIENT = None
+JSON_BACKEND = "orjson" if orjson else "json"
+
+def encode_payload(payload):
+    """
+    リクエストボディをJSONのバイト列にする（ノートごと・リクエストごとに1回だけ呼び、リトライでは同じバイト列を送る）
+    日本語はエスケープせずUTF-8のまま、区切りの空白も省いて送るため、本文のサイズは約半分になる
+    """
+    with METRICS.timer("json_encode"):
+        if JSON_BACKEND == "orjson":
+            return orjson.dumps(payload)
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class NotionClient:
+    """
+    Notion API を呼び出すクライアント
+    キープアライブ付きの requests.Session を保持し、全ワーカーで接続プールを共有する
+    pool_size: ホストごとに保持する接続数（並列数以上にしておくと接続待ちが発生しない）
+    rate_limiter: 指定した場合、リクエスト送信前にトークンを取得する
+    """
+    def __init__(self, api_key, base_url=NOTION_API_BASE_URL, pool_size=10, timeout=30, rate_limiter=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "Notion-Version": NOTION_VERSION
+        })
+
+    def request(self, method, path, payload=None, files=None):
+        """
+        Notion API にリクエストを送信し、レスポンスを返す
+        payload: リクエストボディ（辞書、または encode_payload でエンコード済みのバイト列）
+        files: multipart/form-data で送るファイル（{"file": (ファイル名, バイト列, Content-Type)}）
+        """
+        if self.rate_limiter:
+            with METRICS.timer("rate_limit_wait"):
+                self.rate_limiter.acquire()
+        data = None
+        headers = None
+        if payload is not None:
+            data = payload if isinstance(payload, bytes) else encode_payload(payload)
+            METRICS.increment("bytes_sent", len(data))
+        if files:
+            # multipart の境界つき Content-Type は requests に付けさせる
+            headers = {"Content-Type": None}
+            METRICS.increment("bytes_sent", sum(len(content) for _, content, _ in files.values()))
+        METRICS.increment("requests")
+        with METRICS.timer("http"):
+            response = self.session.request(method, f"{self.base_url}{path}", data=data, files=files,
+                                            headers=headers, timeout=self.timeout)
+        METRICS.increment(f"http_{response.status_code}")
+        METRICS.increment("bytes_received", len(response.content))
+        return response
+
+    def close(self):
+        self.session.close()
+
+class AsyncNotionClient:
+    """
+    asyncio と httpx で Notion API を呼び出すクライアント（--engine async）
+    専用スレッドのイベントループで接続を保持し、全ワーカーのページ作成やブロックの追記を1本の HTTP/2 接続に
+    多重化して送る（h2 がなく HTTP/2 を使えない場合は、HTTP/1.1 の接続を max_connections 本まで使う）
+    request() は NotionClient と同じ呼び出し方で、ワーカーはイベントループに渡したリクエストの完了を待つだけになる
+    max_connections: 同時に開く接続数の上限（HTTP/2 では1本の接続に全リクエストが多重化される）
+    rate_limiter: 指定した場合、リクエスト送信前にトークンを取得する
+    """
+    def __init__(self, api_key, base_url=NOTION_API_BASE_URL, max_connections=10, timeout=30, rate_limiter=None):
+        self.base_url = base_url.rstrip("/")
+        self.rate_limiter = rate_limiter
+        self.http2 = h2 is not None
+        self.lock = threading.Lock()
+        self.pending = set()  # 送信中のリクエスト（close() でキャンセルする）
+        self.closed = False
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.client = self.run(self.create_client(api_key, max_connections, timeout))
+
+    async def create_client(self, api_key, max_connections, timeout):
+        # クライアントはイベントループの中で作る
+        return httpx.AsyncClient(
+            http2=self.http2,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            headers={
+                "Authorization": f"Bearer {api_key}",
+                "Notion-Version": NOTION_VERSION
+            }
+        )
+
+    def run(self, coroutine):
+        """コルーチンをイベントループで実行し、完了を待って結果を返す"""
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        with self.lock:
+            self.pending.add(future)
+        try:
+            return future.result()
+        finally:
+            with self.lock:
+                self.pending.discard(future)
+
+    def request(self, method, path, payload=None, files=None):
+        """
+        Notion API にリクエストを送信し、レスポンス（httpx.Response）を返す
+        payload・files は NotionClient.request と同じ。通信エラーは requests の例外にして送出する（リトライの判定を共通にする）
+        """
+        if self.closed:
+            raise requests.exceptions.ConnectionError("Notion API クライアントは閉じられています")
+        if self.rate_limiter:
+            with METRICS.timer("rate_limit_wait"):
+                self.rate_limiter.acquire()
+        data = None
+        headers = None
+        if payload is not None:
+            data = payload if isinstance(payload, bytes) else encode_payload(payload)
+            headers = {"Content-Type": "application/json"}
+            METRICS.increment("bytes_sent", len(data))
+        if files:
+            # multipart の境界つき Content-Type は httpx に付けさせる
+            METRICS.increment("bytes_sent", sum(len(content) for _, content, _ in files.values()))
+        METRICS.increment("requests")
+        try:
+            with METRICS.timer("http"):
+                response = self.run(self.client.request(method, f"{self.base_url}{path}", content=data,
+                                                        files=files, headers=headers))
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+        METRICS.increment(f"http_{response.status_code}")
+        METRICS.increment("bytes_received", len(response.content))
+        return response
+
+    def close(self):
+        """送信中のリクエストをキャンセルしてから、接続とイベントループを閉じる（Ctrl-C での中断時も待たずに終わる）"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending = list(self.pending)
+        for future in pending:
+            future.cancel()
+        try:
+            asyncio.run_coroutine_threadsafe(self.client.aclose(), self.loop).result(timeout=5)
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+# ------------- アップロード台帳 -------------
+class UploadLedger:
+    """
+    アップロード結果を記録する追記型（JSONL）の台帳
+    1行に1件、ファイル名・コンテンツハッシュ・作成されたページID・ステータスを記録する
+    同じファイルの記録が複数ある場合は最後の行が有効（途中で壊れた行は無視する）
+    database_id ごとに記録を分けるため、別のデータベースへのアップロードには影響しない
+    """
+    def __init__(self, path, database_id):
+        self.path = path
+        self.database_id = database_id
+        self.entries = {}
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get("database_id") == database_id and "file" in entry:
+                        self._index(entry)
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _index(self, entry):
+        self.entries[entry["file"]] = entry
+        if entry.get("status") == "success":
+            self.hashes[entry.get("hash")] = entry
+
+    def get(self, filename):
+        """ファイルの最新の記録を返す（記録がなければ None）"""
+        return self.entries.get(filename)
+
+    def find_by_hash(self, content_hash):
+        """同じ内容でアップロードに成功した記録を返す（ファイル名が変わったノートの照合用）"""
+        return self.hashes.get(content_hash)
+
+    def record(self, filename, content_hash, status, page_id=None, blocks=None):
+        """
+        アップロード結果を1行追記する（プロセスが落ちても記録済みの行は残る）
+        blocks: 本文ブロックの指紋リスト（--sync で変更されたブロックの範囲を求めるために使う）
+        """
+        entry = {
+            "file": filename,
+            "database_id": self.database_id,
+            "hash": content_hash,
+            "page_id": page_id,
+            "status": status,
+            "blocks": blocks,
+            "recorded_at": datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        }
+        with self.lock:
+            self._index(entry)
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+# ------------- 解析結果のキャッシュ -------------
+PARSE_CACHE_FILE = os.path.expanduser("~/src/up_note_to_notion/parse_cache.sqlite3")
+PARSER_VERSION = 3  # 解析・変換の結果が変わる修正をしたら上げる（古い解析結果は使われなくなる）
+PARSE_CACHE_COMMIT_INTERVAL = 100  # この件数を書き込むごとに確定する
+
+class ParseCache:
+    """
+    ノートの解析結果（ノートの情報と本文のブロック）を保存する SQLite のキャッシュ
+    パス・サイズ・更新日時が前回と同じノートは、読み込みも解析もせずに前回の結果を使う
+    更新日時だけが変わったノート（コピーや touch など）も、内容のハッシュが同じなら解析を省く
+    settings（解析器のバージョンとアイコンの設定）が異なる記録は使わない
+    ノートが多くても全件をメモリに読み込まないよう、台帳と違って SQLite に保存する
+    """
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self.pending = 0
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 読み書きは走査〜変換段のスレッドで行うため、作成したスレッド以外からの利用を許可する
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS parsed_notes ("
+                        "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT, "
+                        "settings TEXT, note TEXT, blocks TEXT)")
+        self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM parsed_notes WHERE settings = ?",
+                                   (self.settings,)).fetchone()[0]
+
+    def lookup_stat(self, path, size, mtime_ns):
+        """サイズと更新日時が前回と同じノートの内容のハッシュを返す（同じ設定で解析済みでなければ None）"""
+        with self.lock:
+            if self.db is None:
+                return None
+            row = self.db.execute("SELECT hash FROM parsed_notes WHERE path = ? AND size = ? AND mtime_ns = ? AND settings = ?",
+                                  (path, size, mtime_ns, self.settings)).fetchone()
+        return row[0] if row else None
+
+    def get(self, path, content_hash):
+        """内容のハッシュが同じノートの解析結果を (ノート, ブロック) で返す（なければ None）"""
+        with self.lock:
+            if self.db is None:
+                return None
+            row = self.db.execute("SELECT note, blocks FROM parsed_notes WHERE path = ? AND hash = ? AND settings = ?",
+                                  (path, content_hash, self.settings)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1])
+
+    def put(self, path, size, mtime_ns, content_hash, note, blocks):
+        """解析結果を保存する（トークンはブロックに変換済み、振り分けは毎回決めるため保存しない）"""
+        note = {key: value for key, value in note.items() if key not in ("tokens", "route")}
+        row = (path, size, mtime_ns, content_hash, self.settings,
+               json.dumps(note, ensure_ascii=False), json.dumps(blocks, ensure_ascii=False))
+        with self.lock:
+            if self.db is None:
+                return
+            self.db.execute("INSERT OR REPLACE INTO parsed_notes VALUES (?, ?, ?, ?, ?, ?, ?)", row)
+            self._commit_later()
+
+    def touch(self, path, size, mtime_ns):
+        """内容が変わっていないノートのサイズと更新日時を更新する（次回は読み込みを省ける）"""
+        with self.lock:
+            if self.db is None:
+                return
+            self.db.execute("UPDATE parsed_notes SET size = ?, mtime_ns = ? WHERE path = ?", (size, mtime_ns, path))
+            self._commit_later()
+
+    def _commit_later(self):
+        self.pending += 1
+        if self.pending >= PARSE_CACHE_COMMIT_INTERVAL:
+            self.db.commit()
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
+
+def parse_cache_settings():
+    """解析結果に影響する設定を表す文字列を返す（設定が変わったら前回の解析結果は使わない）"""
+    if not USE_ICON:
+        return f"v{PARSER_VERSION}:no-icon"
+    keywords = json.dumps(get_icon_matcher().keywords, ensure_ascii=False)
+    return f"v{PARSER_VERSION}:icon:{hashlib.sha256(keywords.encode('utf-8')).hexdigest()[:16]}"
+
+# ------------- アップロード先の振り分け（カテゴリー・ハッシュタグ → データベース） -------------
+NOTION_MAX_SELECT_NAME_LENGTH = 100  # マルチセレクトの選択肢名の文字数の上限
+
+class NoteRouter:
+    """
+    ノートのカテゴリー（YAMLヘッダーの categories）とハッシュタグから、アップロード先のデータベースと
+    マルチセレクトのプロパティに入れる値を決める
+    ルールは振り分けファイルに書いた順に照合し、最初に一致したルールを使う
+    どのルールにも一致しないノートは既定のルール（[default] セクション、データベースは --database-id）で送る
+    """
+    def __init__(self, routes, default):
+        self.routes = routes
+        self.default = default
+        self.counts = collections.Counter()
+
+    def database_ids(self):
+        """アップロード先のデータベースIDを重複なく返す（既定のデータベースが先頭）"""
+        database_ids = []
+        for route in [self.default] + self.routes:
+            if route["database_id"] not in database_ids:
+                database_ids.append(route["database_id"])
+        return database_ids
+
+    def route(self, note):
+        """ノートに一致したルールを返す"""
+        categories = set(note["categories"])
+        tags = set(note["tags"])
+        for route in self.routes:
+            if route["categories"] & categories or route["tags"] & tags:
+                return route
+        return self.default
+
+    def properties(self, route, note):
+        """ルールで指定されたマルチセレクトのプロパティに、ノートのハッシュタグ・カテゴリーを入れる"""
+        properties = {}
+        for key, values in (("tags_property", note["tags"]), ("categories_property", note["categories"])):
+            name = route[key]
+            if not name:
+                continue
+            options = properties.setdefault(name, {"multi_select": []})["multi_select"]
+            for value in values:
+                # 選択肢名にカンマは使えないため置き換える
+                option = {"name": value.replace(",", " ")[:NOTION_MAX_SELECT_NAME_LENGTH]}
+                if option not in options:
+                    options.append(option)
+        return properties
+
+def split_route_values(text):
+    """振り分けファイルの値（カンマ区切り）をリストにする"""
+    return [value.strip() for value in re.split(r"[,、]", text) if value.strip()]
+
+def load_note_router(path, default_database_id):
+    """
+    振り分けファイル（INI形式）を読み込んで NoteRouter を返す（誤りがある場合は ValueError を送出する）
+    セクション名がルール名で、database_id・categories・tags・tags_property・categories_property を書く
+    """
+    config = configparser.ConfigParser()
+    with open(path, "r", encoding="utf-8") as f:
+        config.read_file(f)
+
+    def make_route(name, section, database_id=None):
+        return {
+            "name": name,
+            "database_id": section.get("database_id") or database_id,
+            "categories": set(split_route_values(section.get("categories", ""))),
+            "tags": {tag.lstrip("#") for tag in split_route_values(section.get("tags", ""))},
+            "tags_property": section.get("tags_property") or None,
+            "categories_property": section.get("categories_property") or None
+        }
+
+    default_section = config["default"] if config.has_section("default") else config.defaults()
+    default = make_route("default", default_section, default_database_id)
+    routes = []
+    for name in config.sections():
+        if name == "default":
+            continue
+        route = make_route(name, config[name])
+        if not route["database_id"]:
+            raise ValueError(f"[{name}] に database_id がありません")
+        if not route["categories"] and not route["tags"]:
+            raise ValueError(f"[{name}] に categories か tags を指定してください")
+        routes.append(route)
+    return NoteRouter(routes, default)
+
+def note_database_id(note):
+    """ノートのアップロード先のデータベースIDを返す（振り分けていない場合は --database-id）"""
+    route = note.get("route")
+    return route["database_id"] if route else DATABASE_ID
+
+# ------------- データベースのスキーマ確認（プロパティ名・型・ID） -------------
+SCHEMA_CACHE_FILE = os.path.expanduser("~/src/up_note_to_notion/database_schema.json")
+DATABASE_SCHEMAS = {}  # 確認済みのスキーマ（データベースID → {プロパティ名: {"id": プロパティID, "type": 型}}）
+
+def fetch_database_schema(database_id):
+    """データベースのプロパティ（名前 → ID・型）を取得する（失敗時は None）"""
+    response = send_notion_request("GET", f"/databases/{database_id}",
+                                   description=f"データベース {database_id} のスキーマの取得")
+    if response is None:
+        return None
+    return {name: {"id": prop["id"], "type": prop["type"]} for name, prop in response.json()["properties"].items()}
+
+def load_schema_cache(path):
+    """スキーマのキャッシュ（データベースID → スキーマ）を読み込む（壊れている場合は空とみなす）"""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {database_id: entry["properties"] for database_id, entry in data.items() if "properties" in entry}
+
+def save_schema_cache(path, schemas):
+    """取得したスキーマをキャッシュに書き出す（他のデータベースの記録は残す）"""
+    data = {database_id: {"properties": properties} for database_id, properties in load_schema_cache(path).items()}
+    fetched_at = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    for database_id, properties in schemas.items():
+        data[database_id] = {"properties": properties, "fetched_at": fetched_at}
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, path)
+
+def expected_properties(database_id, router=None):
+    """ページの作成に使うプロパティ（名前 → 型）を返す"""
+    expected = {TITLE_PROPERTY_NAME: "title", CREATED_PROPERTY_NAME: "date", UPDATED_PROPERTY_NAME: "date"}
+    if USE_IMAGE_PROPERTY:
+        expected[IMAGE_PROPERTY_NAME] = "files"
+    if router:
+        for route in [router.default] + router.routes:
+            if route["database_id"] == database_id:
+                for key in ("tags_property", "categories_property"):
+                    if route[key]:
+                        expected[route[key]] = "multi_select"
+    return expected
+
+def check_database_schema(schema, expected):
+    """使うプロパティがスキーマにあり、型が一致するかを確認し、問題点のリストを返す"""
+    problems = []
+    for name, kind in expected.items():
+        prop = schema.get(name)
+        if prop is None:
+            message = f"プロパティ「{name}」（{kind}）がありません"
+            if kind == "title":
+                titles = [title for title, candidate in schema.items() if candidate["type"] == "title"]
+                if titles:
+                    message += f"（タイトルのプロパティ名は「{titles[0]}」です）"
+            problems.append(message)
+        elif prop["type"] != kind:
+            problems.append(f"プロパティ「{name}」の型が {prop['type']} です（{kind} が必要です）")
+    return problems
+
+def preflight_database_schemas(database_ids, router, cache_path, use_cache_on_error=False):
+    """
+    アップロード前に各データベースのスキーマを1回だけ取得し、使うプロパティの名前と型を確認する（問題があれば False）
+    確認したスキーマはキャッシュに保存し、ページのプロパティはプロパティIDで指定する
+    use_cache_on_error: 取得できなかった場合に前回のキャッシュで確認する（ドライラン用）
+    """
+    cached = load_schema_cache(cache_path)
+    fetched = {}
+    ok = True
+    for database_id in database_ids:
+        with METRICS.timer("schema"):
+            schema = fetch_database_schema(database_id)
+        if schema is not None:
+            fetched[database_id] = schema
+        elif use_cache_on_error and database_id in cached:
+            print(f"⚠️ データベース {database_id} のスキーマを取得できないため、前回のキャッシュで確認します")
+            schema = cached[database_id]
+        else:
+            print(f"❌ データベース {database_id} のスキーマを取得できません（データベースIDと、データベースにインテグレーションを接続しているか確認してください）")
+            ok = False
+            continue
+        problems = check_database_schema(schema, expected_properties(database_id, router))
+        for problem in problems:
+            print(f"❌ データベース {database_id}: {problem}")
+        if problems:
+            ok = False
+            continue
+        DATABASE_SCHEMAS[database_id] = schema
+
+    if fetched:
+        try:
+            save_schema_cache(cache_path, fetched)
+        except OSError as e:
+            print(f"⚠️ スキーマのキャッシュを書き出せませんでした: {e}")
+    if ok:
+        print(f"✅ データベースのスキーマ確認: {len(database_ids)}個（プロパティID: {cache_path}）")
+    else:
+        print("   プロパティ名は --image-property（画像）や振り分けファイルで変更できます。"
+              "画像プロパティを使わない場合は --no-image-property を指定してください")
+    return ok
+
+def property_keys(database_id, properties):
+    """プロパティ名を確認済みのプロパティIDに置き換える（スキーマを確認していなければ名前のまま）"""
+    schema = DATABASE_SCHEMAS.get(database_id)
+    if not schema:
+        return properties
+    return {schema[name]["id"] if name in schema else name: value for name, value in properties.items()}
+
+# ------------- データベースの既存ページ（重複の検出） -------------
+EXISTING_PAGES_PAGE_SIZE = 100  # 1回の問い合わせで返せる最大件数
+
+def existing_page_key(title, created):
+    """
+    既存ページの照合キー (タイトル, 作成日) を返す
+    作成日は Notion が返す形式（"2024-01-05T07:12:00.000+00:00" など）との違いを吸収し、UTCの分単位にそろえる
+    """
+    created = created or ""
+    try:
+        # Python 3.10 以前の fromisoformat は末尾の "Z" を読めないため、"+00:00" に置き換える
+        value = datetime.fromisoformat(created.replace("Z", "+00:00"))
+    except ValueError:
+        return title, created
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return title, value.strftime("%Y-%m-%dT%H:%M") if "T" in created else created
+
+def created_month_range(month):
+    """"YYYY-MM" の月の初日と翌月の初日（UTC、ISO 8601）を返す"""
+    year, number = map(int, month.split("-"))
+    start = datetime(year, number, 1, tzinfo=timezone.utc)
+    end = datetime(year + number // 12, number % 12 + 1, 1, tzinfo=timezone.utc)
+    return start.isoformat(), end.isoformat()
+
+def fetch_existing_pages(database_id, month):
+    """
+    作成日が指定した月（"YYYY-MM"、UTC）にあるデータベースの既存ページを問い合わせ（POST /databases/{id}/query）で走査し、
+    (タイトル, 作成日) → ページID の索引を返す（失敗時は None）
+    返すプロパティもタイトルと作成日に絞ってレスポンスを小さくする
+    """
+    schema = DATABASE_SCHEMAS.get(database_id) or {}
+    created_id = schema.get(CREATED_PROPERTY_NAME, {}).get("id", CREATED_PROPERTY_NAME)
+    path = (f"/databases/{database_id}/query?filter_properties=title"
+            f"&filter_properties={quote(created_id, safe='')}")
+    start, end = created_month_range(month)
+    payload = {
+        "page_size": EXISTING_PAGES_PAGE_SIZE,
+        "filter": {"and": [
+            {"property": created_id, "date": {"on_or_after": start}},
+            {"property": created_id, "date": {"before": end}}
+        ]}
+    }
+    index = {}
+    while True:
+        with METRICS.timer("existing_pages"):
+            response = send_notion_request("POST", path, payload, f"データベース {database_id} の既存ページの取得")
+        if response is None:
+            return None
+        data = response.json()
+        for page in data.get("results", []):
+            properties = page.get("properties", {})
+            title = next((prop["title"] for prop in properties.values() if prop.get("type") == "title"), [])
+            created = (properties.get(CREATED_PROPERTY_NAME, {}).get("date") or {}).get("start")
+            key = existing_page_key("".join(item.get("plain_text", "") for item in title), created)
+            # 同じキーのページが複数ある場合は最初のページに対応付ける
+            index.setdefault(key, page["id"])
+        METRICS.increment("existing_pages_scanned", len(data.get("results", [])))
+        if not data.get("has_more"):
+            return index
+        payload["start_cursor"] = data["next_cursor"]
+
+class ExistingPageIndex:
+    """
+    データベースの既存ページの (タイトル, 作成日) → ページID の索引
+    ノートの作成日の月を初めて照合するときに、その月に作成日があるページだけを問い合わせて加える
+    （アップロードするノートと関係のない期間のページは取得しない。同じ月は1回だけ走査する）
+    """
+    def __init__(self, database_id):
+        self.database_id = database_id
+        self.pages = {}
+        self.months = set()
+
+    def __len__(self):
+        return len(self.pages)
+
+    def get(self, key):
+        """キーに一致するページIDを返す（作成日を読めないノートは照合しない）"""
+        month = key[1][:7]
+        if not re.fullmatch(r"\d{4}-\d{2}", month):
+            return None
+        if month not in self.months:
+            pages = fetch_existing_pages(self.database_id, month)
+            if pages is None:
+                raise RuntimeError(f"データベース {self.database_id} の既存ページ（作成日 {month}）を取得できません")
+            for page_key, page_id in pages.items():
+                self.pages.setdefault(page_key, page_id)
+            self.months.add(month)
+        return self.pages.get(key)
+
+# ------------- レート制限（トークンバケット） -------------
+RATE_LIMITER = None
+
+class RateLimiter:
+    """
+    全ワーカーで共有するトークンバケット型のレートリミッター
+    rate: 1秒あたりに補充するトークン数（Notion API の平均上限は約3リクエスト/秒）
+    burst: バケットの容量（瞬間的に連続送信できるリクエスト数）
+    429 を受けると送信速度を半減させ、成功が続くと少しずつ元の速度に戻す（AIMD）
+    """
+    def __init__(self, rate=3.0, burst=None, min_rate=0.5, recovery_step=0.1):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.recovery_step = recovery_step
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def acquire(self):
+        """トークンを1つ取得する（取得できるまで待機）"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait_time = self.paused_until - now
+                else:
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def on_rate_limited(self, retry_after):
+        """429 を受けたときに呼ぶ：全ワーカーを一時停止し、送信速度を半減させる"""
+        with self.lock:
+            now = time.monotonic()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.paused_until = max(self.paused_until, now + retry_after)
+            # 停止中はトークンを補充しない
+            self.tokens = 0
+            self.updated = self.paused_until
+            print(f"⚠️ 送信速度を毎秒{self.rate:.2f}リクエストに落とします")
+
+    def on_success(self):
+        """リクエスト成功時に呼ぶ：送信速度を少しずつ上限まで戻す"""
+        with self.lock:
+            if self.rate < self.max_rate:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + self.recovery_step)
+
+# ------------- リトライの方針とサーキットブレーカー -------------
+class NotionAuthError(Exception):
+    """認証エラー（401/403）。APIキーやインテグレーションの接続を直すまで、どのリクエストも成功しない"""
+
+def parse_retry_after(value, default):
+    """Retry-After ヘッダーの秒数（小数も可）を返す（ない場合や解釈できない場合は default）"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return default
+
+class RetryPolicy:
+    """
+    Notion API のエラーの種類ごとのリトライの方針
+    - 409（競合）・429（レート制限）・5xx・通信エラー: 指数バックオフ（ジッター付き）で最大 max_retries 回リトライ
+      （429 は Retry-After の秒数を優先する）
+    - 400・404 などのその他の 4xx: リクエストの内容や対象の誤りで、送り直しても結果が変わらないためリトライしない
+    - 401/403: send_notion_request が NotionAuthError を送出して処理全体を止める
+    base_delay: 1回目のリトライの待機時間の目安（秒）。以後は2倍ずつ増やし、max_delay で頭打ちにする
+    """
+    RETRY_STATUSES = {409, 429}
+    AUTH_STATUSES = {401, 403}
+
+    def __init__(self, max_retries=3, base_delay=1.0, max_delay=30.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.random = random.Random()
+
+    def should_retry(self, status):
+        """ステータスコードのエラーをリトライするかを返す"""
+        return status in self.RETRY_STATUSES or status >= 500
+
+    def backoff(self, attempt):
+        """
+        attempt 回目（1から）のリトライまでの待機時間を返す
+        上限の半分は必ず待ち、残り半分をランダムにして、全ワーカーのリトライが同時に集中しないようにする
+        """
+        ceiling = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return ceiling / 2 + self.random.uniform(0, ceiling / 2)
+
+class CircuitBreaker:
+    """
+    全ワーカーで共有するサーキットブレーカー
+    5xx や通信エラーが failure_threshold 回続くと回路を開き、cooldown 秒の間すべてのワーカーの送信を止める
+    （API が不調なときに、全ワーカーがそれぞれリトライを重ねて負荷をかけ続けないようにする）
+    再開後もエラーが続けば待機時間を2倍にして（max_cooldown まで）再び止め、成功すれば元に戻す
+    """
+    def __init__(self, failure_threshold=5, cooldown=10.0, max_cooldown=120.0):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """回路が開いている間は待機する"""
+        while True:
+            with self.lock:
+                wait_time = self.open_until - time.monotonic()
+            if wait_time <= 0:
+                return
+            with METRICS.timer("circuit_wait"):
+                time.sleep(wait_time)
+
+    def record_success(self):
+        """API が応答したときに呼ぶ：連続したエラーの数と待機時間を元に戻す"""
+        with self.lock:
+            self.failures = 0
+            self.cooldown = self.base_cooldown
+
+    def record_failure(self):
+        """5xx や通信エラーのときに呼ぶ：連続したエラーが閾値に達したら回路を開く"""
+        with self.lock:
+            self.failures += 1
+            now = time.monotonic()
+            if self.failures < self.failure_threshold or now < self.open_until:
+                return
+            self.open_until = now + self.cooldown
+            print(f"⚠️ Notion API のエラーが{self.failures}回続いたため、{self.cooldown:g}秒間すべての送信を止めます")
+            METRICS.increment("circuit_opened")
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+
+RETRY_POLICY = RetryPolicy()
+CIRCUIT_BREAKER = None
+
+# ------------- 実行の計測（段ごとの処理時間とカウンター） -------------
+class RunMetrics:
+    """
+    段ごとの処理時間とカウンターを集計する（複数スレッドから呼ばれる）
+    処理時間は全スレッドの合計で、並列に動いている段の時間は経過時間を超えることがある
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.started_perf = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            count, total = self.stages.get(stage, (0, 0.0))
+            self.stages[stage] = (count + 1, total + seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """with ブロックの処理時間を段 stage に加算する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def increment(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def take_stages(self):
+        """段ごとの計測値を返して0に戻す（解析用プロセスからメインプロセスへ渡すため）"""
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        return stages
+
+    def merge_stages(self, stages):
+        """別プロセスで計測した段ごとの計測値を加算する"""
+        with self.lock:
+            for stage, (count, total) in stages.items():
+                current_count, current_total = self.stages.get(stage, (0, 0.0))
+                self.stages[stage] = (current_count + count, current_total + total)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started_perf
+
+    def to_dict(self, summary=None, options=None):
+        """レポート用の辞書を返す（summary: ノートの件数、options: 実行時の設定）"""
+        with self.lock:
+            stages = {stage: {"count": count, "seconds": round(total, 6)}
+                      for stage, (count, total) in sorted(self.stages.items())}
+            counters = dict(sorted(self.counters.items()))
+        return {
+            "started_at": datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+            "elapsed_seconds": round(self.elapsed(), 6),
+            "options": options or {},
+            "summary": summary or {},
+            "stages": stages,
+            "counters": counters
+        }
+
+    def to_prometheus(self, summary=None):
+        """Prometheus のテキスト形式（node_exporter の textfile collector 用）で返す"""
+        report = self.to_dict(summary)
+        lines = [
+            "# TYPE upnote_upload_elapsed_seconds gauge",
+            f"upnote_upload_elapsed_seconds {report['elapsed_seconds']}",
+            "# TYPE upnote_upload_stage_seconds_total counter",
+        ]
+        lines += [f'upnote_upload_stage_seconds_total{{stage="{stage}"}} {value["seconds"]}'
+                  for stage, value in report["stages"].items()]
+        lines.append("# TYPE upnote_upload_stage_calls_total counter")
+        lines += [f'upnote_upload_stage_calls_total{{stage="{stage}"}} {value["count"]}'
+                  for stage, value in report["stages"].items()]
+        lines.append("# TYPE upnote_upload_events_total counter")
+        lines += [f'upnote_upload_events_total{{event="{counter}"}} {value}'
+                  for counter, value in report["counters"].items()]
+        lines.append("# TYPE upnote_upload_notes gauge")
+        lines += [f'upnote_upload_notes{{result="{key}"}} {value}'
+                  for key, value in report["summary"].items()]
+        return "\n".join(lines) + "\n"
+
+    def write_report(self, path, report_format="json", summary=None, options=None):
+        """レポートをファイルに書き出す"""
+        with open(path, "w", encoding="utf-8") as f:
+            if report_format == "prometheus":
+                f.write(self.to_prometheus(summary))
+            else:
+                json.dump(self.to_dict(summary, options), f, ensure_ascii=False, indent=2)
+                f.write("\n")
+
+METRICS = RunMetrics()
 
 # ------------- 画像URLの生成（レンタルサーバー版） -------------
-BASE_IMAGE_URL = "https://www.soratomo.com/img_UpNote_diary/"
+BASE_IMAGE_URL_DEFAULT = "https://www.soratomo.com/img_UpNote_diary/"
+BASE_IMAGE_URL = BASE_IMAGE_URL_DEFAULT  # --image-base-url で変更できる
+IMAGE_MANIFEST = None
+IMAGE_MANIFEST_LOCK = threading.Lock()
 
-def generate_image_url(filename):
-    """ファイル名からレンタルサーバー上の画像URLを生成"""
+def normalize_image_url(filename):
+    """ファイル名からレンタルサーバー上の画像URLを組み立てる"""
     # 画像ファイルの拡張子を小文字に統一（大文字の拡張子対応）
     name, ext = os.path.splitext(filename)
-    normalized_filename = f"{name}{ext.lower()}"
+    return f"{BASE_IMAGE_URL}{name}{ext.lower()}"
 
-    # 画像ファイルの存在確認（ローカルの Files ディレクトリ内）
-    local_image_path = os.path.join(NOTES_DIR, "Files", filename)
-    if not os.path.exists(local_image_path):
-        print(f"⚠️ 警告: 画像ファイル {filename} がローカルに見つかりません。URLは生成されますが、サーバー上に存在するか確認してください。")
+class ImageManifest:
+    """
+    Files ディレクトリの画像の一覧（ファイル名 → サイズ・更新日時・URL）
+    起動時に os.scandir で1回だけ走査し、以降の存在確認とURL生成はメモリ上で行う
+    """
+    def __init__(self, files_dir):
+        self.files_dir = files_dir
+        self.entries = {}
+        self.warned = set()
+        self.lock = threading.Lock()
+        try:
+            with os.scandir(files_dir) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        self.entries[entry.name] = {
+                            "size": stat.st_size,
+                            "mtime": stat.st_mtime,
+                            "url": normalize_image_url(entry.name)
+                        }
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, filename):
+        return filename in self.entries
+
+    def get(self, filename):
+        return self.entries.get(filename)
+
+    def path(self, filename):
+        return os.path.join(self.files_dir, filename)
+
+    def source(self, filename, variant="inline"):
+        """
+        送信する画像ファイルの {"path", "name", "size", "mtime"} を返す（ローカルにない画像は None）
+        縮小版（variant: cover / inline）が作られていればそちらを返す
+        """
+        entry = self.entries.get(filename)
+        if entry is None:
+            return None
+        variants = entry.get("variants") or {}
+        source = variants.get(variant) or variants.get("inline")
+        if source:
+            return source
+        return {"path": self.path(filename), "name": filename, "size": entry["size"], "mtime": entry["mtime"]}
+
+    def has_variant(self, filename, variant):
+        entry = self.entries.get(filename)
+        return bool(entry and variant in (entry.get("variants") or {}))
+
+    def url(self, filename, variant="inline"):
+        """画像URLを返す（ローカルにない画像は初回だけ警告を表示する）"""
+        entry = self.entries.get(filename)
+        if entry:
+            urls = entry.get("urls") or {}
+            return urls.get(variant) or urls.get("inline") or entry["url"]
+        with self.lock:
+            first_time = filename not in self.warned
+            self.warned.add(filename)
+        if first_time:
+            print(f"⚠️ 警告: 画像ファイル {filename} がローカルに見つかりません。URLは生成されますが、サーバー上に存在するか確認してください。")
+        return normalize_image_url(filename)
+
+def get_image_manifest():
+    """画像の一覧を返す（未作成なら NOTES_DIR/Files を走査して作る）"""
+    global IMAGE_MANIFEST
+    if IMAGE_MANIFEST is None:
+        with IMAGE_MANIFEST_LOCK:
+            if IMAGE_MANIFEST is None:
+                IMAGE_MANIFEST = ImageManifest(os.path.join(NOTES_DIR, "Files"))
+    return IMAGE_MANIFEST
+
+def generate_image_url(filename, variant="inline"):
+    """ファイル名から画像URLを生成（variant: 縮小版を公開している場合に cover / inline を選ぶ）"""
+    return get_image_manifest().url(filename, variant)
+
+# ------------- 画像の縮小と再圧縮 -------------
+IMAGE_CACHE_DIR = os.path.expanduser("~/src/up_note_to_notion/image_cache")
+IMAGE_PROCESS_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+IMAGE_FORMATS = {"jpeg": ("JPEG", ".jpg"), "webp": ("WEBP", ".webp")}
+
+def make_image_variants(source_path, cache_dir, widths, image_format="jpeg", quality=82):
+    """
+    画像の縮小版を作る（プロセスプールで実行される）
+    widths: {variant: 最大幅}（cover / inline）
+    縮小版は元の画像の SHA-256 と設定をファイル名にしてキャッシュするため、再実行時は作り直さない
+    縮小しても元の画像より小さくならない場合は None（元の画像をそのまま使う）
+    戻り値: {variant: 縮小版のパス または None}
+    """
+    from PIL import Image, ImageOps
+
+    with open(source_path, "rb") as f:
+        content = f.read()
+    digest = hashlib.sha256(content).hexdigest()
+    pil_format, ext = IMAGE_FORMATS[image_format]
+    directory = os.path.join(cache_dir, digest[:2])
+    os.makedirs(directory, exist_ok=True)
+
+    image = None
+    results = {}
+    for variant, max_width in widths.items():
+        path = os.path.join(directory, f"{digest}-w{max_width}-q{quality}{ext}")
+        # 元の画像を使うと決めた結果も目印のファイルで覚えておく
+        skip_marker = path + ".original"
+        if os.path.exists(path):
+            results[variant] = path
+            continue
+        if os.path.exists(skip_marker):
+            results[variant] = None
+            continue
+
+        if image is None:
+            with Image.open(source_path) as opened:
+                image = ImageOps.exif_transpose(opened)
+                image.load()
+            if pil_format == "JPEG" and image.mode != "RGB":
+                # JPEG は透過を扱えないため、白い背景に重ねる
+                rgba = image.convert("RGBA")
+                image = Image.new("RGB", rgba.size, (255, 255, 255))
+                image.paste(rgba, mask=rgba.getchannel("A"))
+        resized = image.copy()
+        resized.thumbnail((max_width, max_width * 10), Image.LANCZOS)
+
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=ext)
+        os.close(fd)
+        try:
+            if pil_format == "JPEG":
+                resized.save(temp_path, pil_format, quality=quality, optimize=True, progressive=True)
+            else:
+                resized.save(temp_path, pil_format, quality=quality, method=4)
+            if os.path.getsize(temp_path) >= len(content):
+                os.unlink(temp_path)
+                open(skip_marker, "w").close()
+                results[variant] = None
+            else:
+                os.replace(temp_path, path)
+                results[variant] = path
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+    return results
+
+def process_images(manifest, widths, cache_dir=IMAGE_CACHE_DIR, image_format="jpeg", quality=82, workers=None):
+    """
+    Files フォルダの画像の縮小版をプロセスプールで作り、画像一覧に登録する
+    以降の公開・アップロードは縮小版を使う（作れなかった画像は元の画像を使う）
+    """
+    filenames = [filename for filename in manifest.entries
+                 if os.path.splitext(filename)[1].lower() in IMAGE_PROCESS_EXTENSIONS]
+    counts = {"processed": 0, "original": 0, "failed": 0}
+    saved_bytes = 0
+    print(f"🖼 {len(filenames)} 件の画像の縮小版を作ります（最大幅: "
+          + ", ".join(f"{variant} {width}px" for variant, width in widths.items()) + "）...")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(make_image_variants, manifest.path(filename), cache_dir, widths,
+                                   image_format, quality): filename for filename in filenames}
+        for future, filename in futures.items():
+            entry = manifest.get(filename)
+            try:
+                results = future.result()
+            except Exception as e:
+                print(f"⚠️ 画像 {filename} の縮小版を作れませんでした（元の画像を使います）: {e}")
+                counts["failed"] += 1
+                continue
+            variants = {}
+            stem = os.path.splitext(filename)[0]
+            for variant, path in results.items():
+                if path:
+                    stat = os.stat(path)
+                    variants[variant] = {"path": path, "name": stem + os.path.splitext(path)[1],
+                                         "size": stat.st_size, "mtime": stat.st_mtime}
+            if variants.get("inline"):
+                saved_bytes += entry["size"] - variants["inline"]["size"]
+            if variants:
+                entry["variants"] = variants
+                counts["processed"] += 1
+            else:
+                counts["original"] += 1
+    METRICS.increment("images_processed", counts["processed"])
+    print(f"✅ 画像の縮小: 縮小版 {counts['processed']} 件、元の画像のまま {counts['original']} 件、"
+          f"失敗 {counts['failed']} 件（本文用で {saved_bytes / (1024 * 1024):.1f}MB 削減）")
+    return counts
+
+# ------------- 画像の公開先（ローカルのディレクトリ・S3互換ストレージ・WebDAV） -------------
+class ImagePublisher:
+    """
+    画像の公開先の基底クラス
+    画像は内容の SHA-256 をキーにして置くため、同じ画像は一度公開すれば再実行しても送り直さない
+    base_url: 公開先の画像を参照するURL（キーを結合して画像URLにする）
+    """
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/") + "/"
+
+    def url(self, key):
+        return self.base_url + quote(key)
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def put(self, key, path, content_type):
+        raise NotImplementedError
+
+    def describe(self):
+        return self.base_url
+
+class LocalDirectoryPublisher(ImagePublisher):
+    """ローカルのディレクトリ（Webサーバーで公開されている、またはマウントされた共有フォルダ）に画像をコピーする"""
+    def __init__(self, directory, base_url):
+        super().__init__(base_url)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def exists(self, key):
+        return os.path.exists(os.path.join(self.directory, key))
+
+    def put(self, key, path, content_type):
+        # 書き込み途中のファイルが公開されないよう、一時ファイルに書いてから置き換える
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".upload-")
+        os.close(fd)
+        try:
+            shutil.copyfile(path, temp_path)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, os.path.join(self.directory, key))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def describe(self):
+        return f"{self.directory}（{self.base_url}）"
+
+class S3Publisher(ImagePublisher):
+    """S3互換ストレージ（AWS S3・MinIO など）に画像をアップロードする（boto3 が必要）"""
+    def __init__(self, bucket, prefix="", base_url=None, endpoint_url=None):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise ImportError("S3に公開するには boto3 が必要です（pip install boto3）")
+        if base_url is None:
+            if endpoint_url:
+                base_url = f"{endpoint_url.rstrip('/')}/{bucket}/{prefix}"
+            else:
+                base_url = f"https://{bucket}.s3.amazonaws.com/{prefix}"
+        super().__init__(base_url)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client_error = ClientError
+        # 認証情報は boto3 の標準の方法（環境変数・~/.aws/credentials など）で読み込む
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.prefix + key)
+            return True
+        except self.client_error as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def put(self, key, path, content_type):
+        self.client.upload_file(path, self.bucket, self.prefix + key, ExtraArgs={"ContentType": content_type})
+
+    def describe(self):
+        return f"s3://{self.bucket}/{self.prefix}（{self.base_url}）"
+
+class WebDAVPublisher(ImagePublisher):
+    """WebDAVサーバーに画像を PUT する（認証情報は環境変数 WEBDAV_USERNAME / WEBDAV_PASSWORD）"""
+    def __init__(self, target_url, base_url=None, timeout=60):
+        super().__init__(base_url or target_url)
+        self.target_url = target_url.rstrip("/") + "/"
+        self.timeout = timeout
+        self.session = requests.Session()
+        if os.environ.get("WEBDAV_USERNAME"):
+            self.session.auth = (os.environ["WEBDAV_USERNAME"], os.environ.get("WEBDAV_PASSWORD", ""))
+        # 公開先のフォルダがなければ作る（既にある場合の 405 は無視する）
+        response = self.session.request("MKCOL", self.target_url, timeout=self.timeout)
+        if response.status_code not in (201, 405, 301, 200):
+            raise ValueError(f"WebDAVのフォルダを作成できません: {response.status_code}")
+
+    def exists(self, key):
+        response = self.session.head(self.target_url + quote(key), timeout=self.timeout)
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        return True
+
+    def put(self, key, path, content_type):
+        with open(path, "rb") as f:
+            response = self.session.put(self.target_url + quote(key), data=f,
+                                        headers={"Content-Type": content_type}, timeout=self.timeout)
+        response.raise_for_status()
 
-    return f"{BASE_IMAGE_URL}{normalized_filename}"
+    def describe(self):
+        return f"{self.target_url}（WebDAV）"
+
+def create_image_publisher(target, base_url=None, s3_endpoint_url=None):
+    """
+    --image-target の指定から公開先を作る
+    s3://バケット/プレフィックス → S3互換ストレージ、http(s)://… → WebDAV、それ以外 → ローカルのディレクトリ
+    """
+    parsed = urlparse(target)
+    if parsed.scheme == "s3":
+        prefix = parsed.path.lstrip("/")
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        return S3Publisher(parsed.netloc, prefix, base_url=base_url, endpoint_url=s3_endpoint_url)
+    if parsed.scheme in ("http", "https"):
+        return WebDAVPublisher(target, base_url=base_url)
+    if not base_url:
+        raise ValueError("ローカルのディレクトリに公開する場合は --image-base-url に公開URLを指定してください")
+    return LocalDirectoryPublisher(os.path.expanduser(target), base_url)
+
+def publish_images(manifest, publisher, workers=4):
+    """
+    Files フォルダの画像を並列で公開先にアップロードし、画像一覧のURLを公開先のURLに差し替える
+    公開先に同じ内容の画像（SHA-256 が同じキー）が既にある場合は送らない
+    """
+    counts = {"uploaded": 0, "skipped": 0, "failed": 0}
+    counts_lock = threading.Lock()
+    key_locks = {}
+
+    def publish(item):
+        filename, variant = item
+        entry = manifest.get(filename)
+        source = manifest.source(filename, variant)
+        try:
+            with open(source["path"], "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            key = f"{digest}{os.path.splitext(source['name'])[1].lower()}"
+            # 別名の同じ画像を同時に送らないよう、キーごとに1スレッドだけが確認と送信を行う
+            with counts_lock:
+                key_lock = key_locks.setdefault(key, threading.Lock())
+            with key_lock:
+                if publisher.exists(key):
+                    result = "skipped"
+                else:
+                    content_type = mimetypes.guess_type(source["name"])[0] or "application/octet-stream"
+                    publisher.put(key, source["path"], content_type)
+                    METRICS.increment("bytes_published", source["size"])
+                    result = "uploaded"
+            entry.setdefault("urls", {})[variant] = publisher.url(key)
+        except Exception as e:
+            print(f"⚠️ 画像 {filename} を公開できませんでした（従来のURLで参照します）: {e}")
+            result = "failed"
+        with counts_lock:
+            counts[result] += 1
+        METRICS.increment(f"images_publish_{result}")
+
+    # 本文用の画像に加え、カバー用の縮小版があればそれも公開する
+    items = [(filename, "inline") for filename in manifest.entries]
+    items += [(filename, "cover") for filename in manifest.entries if manifest.has_variant(filename, "cover")]
+    print(f"📤 {len(items)} 件の画像を公開先に送ります（並列数: {workers}）...")
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-publish") as executor:
+        list(executor.map(publish, items))
+    print(f"✅ 画像の公開: アップロード {counts['uploaded']} 件、公開済みのためスキップ {counts['skipped']} 件、"
+          f"失敗 {counts['failed']} 件")
+    return counts
+
+def image_file_object(filename, uploads=None, variant="inline"):
+    """
+    画像をNotionのファイルオブジェクトとして返す
+    uploads: {(ファイル名, variant): ファイルアップロードID}（Notionにアップロード済みの画像はIDで参照する）
+    """
+    if uploads:
+        upload_id = uploads.get((filename, variant)) or uploads.get((filename, "inline"))
+        if upload_id:
+            return {"type": "file_upload", "file_upload": {"id": upload_id}}
+    # 外部URLの形は以前と同じにしておく（--sync のブロック指紋が変わらないように）
+    return {"external": {"url": generate_image_url(filename, variant)}}
+
+def find_missing_images(notes_dir, manifest):
+    """
+    エクスポート全体を走査し、ローカルに見つからない画像を {画像ファイル名: [ノートのファイル名]} で返す
+    アップロード前の事前チェック用（ノートの内容はメモリに残さない）
+    """
+    missing = {}
+    for job in scan_markdown_files(notes_dir):
+        try:
+            with open(job["path"], "r", encoding="utf-8") as f:
+                content = f.read()
+        except (OSError, UnicodeDecodeError):
+            # 読み込めないノートはアップロード時にエラーとして報告される
+            continue
+        for image_match in IMAGE_PATTERN.finditer(content):
+            filename = image_match.group(1)
+            if filename not in manifest:
+                notes = missing.setdefault(filename, [])
+                if job["filename"] not in notes:
+                    notes.append(job["filename"])
+    return missing
+
+# ------------- 画像のアップロード（Notionのファイルアップロード） -------------
+FILE_UPLOAD_CACHE_FILE = os.path.expanduser("~/src/up_note_to_notion/file_upload_cache.jsonl")
+NOTION_MAX_SINGLE_PART_UPLOAD = 20 * 1024 * 1024  # 1回のリクエストで送れるファイルサイズの上限
+FILE_UPLOAD_EXPIRY_MARGIN = 10 * 60  # 有効期限が近い未添付のアップロードは使わない（秒）
+IMAGE_UPLOADER = None
+
+class FileUploadCache:
+    """
+    画像の SHA-256 → Notionのファイルアップロード ID の対応を記録する追記型（JSONL）のキャッシュ
+    複数のノートで使われる画像や再実行時の画像を、同じバイト列を送り直さずに参照するために使う
+    ファイル名・サイズ・更新日時も記録し、変わっていない画像はハッシュ計算のための読み込みを省く
+    scope（APIキーのハッシュ）ごとに記録を分けるため、別のインテグレーションのIDは使わない
+    """
+    def __init__(self, path, scope):
+        self.path = path
+        self.scope = scope
+        self.entries = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get("scope") == scope and "sha256" in entry:
+                        self._index(entry)
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _index(self, entry):
+        self.entries[entry["sha256"]] = entry
+        self.stats[(entry.get("name"), entry.get("size"), entry.get("mtime"))] = entry["sha256"]
+
+    def hash_for(self, name, size, mtime):
+        """前回と同じファイル名・サイズ・更新日時の画像のハッシュを返す（なければ None）"""
+        with self.lock:
+            return self.stats.get((name, size, mtime))
+
+    def get(self, sha256):
+        """まだ使えるファイルアップロードの記録を返す（ページに添付済みか、有効期限内のもの）"""
+        with self.lock:
+            entry = self.entries.get(sha256)
+        if not entry:
+            return None
+        if entry.get("attached"):
+            return entry
+        expires_at = entry.get("expires_at")
+        if expires_at and expires_at - FILE_UPLOAD_EXPIRY_MARGIN > time.time():
+            return entry
+        return None
+
+    def record(self, sha256, upload_id, name, size, mtime, expires_at=None, attached=False):
+        entry = {
+            "sha256": sha256,
+            "scope": self.scope,
+            "id": upload_id,
+            "name": name,
+            "size": size,
+            "mtime": mtime,
+            "expires_at": expires_at,
+            "attached": attached,
+            "recorded_at": datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        }
+        with self.lock:
+            self._index(entry)
+            self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.file.flush()
+        return entry
+
+    def mark_attached(self, sha256):
+        """ページに添付したアップロードを記録する（添付後は有効期限がなくなる）"""
+        with self.lock:
+            entry = self.entries.get(sha256)
+        if entry and not entry.get("attached"):
+            self.record(sha256, entry["id"], entry["name"], entry["size"], entry["mtime"], attached=True)
+
+    def close(self):
+        self.file.close()
+
+def parse_expiry_time(value):
+    """Notionの expiry_time（ISO 8601）をUNIX時刻に変換する（読めなければ None）"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+class ImageUploader:
+    """
+    ローカルの画像をNotionのファイルアップロードAPIで送り、ファイルアップロードIDを返す
+    ページ作成と並行して動くスレッドプールで送信し、同じ内容の画像は1回だけ送る
+    送れない画像（ローカルにない・大きすぎる・送信に失敗した）は None を返し、従来どおり外部URLで参照する
+    """
+    def __init__(self, cache, manifest, workers=2):
+        self.cache = cache
+        self.manifest = manifest
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-upload")
+        self.futures = {}
+        self.hash_locks = {}
+        self.lock = threading.Lock()
+
+    def submit(self, filename, variant="inline"):
+        """画像の送信を予約し、(ファイルアップロードID, SHA-256) または None を返す Future を返す"""
+        with self.lock:
+            future = self.futures.get((filename, variant))
+            if future is None:
+                future = self.executor.submit(self.upload, filename, variant)
+                self.futures[(filename, variant)] = future
+            return future
+
+    def _hash_lock(self, sha256):
+        with self.lock:
+            return self.hash_locks.setdefault(sha256, threading.Lock())
+
+    def upload(self, filename, variant="inline"):
+        # 縮小版が作られていれば、元の画像ではなく縮小版を送る
+        source = self.manifest.source(filename, variant)
+        if source is None:
+            return None
+        if source["size"] > NOTION_MAX_SINGLE_PART_UPLOAD:
+            print(f"⚠️ 画像 {filename} は{NOTION_MAX_SINGLE_PART_UPLOAD // (1024 * 1024)}MBを超えるため、外部URLで参照します")
+            return None
+
+        try:
+            content = None
+            sha256 = self.cache.hash_for(source["name"], source["size"], source["mtime"])
+            if sha256 is None:
+                with open(source["path"], "rb") as f:
+                    content = f.read()
+                sha256 = hashlib.sha256(content).hexdigest()
+
+            # 別名の同じ画像を同時に送らないよう、ハッシュごとに1スレッドだけが送信する
+            with self._hash_lock(sha256):
+                cached = self.cache.get(sha256)
+                if cached:
+                    METRICS.increment("image_upload_cache_hits")
+                    return cached["id"], sha256
+                if content is None:
+                    with open(source["path"], "rb") as f:
+                        content = f.read()
+                with METRICS.timer("image_upload"):
+                    upload_id, expires_at = self._send(source["name"], content)
+                if upload_id is None:
+                    return None
+                METRICS.increment("images_uploaded")
+                self.cache.record(sha256, upload_id, source["name"], source["size"], source["mtime"], expires_at=expires_at)
+                return upload_id, sha256
+        except OSError as e:
+            print(f"⚠️ 画像 {filename} を読み込めないため、外部URLで参照します: {e}")
+            return None
+
+    def _send(self, filename, content):
+        """ファイルアップロードを作成して内容を送り、(ID, 有効期限) を返す（失敗時は (None, None)）"""
+        content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        response = send_notion_request("POST", "/file_uploads", {"filename": filename, "content_type": content_type},
+                                       f"画像 {filename} のアップロード作成")
+        if response is None:
+            return None, None
+        upload_id = response.json()["id"]
+        response = send_notion_request("POST", f"/file_uploads/{upload_id}/send", description=f"画像 {filename} の送信",
+                                       files={"file": (filename, content, content_type)})
+        if response is None:
+            return None, None
+        result = response.json()
+        if result.get("status") != "uploaded":
+            print(f"⚠️ 画像 {filename} のアップロードが完了しませんでした（status: {result.get('status')}）")
+            return None, None
+        print(f"🖼 画像 {filename} をNotionにアップロードしました")
+        return upload_id, parse_expiry_time(result.get("expiry_time"))
+
+    def resolve(self, futures):
+        """予約した送信の完了を待ち、({(ファイル名, variant): ID}, [SHA-256]) を返す（送れなかった画像は含めない）"""
+        uploads = {}
+        hashes = []
+        for key, future in futures.items():
+            result = future.result()
+            if result:
+                uploads[key] = result[0]
+                hashes.append(result[1])
+        return uploads, hashes
+
+    def close(self):
+        # 中断された場合に備え、まだ始まっていない送信は取り消す
+        self.executor.shutdown(wait=True, cancel_futures=True)
 
 # ------------- 日付フォーマットをNotion用（ISO 8601）に変換する関数 -------------
+STRICT_DATE_PATTERN = re.compile(r"([1-9]\d{3})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})")
+
 def format_date(date_str):
     """YYYY-MM-DD HH:MM:SS を ISO 8601 形式に変換"""
+    # ゼロ埋めされた標準的な形式は strptime を使わずに変換する（日付の妥当性は datetime で確認）
+    match = STRICT_DATE_PATTERN.fullmatch(date_str)
+    if match:
+        try:
+            datetime(*map(int, match.groups()))
+            year, month, day, hour, minute, second = match.groups()
+            return f"{year}-{month}-{day}T{hour}:{minute}:{second}Z"
+        except ValueError:
+            pass
+
     try:
         dt = datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S")
         return dt.strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -367,277 +2449,383 @@ def format_date(date_str):
         return None
 
 # ------------- 本文からアイコンを推測する関数 -------------
+# キーワードと対応する絵文字（同じ長さのキーワードが複数見つかった場合は先に書かれたものを優先）
+DEFAULT_ICON_KEYWORDS = [
+    # 朝勉関連
+    ("朝勉", "🌅"),
+    ("勉強", "📚"),
+    ("学習", "📝"),
+    ("勤続", "🔄"),
+    ("早起き", "🌄"),
+    ("朝活", "☀️"),
+
+    # 時間関連
+    ("時間", "⏰"),
+    ("スケジュール", "📅"),
+    ("予定", "📆"),
+    ("締め切り", "⏳"),
+    ("期限", "⌛"),
+
+    # 感情関連
+    ("嬉しい", "😊"),
+    ("楽しい", "😄"),
+    ("悲しい", "😢"),
+    ("辛い", "😣"),
+    ("疲れ", "😩"),
+    ("頑張", "💪"),
+    ("がんば", "💪"),
+
+    # 場所関連
+    ("家", "🏠"),
+    ("実家", "🏡"),
+    ("学校", "🏫"),
+    ("会社", "🏢"),
+    ("オフィス", "🏢"),
+    ("カフェ", "☕"),
+
+    # 食事関連
+    ("食事", "🍽️"),
+    ("朝食", "🍳"),
+    ("昼食", "🍱"),
+    ("夕食", "🍲"),
+    ("晩ごはん", "🍲"),
+    ("コーヒー", "☕"),
+    ("お茶", "🍵"),
+
+    # 天気関連
+    ("晴れ", "☀️"),
+    ("雨", "🌧️"),
+    ("雪", "❄️"),
+    ("曇り", "☁️"),
+    ("台風", "🌀"),
+    ("寒い", "🥶"),
+    ("暑い", "🥵"),
+
+    # 季節関連
+    ("春", "🌸"),
+    ("夏", "🌞"),
+    ("秋", "🍂"),
+    ("冬", "⛄"),
+    ("年末", "🎍"),
+    ("年始", "🎍"),
+    ("正月", "🎍"),
+
+    # イベント関連
+    ("誕生日", "🎂"),
+    ("クリスマス", "🎄"),
+    ("ハロウィン", "🎃"),
+    ("旅行", "✈️"),
+    ("旅", "🧳"),
+    ("休暇", "🏖️"),
+    ("休日", "🛌"),
+
+    # 仕事関連
+    ("仕事", "💼"),
+    ("会議", "🗣️"),
+    ("プレゼン", "📊"),
+    ("資料", "📑"),
+    ("メール", "📧"),
+    ("電話", "📱"),
+
+    # 健康関連
+    ("健康", "🏥"),
+    ("運動", "🏃"),
+    ("ジム", "🏋️"),
+    ("ヨガ", "🧘‍♀️"),
+    ("散歩", "🚶"),
+    ("睡眠", "💤"),
+
+    # 趣味関連
+    ("読書", "📖"),
+    ("映画", "🎬"),
+    ("音楽", "🎵"),
+    ("ゲーム", "🎮"),
+    ("料理", "👨‍🍳"),
+    ("写真", "📷"),
+    ("絵", "🎨"),
+
+    # 交通関連
+    ("電車", "🚆"),
+    ("バス", "🚌"),
+    ("車", "🚗"),
+    ("自転車", "🚲"),
+    ("飛行機", "✈️"),
+    ("通勤", "🚶"),
+
+    # コミュニケーション関連
+    ("友達", "👫"),
+    ("家族", "👨‍👩‍👧‍👦"),
+    ("恋人", "💑"),
+    ("会話", "💬"),
+    ("メッセージ", "💌"),
+
+    # テクノロジー関連
+    ("パソコン", "💻"),
+    ("スマホ", "📱"),
+    ("アプリ", "📲"),
+    ("インターネット", "🌐"),
+    ("SNS", "📱"),
+    ("プログラミング", "👨‍💻"),
+
+    # その他
+    ("アイデア", "💡"),
+    ("メモ", "📝"),
+    ("計画", "📋"),
+    ("目標", "🎯"),
+    ("成功", "🏆"),
+    ("失敗", "😓"),
+    ("質問", "❓"),
+    ("答え", "❗"),
+    ("重要", "⚠️"),
+    ("緊急", "🚨"),
+    ("お金", "💰"),
+    ("買い物", "🛒"),
+    ("プレゼント", "🎁"),
+    ("スポーツ", "🏅"),
+    ("ニュース", "📰"),
+
+    # 追加キーワード（より多様なアイコンを提供）
+    ("考え", "🤔"),
+    ("思考", "💭"),
+    ("発見", "🔍"),
+    ("気づき", "💫"),
+    ("成長", "📈"),
+    ("変化", "🔄"),
+    ("挑戦", "🏔️"),
+    ("達成", "🏅"),
+    ("反省", "🔄"),
+    ("振り返り", "🔙"),
+    ("未来", "🔮"),
+    ("希望", "✨"),
+    ("夢", "💭"),
+    ("願い", "🙏"),
+    ("感謝", "🙏"),
+    ("喜び", "🎊"),
+    ("驚き", "😲"),
+    ("焦り", "💦"),
+    ("不安", "😰"),
+    ("心配", "😟"),
+    ("安心", "😌"),
+    ("リラックス", "🧘"),
+    ("集中", "🎯"),
+    ("忙しい", "⏰"),
+    ("余裕", "😎"),
+    ("自信", "💪"),
+    ("迷い", "🤷"),
+    ("決断", "✅"),
+    ("選択", "🔀"),
+    ("整理", "🗂️"),
+    ("片付け", "🧹"),
+    ("掃除", "🧼"),
+    ("準備", "🔧"),
+    ("始まり", "🎬"),
+    ("終わり", "🏁"),
+    ("継続", "🔁"),
+    ("習慣", "📆"),
+    ("ルーティン", "🔄"),
+    ("改善", "📈"),
+    ("工夫", "🛠️"),
+    ("創造", "🎨"),
+    ("発明", "💡"),
+    ("実験", "🧪"),
+    ("分析", "📊"),
+    ("調査", "🔎"),
+    ("研究", "🔬"),
+    ("学び", "🎓"),
+    ("教育", "🏫"),
+    ("指導", "👨‍🏫"),
+    ("相談", "💬"),
+    ("アドバイス", "💡"),
+    ("協力", "🤝"),
+    ("チーム", "👥"),
+    ("グループ", "👪"),
+    ("コミュニティ", "🏘️"),
+    ("社会", "🌐"),
+    ("世界", "🌍"),
+    ("自然", "🌳"),
+    ("環境", "🌱"),
+    ("動物", "🐾"),
+    ("植物", "🌿"),
+    ("花", "🌸"),
+    ("海", "🌊"),
+    ("山", "⛰️"),
+    ("川", "🏞️"),
+    ("空", "☁️"),
+    ("星", "⭐"),
+    ("月", "🌙"),
+    ("太陽", "☀️"),
+    ("朝", "🌅"),
+    ("昼", "🌞"),
+    ("夕方", "🌇"),
+    ("夜", "🌃"),
+    ("深夜", "🌌"),
+    ("瞑想", "🧘"),
+    ("ストレッチ", "🤸"),
+    ("ウォーキング", "🚶"),
+    ("ランニング", "🏃"),
+    ("トレーニング", "🏋️"),
+    ("サッカー", "⚽"),
+    ("野球", "⚾"),
+    ("テニス", "🎾"),
+    ("バスケ", "🏀"),
+    ("水泳", "🏊"),
+    ("ゴルフ", "⛳"),
+    ("釣り", "🎣"),
+    ("キャンプ", "⛺"),
+    ("ハイキング", "🥾"),
+    ("登山", "🧗"),
+    ("サイクリング", "🚴"),
+    ("ドライブ", "🚗"),
+    ("観光", "🗿"),
+    ("美術館", "🏛️"),
+    ("博物館", "🏛️"),
+    ("映画館", "🎦"),
+    ("劇場", "🎭"),
+    ("コンサート", "🎵"),
+    ("ライブ", "🎤"),
+    ("フェス", "🎪"),
+    ("パーティー", "🎉"),
+    ("お祝い", "🎊"),
+    ("記念日", "🎂"),
+    ("結婚", "💒"),
+    ("出産", "👶"),
+    ("育児", "👨‍👩‍👧"),
+    ("子育て", "👨‍👩‍👧"),
+    ("大学", "🎓"),
+    ("卒業", "🎓"),
+    ("就職", "💼"),
+    ("転職", "🔄"),
+    ("昇進", "📈"),
+    ("退職", "🚪"),
+    ("老後", "👴"),
+    ("人生", "🌈"),
+]
+
+ICON_KEYWORDS_FILE = None  # --icon-keywords で指定されたキーワードファイル
+ICON_MATCHER = None
+ICON_MATCHER_LOCK = threading.Lock()
+
+HASHTAG_PATTERN = re.compile(r"#\S+")
+STREAK_PATTERN = re.compile(r"朝勉勤続\d+日目[。]?")
+DAY_NUMBER_PATTERN = re.compile(r'(\d+)日目')
+
+class KeywordMatcher:
+    """
+    Aho–Corasick 法で複数のキーワードを1回の走査で探す照合器
+    keywords: (キーワード, 値) のリスト（リストの順番が同じ長さのキーワード同士の優先順位になる）
+    find_best はテキスト中に現れるキーワードのうち最長のものを返す
+    """
+    def __init__(self, keywords):
+        self.keywords = keywords
+        self.goto = [{}]
+        self.fail = [0]
+        # 各状態で一致が確定するキーワードのうち最も優先度が高いもの（なければ -1）
+        self.best = [-1]
+
+        # トライ木を構築
+        for index, (keyword, _) in enumerate(keywords):
+            state = 0
+            for char in keyword:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.best.append(-1)
+                state = next_state
+            self.best[state] = self._prefer(self.best[state], index)
+
+        # 幅優先で失敗遷移を求め、失敗先で一致するキーワードも引き継ぐ
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.best[next_state] = self._prefer(self.best[next_state], self.best[self.fail[next_state]])
+                queue.append(next_state)
+
+    def _prefer(self, a, b):
+        """優先するキーワードの番号を返す（長いものを優先し、同じ長さなら番号が小さいもの）"""
+        if a < 0:
+            return b
+        if b < 0:
+            return a
+        len_a = len(self.keywords[a][0])
+        len_b = len(self.keywords[b][0])
+        if len_a != len_b:
+            return a if len_a > len_b else b
+        return min(a, b)
+
+    def find_best(self, text):
+        """テキスト中で最も優先度の高いキーワードの (キーワード, 値) を返す（見つからなければ None）"""
+        goto = self.goto
+        fail = self.fail
+        best_state = self.best
+        state = 0
+        found = -1
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if best_state[state] >= 0:
+                found = self._prefer(found, best_state[state])
+        return self.keywords[found] if found >= 0 else None
+
+def load_icon_keywords(path):
+    """
+    キーワードファイルを読み込み、(キーワード, 絵文字) のリストを返す
+    1行に「キーワード<タブ>絵文字」を書く（空行と # で始まる行は無視）
+    """
+    keywords = []
+    seen = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = line.split("\t")
+            if len(parts) != 2 or not parts[0].strip() or not parts[1].strip():
+                print(f"⚠️ キーワードファイル {path} の{line_number}行目を読み飛ばします: {line}")
+                continue
+            keyword, emoji = parts[0].strip(), parts[1].strip()
+            if keyword in seen:
+                print(f"⚠️ キーワード「{keyword}」が{seen[keyword]}行目と{line_number}行目で重複しています（{line_number}行目を使用）")
+                keywords = [entry for entry in keywords if entry[0] != keyword]
+            seen[keyword] = line_number
+            keywords.append((keyword, emoji))
+    return keywords
+
+def build_icon_keywords(path=None):
+    """組み込みのキーワード表に、キーワードファイルの内容を追加・上書きした表を返す"""
+    if not path:
+        return list(DEFAULT_ICON_KEYWORDS)
+    custom = load_icon_keywords(path)
+    custom_keywords = {keyword for keyword, _ in custom}
+    # ファイルで指定したキーワードを優先し、組み込みの表の同じキーワードは置き換える
+    return custom + [entry for entry in DEFAULT_ICON_KEYWORDS if entry[0] not in custom_keywords]
+
+def get_icon_matcher():
+    """キーワード照合器を返す（初回呼び出し時に一度だけ構築する）"""
+    global ICON_MATCHER
+    if ICON_MATCHER is None:
+        with ICON_MATCHER_LOCK:
+            if ICON_MATCHER is None:
+                ICON_MATCHER = KeywordMatcher(build_icon_keywords(ICON_KEYWORDS_FILE))
+    return ICON_MATCHER
+
 def predict_icon_from_content(content, title):
     """本文の内容からNotionページのアイコン（絵文字）を推測する"""
-    # キーワードと対応する絵文字のマッピング
-    keyword_to_emoji = {
-        # 朝勉関連
-        "朝勉": "🌅",
-        "勉強": "📚",
-        "学習": "📝",
-        "勤続": "🔄",
-        "早起き": "🌄",
-        "朝活": "☀️",
-
-        # 時間関連
-        "時間": "⏰",
-        "スケジュール": "📅",
-        "予定": "📆",
-        "締め切り": "⏳",
-        "期限": "⌛",
-
-        # 感情関連
-        "嬉しい": "😊",
-        "楽しい": "😄",
-        "悲しい": "😢",
-        "辛い": "😣",
-        "疲れ": "😩",
-        "頑張": "💪",
-        "がんば": "💪",
-
-        # 場所関連
-        "家": "🏠",
-        "実家": "🏡",
-        "学校": "🏫",
-        "会社": "🏢",
-        "オフィス": "🏢",
-        "カフェ": "☕",
-
-        # 食事関連
-        "食事": "🍽️",
-        "朝食": "🍳",
-        "昼食": "🍱",
-        "夕食": "🍲",
-        "晩ごはん": "🍲",
-        "コーヒー": "☕",
-        "お茶": "🍵",
-
-        # 天気関連
-        "晴れ": "☀️",
-        "雨": "🌧️",
-        "雪": "❄️",
-        "曇り": "☁️",
-        "台風": "🌀",
-        "寒い": "🥶",
-        "暑い": "🥵",
-
-        # 季節関連
-        "春": "🌸",
-        "夏": "🌞",
-        "秋": "🍂",
-        "冬": "⛄",
-        "年末": "🎍",
-        "年始": "🎍",
-        "正月": "🎍",
-
-        # イベント関連
-        "誕生日": "🎂",
-        "クリスマス": "🎄",
-        "ハロウィン": "🎃",
-        "旅行": "✈️",
-        "旅": "🧳",
-        "休暇": "🏖️",
-        "休日": "🛌",
-
-        # 仕事関連
-        "仕事": "💼",
-        "会議": "🗣️",
-        "プレゼン": "📊",
-        "資料": "📑",
-        "メール": "📧",
-        "電話": "📞",
-
-        # 健康関連
-        "健康": "🏥",
-        "運動": "🏃",
-        "ジム": "🏋️",
-        "ヨガ": "🧘",
-        "散歩": "🚶",
-        "睡眠": "😴",
-
-        # 趣味関連
-        "読書": "📖",
-        "映画": "🎬",
-        "音楽": "🎵",
-        "ゲーム": "🎮",
-        "料理": "👨‍🍳",
-        "写真": "📷",
-        "絵": "🎨",
-
-        # 交通関連
-        "電車": "🚆",
-        "バス": "🚌",
-        "車": "🚗",
-        "自転車": "🚲",
-        "飛行機": "✈️",
-        "通勤": "🚶",
-
-        # コミュニケーション関連
-        "友達": "👫",
-        "家族": "👨‍👩‍👧‍👦",
-        "恋人": "💑",
-        "会話": "💬",
-        "電話": "📱",
-        "メッセージ": "💌",
-
-        # テクノロジー関連
-        "パソコン": "💻",
-        "スマホ": "📱",
-        "アプリ": "📲",
-        "インターネット": "🌐",
-        "SNS": "📱",
-        "プログラミング": "👨‍💻",
-
-        # その他
-        "アイデア": "💡",
-        "メモ": "📝",
-        "計画": "📋",
-        "目標": "🎯",
-        "成功": "🏆",
-        "失敗": "😓",
-        "質問": "❓",
-        "答え": "❗",
-        "重要": "⚠️",
-        "緊急": "🚨",
-        "お金": "💰",
-        "買い物": "🛒",
-        "プレゼント": "🎁",
-        "音楽": "🎵",
-        "スポーツ": "⚽",
-        "ニュース": "📰",
-
-        # 追加キーワード（より多様なアイコンを提供）
-        "考え": "🤔",
-        "思考": "💭",
-        "発見": "🔍",
-        "気づき": "💫",
-        "成長": "📈",
-        "変化": "🔄",
-        "挑戦": "🏔️",
-        "達成": "🏅",
-        "反省": "🔄",
-        "振り返り": "🔙",
-        "未来": "🔮",
-        "希望": "✨",
-        "夢": "💫",
-        "願い": "🙏",
-        "感謝": "🙏",
-        "喜び": "🎊",
-        "驚き": "😲",
-        "焦り": "💦",
-        "不安": "😰",
-        "心配": "😟",
-        "安心": "😌",
-        "リラックス": "🧘",
-        "集中": "🎯",
-        "忙しい": "⏰",
-        "余裕": "😎",
-        "自信": "💪",
-        "迷い": "🤷",
-        "決断": "✅",
-        "選択": "🔀",
-        "整理": "🗂️",
-        "片付け": "🧹",
-        "掃除": "🧼",
-        "準備": "🔧",
-        "始まり": "🎬",
-        "終わり": "🏁",
-        "継続": "🔁",
-        "習慣": "📆",
-        "ルーティン": "🔄",
-        "改善": "📈",
-        "工夫": "🛠️",
-        "創造": "🎨",
-        "発明": "💡",
-        "実験": "🧪",
-        "分析": "📊",
-        "調査": "🔎",
-        "研究": "🔬",
-        "学び": "🎓",
-        "教育": "👨‍🏫",
-        "指導": "👨‍🏫",
-        "相談": "💬",
-        "アドバイス": "💡",
-        "協力": "🤝",
-        "チーム": "👥",
-        "グループ": "👪",
-        "コミュニティ": "🏘️",
-        "社会": "🌐",
-        "世界": "🌍",
-        "自然": "🌳",
-        "環境": "🌱",
-        "動物": "🐾",
-        "植物": "🌿",
-        "花": "🌸",
-        "海": "🌊",
-        "山": "⛰️",
-        "川": "🏞️",
-        "空": "☁️",
-        "星": "⭐",
-        "月": "🌙",
-        "太陽": "☀️",
-        "朝": "🌅",
-        "昼": "🌞",
-        "夕方": "🌇",
-        "夜": "🌃",
-        "深夜": "🌌",
-        "睡眠": "💤",
-        "夢": "💭",
-        "瞑想": "🧘",
-        "ヨガ": "🧘‍♀️",
-        "ストレッチ": "🤸",
-        "ウォーキング": "🚶",
-        "ランニング": "🏃",
-        "トレーニング": "🏋️",
-        "スポーツ": "🏅",
-        "サッカー": "⚽",
-        "野球": "⚾",
-        "テニス": "🎾",
-        "バスケ": "🏀",
-        "水泳": "🏊",
-        "ゴルフ": "⛳",
-        "釣り": "🎣",
-        "キャンプ": "⛺",
-        "ハイキング": "🥾",
-        "登山": "🧗",
-        "サイクリング": "🚴",
-        "ドライブ": "🚗",
-        "旅": "🧳",
-        "観光": "🗿",
-        "美術館": "🏛️",
-        "博物館": "🏛️",
-        "映画館": "🎦",
-        "劇場": "🎭",
-        "コンサート": "🎵",
-        "ライブ": "🎤",
-        "フェス": "🎪",
-        "パーティー": "🎉",
-        "お祝い": "🎊",
-        "記念日": "🎂",
-        "結婚": "💒",
-        "出産": "👶",
-        "育児": "👨‍👩‍👧",
-        "子育て": "👨‍👩‍👧",
-        "教育": "🏫",
-        "学校": "🏫",
-        "大学": "🎓",
-        "卒業": "🎓",
-        "就職": "💼",
-        "転職": "🔄",
-        "昇進": "📈",
-        "退職": "🚪",
-        "老後": "👴",
-        "人生": "🌈",
-    }
-
     # 本文の冒頭160文字を抽出（画像タグを除去）
-    clean_content = re.sub(r"!\[(?:[^\]]*)\]\((?:Files/)?([^)]+)\)", "", content).strip()
+    clean_content = IMAGE_PATTERN.sub("", content).strip()
 
     # ハッシュタグを除去
-    clean_content = re.sub(r"#\S+", "", clean_content)
+    clean_content = HASHTAG_PATTERN.sub("", clean_content)
 
     # "朝勉勤続〜日目"のパターンを除去
-    clean_content = re.sub(r"朝勉勤続\d+日目[。]?", "", clean_content)
+    clean_content = STREAK_PATTERN.sub("", clean_content)
 
     # 冒頭160文字を取得
     intro_content = clean_content[:160]
@@ -645,20 +2833,14 @@ def predict_icon_from_content(content, title):
     print(f"🔍 アイコン推測用テキスト: {intro_content[:30]}...")
 
     # 本文からキーワードを検索（優先度高）
-    found_emojis = []
-    for keyword, emoji in keyword_to_emoji.items():
-        if keyword in intro_content:
-            found_emojis.append((keyword, emoji))
-
-    # 見つかったキーワードがあれば、最初のものを使用
-    if found_emojis:
-        # 最長のキーワードを優先（より具体的な内容を反映）
-        found_emojis.sort(key=lambda x: len(x[0]), reverse=True)
-        print(f"✅ キーワード「{found_emojis[0][0]}」に基づくアイコン: {found_emojis[0][1]}")
-        return found_emojis[0][1]
+    # 最長のキーワードを優先（より具体的な内容を反映）
+    found = get_icon_matcher().find_best(intro_content)
+    if found:
+        print(f"✅ キーワード「{found[0]}」に基づくアイコン: {found[1]}")
+        return found[1]
 
     # 本文からキーワードが見つからない場合、日付パターンを検出（優先度低）
-    day_match = re.search(r'(\d+)日目', title)
+    day_match = DAY_NUMBER_PATTERN.search(title)
     if day_match:
         day_num = int(day_match.group(1))
         # 100日ごとに特別な絵文字を使用
@@ -677,33 +2859,151 @@ def predict_icon_from_content(content, title):
     # デフォルトのアイコン
     return "📝"  # デフォルトは「メモ」の絵文字
 
+# ------------- マークダウンをトークンに分割する関数 -------------
+# 正規表現はモジュール読み込み時に一度だけコンパイルする
+YAML_HEADER_PATTERN = re.compile(r"^---\s*\n(.*?)\n---\s*\n", re.DOTALL)
+CREATED_PATTERN = re.compile(r"created:\s*([\d-]+\s[\d:]+)")
+UPDATED_PATTERN = re.compile(r"date:\s*([\d-]+\s[\d:]+)")
+IMAGE_PATTERN = re.compile(r"!\[(?:[^\]]*)\]\((?:Files/)?([^)]+)\)")
+TITLE_PATTERN = re.compile(r"(朝勉勤続\d+日目[。]?)")
+# YAMLヘッダーの「categories:」（「- 値」の行が続くか、同じ行に [a, b] や値を書く）
+CATEGORIES_PATTERN = re.compile(r"^categories:[ \t]*(.*)\n?((?:[ \t]*-[ \t]*.*(?:\n|$))*)", re.MULTILINE)
+# 本文のハッシュタグ（見出しの「# 」やURL中の「#」は含めない）
+NOTE_TAG_PATTERN = re.compile(r"(?<![\w#/&])#([^\s#\[\]()<>]+)")
+NOTE_TAG_TRAILING_PUNCTUATION = "。、，,.!！?？:：;；"
+# 罫線として扱う行（「---」「\---」など）
+HORIZONTAL_LINE_PATTERN = re.compile(r"-{2,}|\\-{2,}")
+DASH_LINE_PATTERN = re.compile(r"-{2,}")
+# 見出し・リスト・番号付きリスト・引用・コードブロックを1回の照合で判定する
+BLOCK_LINE_PATTERN = re.compile(
+    r"(?:(?P<heading>#{1,3})\s+(?P<heading_text>.+)"
+    r"|[-*]\s+(?P<bulleted_list_item>.+)"
+    r"|\d+\.\s+(?P<numbered_list_item>.+)"
+    r"|>\s+(?P<quote>.+)"
+    r"|(?P<code>```.*))$"
+)
+BOLD_PATTERN = re.compile(r"\*\*(.*?)\*\*")
+
+HORIZONTAL_LINE_MARKER = "<HORIZONTAL_LINE>"
+EMPTY_BLOCK_MARKER = "<EMPTY_BLOCK>"
+
+def tokenize_markdown(body):
+    """
+    画像タグを除いた本文を1回の走査で (種類, テキスト) のトークン列に変換する
+    種類: divider / empty / heading_1〜3 / bulleted_list_item / numbered_list_item / quote / code / paragraph
+    空行と<br>は empty になり、連続する empty は1つにまとめる
+    """
+    tokens = []
+    prev_empty = False
+
+    for line in body.split("\n"):
+        # 罫線（「\--」や「---」などのパターンに対応）
+        if line[:1] in ("-", "\\") and HORIZONTAL_LINE_PATTERN.fullmatch(line):
+            line = HORIZONTAL_LINE_MARKER
+        else:
+            # <br>タグを空のブロックに変換
+            line = line.replace("<br>", EMPTY_BLOCK_MARKER)
+
+        # 空の段落（連続する空のブロックは2つ以上続かないようにする）
+        if line == EMPTY_BLOCK_MARKER or not line.strip():
+            if not prev_empty:
+                tokens.append(("empty", ""))
+                prev_empty = True
+            continue
+        prev_empty = False
+
+        # "--"や"---"などの罫線表現を区切り線に変換
+        stripped = line.strip()
+        if (line == HORIZONTAL_LINE_MARKER or stripped == "\\--" or
+                (stripped[:1] == "-" and DASH_LINE_PATTERN.fullmatch(stripped))):
+            tokens.append(("divider", ""))
+            continue
+
+        match = BLOCK_LINE_PATTERN.match(line)
+        if not match:
+            tokens.append(("paragraph", line))
+        elif match.group("heading"):
+            tokens.append((f"heading_{len(match.group('heading'))}", match.group("heading_text")))
+        elif match.group("code") is not None:
+            tokens.append(("code", line.replace("```", "")))
+        else:
+            kind = match.lastgroup
+            tokens.append((kind, match.group(kind)))
+
+    return tokens
+
 # ------------- Markdownファイルを解析する関数 -------------
-def parse_markdown(file_path):
+def parse_categories(yaml_content):
+    """YAMLヘッダーの categories をリストで返す（リスト形式と1行形式のどちらにも対応）"""
+    match = CATEGORIES_PATTERN.search(yaml_content)
+    if not match:
+        return []
+    inline = match.group(1).strip()
+    if inline:
+        values = inline.strip("[]").split(",")
+    else:
+        values = [line.strip()[1:] for line in match.group(2).splitlines() if line.strip()]
+    categories = []
+    for value in values:
+        value = value.strip().strip("'\"")
+        if value and value not in categories:
+            categories.append(value)
+    return categories
+
+def extract_hashtags(body):
+    """本文のハッシュタグを出現順に重複なく返す（先頭の # は除く）"""
+    tags = []
+    for match in NOTE_TAG_PATTERN.finditer(body):
+        tag = match.group(1).rstrip(NOTE_TAG_TRAILING_PUNCTUATION)
+        if tag and tag not in tags:
+            tags.append(tag)
+    return tags
+
+def parse_markdown(file_path, content=None):
+    """
+    マークダウンファイルを解析してノートの情報を返す
+    content: 読み込み済みのファイル内容（省略時はファイルから読み込む）
+    解析に失敗した場合は例外を送出する
+    """
     try:
         print(f"🔍 {file_path} の解析開始…")
 
-        with open(file_path, "r", encoding="utf-8") as file:
-            content = file.read()
+        if content is None:
+            with METRICS.timer("read"):
+                with open(file_path, "r", encoding="utf-8") as file:
+                    content = file.read()
+
+        header_start = time.perf_counter()
 
         # YAMLヘッダーを削除（より堅牢な方法）
-        yaml_match = re.match(r"^---\s*\n(.*?)\n---\s*\n", content, re.DOTALL)
+        yaml_match = YAML_HEADER_PATTERN.match(content)
         yaml_content = yaml_match.group(1) if yaml_match else ""
         if yaml_match:
             content = content[yaml_match.end():].strip()
             print("✅ YAMLヘッダーを検出して削除しました")
 
         # `created:` または `date:` のどちらかを取得（YAMLヘッダーからも検索）
-        created_match = re.search(r"created:\s*([\d-]+\s[\d:]+)", content + "\n" + yaml_content)
-        updated_match = re.search(r"date:\s*([\d-]+\s[\d:]+)", content + "\n" + yaml_content)
+        header_search_text = content + "\n" + yaml_content
+        created_match = CREATED_PATTERN.search(header_search_text)
+        updated_match = UPDATED_PATTERN.search(header_search_text)
 
         created = format_date(created_match.group(1)) if created_match else datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
         updated = format_date(updated_match.group(1)) if updated_match else created
 
         print(f"📅 作成日: {created}, 更新日: {updated}")
+        METRICS.add_time("parse_header", time.perf_counter() - header_start)
 
-        # 画像を抽出（より堅牢な正規表現）
-        image_matches = re.findall(r"!\[(?:[^\]]*)\]\((?:Files/)?([^)]+)\)", content)
-        image_filenames = [img for img in image_matches if img]
+        body_start = time.perf_counter()
+
+        # 画像の抽出と本文からの除去を1回の走査で行う
+        image_filenames = []
+        body_parts = []
+        last_end = 0
+        for image_match in IMAGE_PATTERN.finditer(content):
+            image_filenames.append(image_match.group(1))
+            body_parts.append(content[last_end:image_match.start()])
+            last_end = image_match.end()
+        body_parts.append(content[last_end:])
 
         # 最初の画像をカバー画像として使用
         cover_image = image_filenames[0] if image_filenames else None
@@ -712,43 +3012,12 @@ def parse_markdown(file_path):
         if cover_image:
             print(f"🖼 カバー画像: {cover_image}")
 
-        # 本文から画像タグを削除し、適切なブロック変換
-        clean_body = re.sub(r"!\[(?:[^\]]*)\]\((?:Files/)?([^)]+)\)", "", content).strip()
-
-        # 罫線を `divider` に変換（「\--」や「---」などのパターンに対応）
-        clean_body = re.sub(r"\n-{2,}\n", "\n<HORIZONTAL_LINE>\n", clean_body)
-
-        # 行頭の「\--」や「---」も区切り線に変換
-        clean_body = re.sub(r"^-{2,}$", "<HORIZONTAL_LINE>", clean_body, flags=re.MULTILINE)
-        clean_body = re.sub(r"^\\-{2,}$", "<HORIZONTAL_LINE>", clean_body, flags=re.MULTILINE)
-
-        # <br>タグを空のブロックに変換
-        clean_body = re.sub(r"<br>", "<EMPTY_BLOCK>", clean_body)
-
-        # 段落に分割
-        paragraphs = []
-        for p in clean_body.split("\n"):
-            if p.strip():
-                # 空でない段落を追加
-                paragraphs.append(p)
-            else:
-                # 空の段落は<EMPTY_BLOCK>として追加
-                paragraphs.append("<EMPTY_BLOCK>")
-
-        # 連続する空のブロックを削除（2つ以上連続しないように）
-        filtered_paragraphs = []
-        prev_empty = False
-        for p in paragraphs:
-            if p == "<EMPTY_BLOCK>":
-                if not prev_empty:
-                    filtered_paragraphs.append(p)
-                    prev_empty = True
-            else:
-                filtered_paragraphs.append(p)
-                prev_empty = False
+        # 画像タグを除いた本文を行ごとにトークンへ変換
+        clean_body = "".join(body_parts).strip()
+        tokens = tokenize_markdown(clean_body)
 
         # タイトルを「朝勉勤続〇〇日目」のみ抽出
-        title_match = re.search(r"(朝勉勤続\d+日目[。]?)", content)
+        title_match = TITLE_PATTERN.search(content)
         if title_match:
             title = title_match.group(1)
             # タイトルの末尾の句点「。」を削除
@@ -762,8 +3031,17 @@ def parse_markdown(file_path):
             # タイトルの末尾の句点「。」を削除
             title = title.rstrip("。")
 
+        # カテゴリー（YAMLヘッダー）とハッシュタグ（本文）はアップロード先の振り分けに使う
+        categories = parse_categories(yaml_content)
+        tags = extract_hashtags(clean_body)
+
+        METRICS.add_time("parse_body", time.perf_counter() - body_start)
+
         # 本文からアイコンを推測
-        icon = predict_icon_from_content(content, title) if USE_ICON else None
+        icon = None
+        if USE_ICON:
+            with METRICS.timer("icon"):
+                icon = predict_icon_from_content(content, title)
         if icon:
             print(f"🔮 推測されたアイコン: {icon}")
 
@@ -771,244 +3049,1098 @@ def parse_markdown(file_path):
             "title": title,
             "created": created,
             "updated": updated,
-            "paragraphs": filtered_paragraphs,
+            "tokens": tokens,
             "images": image_filenames,
             "cover_image": cover_image,
-            "icon": icon
+            "icon": icon,
+            "categories": categories,
+            "tags": tags
         }
 
     except Exception as e:
         print(f"❌ エラー: {file_path} の解析に失敗しました。 {e}")
-        sys.exit(1)
+        raise
 
 # ------------- マークダウンをNotionブロックに変換する関数 -------------
-def convert_markdown_to_notion_blocks(paragraphs):
-    """マークダウンテキストをNotionブロックに変換する"""
+NOTION_MAX_TEXT_LENGTH = 2000  # rich text 1要素あたりの文字数の上限（UTF-16換算）
+NOTION_MAX_RICH_TEXT_ITEMS = 100  # 1ブロックあたりの rich text 要素数の上限
+NOTION_MAX_CHILDREN = 100  # 1リクエストで追加できる子ブロックの上限
+
+def split_text(text, limit=NOTION_MAX_TEXT_LENGTH):
+    """テキストを Notion の文字数上限を超えない長さに分割する（サロゲートペアは2文字として数える）"""
+    # 全文字がサロゲートペアでも上限に収まる長さなら分割不要
+    if len(text) * 2 <= limit:
+        return [text]
+
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + limit
+        chunk = text[start:end]
+        overflow = len(chunk.encode("utf-16-le")) // 2 - limit
+        while overflow > 0:
+            # 1文字は1〜2単位なので、超過分の半分ずつ削って上限ぎりぎりに合わせる
+            end -= (overflow + 1) // 2
+            chunk = text[start:end]
+            overflow = len(chunk.encode("utf-16-le")) // 2 - limit
+        chunks.append(chunk)
+        start = end
+    return chunks
+
+def utf16_length(text):
+    """Notion の文字数（UTF-16換算、サロゲートペアは2文字）を返す"""
+    return len(text.encode("utf-16-le")) // 2
+
+def coalesce_paragraphs(tokens, limit=NOTION_MAX_TEXT_LENGTH):
+    """
+    連続する通常の段落（間の空行1つを含む）を、改行を含む1つの段落にまとめる
+    UpNote の行末の空白2つによる改行や <br> が1行ずつ別のブロックになり、ブロック数とリクエストが増えるのを防ぐ
+    見出し・リスト・引用・区切り線・コードはまとめない。まとめた段落は rich text 1要素の上限（limit）に収める
+    """
+    merged = []
+    lines = None  # まとめている段落の行（まとめる段落がなければ None）
+    length = 0  # まとめている段落の文字数（UTF-16換算）
+    pending_empty = False  # 段落の後の空行（次の段落をまとめるときは段落に取り込む）
+
+    def flush_paragraph():
+        # 行末の空白2つ（Markdown の改行の印）は、まとめた段落では改行文字に置き換わるため除く
+        merged.append(("paragraph", "\n".join(line.rstrip() for line in lines) if len(lines) > 1 else lines[0]))
+        if pending_empty:
+            merged.append(("empty", ""))
+
+    for kind, text in tokens:
+        if kind == "paragraph":
+            size = utf16_length(text)
+            gap = 2 if pending_empty else 1
+            if lines is not None and length + gap + size <= limit:
+                if pending_empty:
+                    lines.append("")
+                lines.append(text)
+                length += gap + size
+            else:
+                if lines is not None:
+                    flush_paragraph()
+                lines = [text]
+                length = size
+            pending_empty = False
+        elif kind == "empty" and lines is not None and not pending_empty:
+            pending_empty = True
+        else:
+            if lines is not None:
+                flush_paragraph()
+                lines = None
+                pending_empty = False
+            merged.append((kind, text))
+
+    if lines is not None:
+        flush_paragraph()
+    return merged
+
+def rich_text_items(content, annotations=None):
+    """テキストを rich text の要素に変換する（上限を超える長さは複数の要素に分ける）"""
+    items = []
+    for chunk in split_text(content):
+        item = {"text": {"content": chunk}}
+        if annotations:
+            item["annotations"] = annotations
+        items.append(item)
+    return items
+
+def append_text_block(blocks, kind, rich_text, extra=None):
+    """rich text を持つブロックを追加する（要素数が上限を超える場合は同じ種類のブロックに分ける）"""
+    for start in range(0, max(len(rich_text), 1), NOTION_MAX_RICH_TEXT_ITEMS):
+        content = {"rich_text": rich_text[start:start + NOTION_MAX_RICH_TEXT_ITEMS]}
+        if extra:
+            content.update(extra)
+        blocks.append({
+            "object": "block",
+            "type": kind,
+            kind: content
+        })
+
+def convert_markdown_to_notion_blocks(tokens):
+    """tokenize_markdown が返したトークンをNotionブロックに変換する（連続する段落は1つのブロックにまとめる）"""
     blocks = []
 
-    for paragraph in paragraphs:
-        if paragraph == "<HORIZONTAL_LINE>":
+    for kind, text in coalesce_paragraphs(tokens):
+        if kind == "divider":
             blocks.append({"object": "block", "type": "divider", "divider": {}})
-        elif paragraph == "<EMPTY_BLOCK>":
+        elif kind == "empty":
             blocks.append({"object": "block", "type": "paragraph", "paragraph": {"rich_text": []}})
-        # "--"や"---"などの罫線表現を区切り線に変換
-        elif paragraph.strip() == "\\--" or paragraph.strip() == "--" or re.match(r"^-{2,}$", paragraph.strip()):
-            blocks.append({"object": "block", "type": "divider", "divider": {}})
+        # コードブロック（```）の処理
+        elif kind == "code":
+            # コードブロックの開始行を検出した場合は、次の```までを一つのブロックとして処理
+            # 実際の実装では複数行の処理が必要になりますが、ここでは簡略化
+            append_text_block(blocks, "code", rich_text_items(text), {"language": "plain_text"})
+        # 通常の段落
+        elif kind == "paragraph":
+            # 太字（**text**）の処理
+            rich_text = []
+            last_end = 0
+            for match in BOLD_PATTERN.finditer(text):
+                # 太字の前のテキスト
+                if match.start() > last_end:
+                    rich_text.extend(rich_text_items(text[last_end:match.start()]))
+
+                # 太字のテキスト
+                rich_text.extend(rich_text_items(match.group(1), {"bold": True}))
+
+                last_end = match.end()
+
+            if not rich_text:
+                # 太字がない場合は、テキスト全体を1つのブロックとして追加
+                rich_text = rich_text_items(text)
+            elif last_end < len(text):
+                # 最後の太字の後のテキスト
+                rich_text.extend(rich_text_items(text[last_end:]))
+
+            append_text_block(blocks, "paragraph", rich_text)
+        # 見出し・リスト・引用はトークンの種類がそのままブロックの種類になる
         else:
-            # 見出し（#）の処理
-            heading_match = re.match(r'^(#{1,3})\s+(.+)$', paragraph)
-            if heading_match:
-                level = len(heading_match.group(1))
-                text = heading_match.group(2)
-
-                if level == 1:
-                    blocks.append({
-                        "object": "block",
-                        "type": "heading_1",
-                        "heading_1": {"rich_text": [{"text": {"content": text}}]}
-                    })
-                elif level == 2:
-                    blocks.append({
-                        "object": "block",
-                        "type": "heading_2",
-                        "heading_2": {"rich_text": [{"text": {"content": text}}]}
-                    })
-                elif level == 3:
-                    blocks.append({
-                        "object": "block",
-                        "type": "heading_3",
-                        "heading_3": {"rich_text": [{"text": {"content": text}}]}
-                    })
-            # リスト項目（- または *）の処理
-            elif re.match(r'^[-*]\s+(.+)$', paragraph):
-                text = re.match(r'^[-*]\s+(.+)$', paragraph).group(1)
-                blocks.append({
-                    "object": "block",
-                    "type": "bulleted_list_item",
-                    "bulleted_list_item": {"rich_text": [{"text": {"content": text}}]}
-                })
-            # 番号付きリスト（1. 2. など）の処理
-            elif re.match(r'^\d+\.\s+(.+)$', paragraph):
-                text = re.match(r'^\d+\.\s+(.+)$', paragraph).group(1)
-                blocks.append({
-                    "object": "block",
-                    "type": "numbered_list_item",
-                    "numbered_list_item": {"rich_text": [{"text": {"content": text}}]}
-                })
-            # 引用（>）の処理
-            elif re.match(r'^>\s+(.+)$', paragraph):
-                text = re.match(r'^>\s+(.+)$', paragraph).group(1)
-                blocks.append({
-                    "object": "block",
-                    "type": "quote",
-                    "quote": {"rich_text": [{"text": {"content": text}}]}
-                })
-            # コードブロック（```）の処理
-            elif re.match(r'^```(.*)$', paragraph):
-                # コードブロックの開始行を検出した場合は、次の```までを一つのブロックとして処理
-                # 実際の実装では複数行の処理が必要になりますが、ここでは簡略化
-                blocks.append({
-                    "object": "block",
-                    "type": "code",
-                    "code": {
-                        "rich_text": [{"text": {"content": paragraph.replace('```', '')}}],
-                        "language": "plain_text"
-                    }
-                })
-            # 通常の段落
-            else:
-                # 太字（**text**）の処理
-                text = paragraph
-                bold_matches = re.findall(r'\*\*(.*?)\*\*', text)
-                rich_text = []
-
-                if bold_matches:
-                    # 太字がある場合は、テキストを分割して適切なフォーマットを適用
-                    last_end = 0
-                    for match in re.finditer(r'\*\*(.*?)\*\*', text):
-                        # 太字の前のテキスト
-                        if match.start() > last_end:
-                            rich_text.append({"text": {"content": text[last_end:match.start()]}})
-
-                        # 太字のテキスト
-                        rich_text.append({
-                            "text": {"content": match.group(1)},
-                            "annotations": {"bold": True}
-                        })
-
-                        last_end = match.end()
-
-                    # 最後の太字の後のテキスト
-                    if last_end < len(text):
-                        rich_text.append({"text": {"content": text[last_end:]}})
-                else:
-                    # 太字がない場合は、テキスト全体を1つのブロックとして追加
-                    rich_text = [{"text": {"content": text}}]
-
-                blocks.append({
-                    "object": "block",
-                    "type": "paragraph",
-                    "paragraph": {"rich_text": rich_text}
-                })
+            append_text_block(blocks, kind, rich_text_items(text))
 
     return blocks
 
-# ------------- Notionにデータをアップロードする関数 -------------
-def upload_to_notion(note, max_retries=3, retry_delay=2):
+# ------------- Notion APIへリクエストを送る関数 -------------
+def send_notion_request(method, path, payload=None, description="リクエスト", files=None, policy=None):
     """
-    Notionにノートデータをアップロードする関数
-    max_retries: 最大リトライ回数
-    retry_delay: リトライ間の待機時間（秒）
+    Notion APIにリクエストを送り、リトライの方針（RetryPolicy）に従ってリトライする関数
+    description: ログに表示する処理内容（例: 「〇〇 の追加」）
+    files: multipart/form-data で送るファイル（ファイルアップロード用）
+    policy: リトライの方針（省略時は RETRY_POLICY）
+    成功した場合はレスポンスを、失敗した場合は None を返す
+    認証エラー（401/403）の場合は NotionAuthError を送出する（どのリクエストも成功しないため、呼び出し元で処理を止める）
     """
-    retries = 0
-    while retries <= max_retries:
+    policy = policy or RETRY_POLICY
+    # ボディはループの外で1回だけエンコードし、リトライでは同じバイト列を送り直す
+    if payload is not None and not isinstance(payload, bytes):
+        payload = encode_payload(payload)
+
+    attempt = 0
+    failure = None
+    while True:
+        # API が不調な間は、全ワーカーの送信をサーキットブレーカーで止める
+        if CIRCUIT_BREAKER:
+            CIRCUIT_BREAKER.wait()
+
+        delay = None
         try:
-            print(f"🚀 Notionへアップロード開始: {note['title']}")
-
-            # ページのプロパティを設定
-            new_page_data = {
-                "parent": {"database_id": DATABASE_ID},
-                "properties": {
-                    "タイトル": {"title": [{"text": {"content": note["title"]}}]},
-                    "作成日": {"date": {"start": note["created"]}},
-                    "更新日": {"date": {"start": note["updated"]}},
-                },
-                "children": []
+            response = NOTION_CLIENT.request(method, path, payload, files=files)
+        except requests.exceptions.RequestException as e:
+            print(f"❌ ネットワークエラー: {e}")
+            METRICS.increment("network_errors")
+            failure = (None, str(e))
+            if CIRCUIT_BREAKER:
+                CIRCUIT_BREAKER.record_failure()
+        except Exception as e:
+            print(f"❌ エラー: {description}に失敗しました。 {e}")
+            record_request_failure(description, None, str(e))
+            return None
+        else:
+            status = response.status_code
+            # 成功
+            if status == 200:
+                if RATE_LIMITER:
+                    RATE_LIMITER.on_success()
+                if CIRCUIT_BREAKER:
+                    CIRCUIT_BREAKER.record_success()
+                return response
+
+            # 認証エラーは APIキーや接続を直すまで解消しないため、リトライせずに処理全体を止める
+            if status in policy.AUTH_STATUSES:
+                raise NotionAuthError(f"{description}で認証エラー（{status}）が発生しました。"
+                                      "APIキーと、データベースにインテグレーションを接続しているか確認してください。")
+
+            failure = (status, response.text)
+            # レート制限対応（共有リミッターで全ワーカーの送信を止める）
+            if status == 429:
+                retry_after = parse_retry_after(response.headers.get("Retry-After"), policy.backoff(attempt + 1))
+                print(f"⚠️ レート制限に達しました。{retry_after:g}秒後にリトライします...")
+                METRICS.increment("rate_limited")
+                if RATE_LIMITER:
+                    RATE_LIMITER.on_rate_limited(retry_after)
+                    delay = 0
+                else:
+                    delay = retry_after
+            # その他のエラー
+            else:
+                print(f"❌ {description}に失敗: {status}")
+                print(response.text)
+                if CIRCUIT_BREAKER:
+                    # 5xx は API の不調として数え、4xx は API 自体は応答しているとみなす
+                    if status >= 500:
+                        CIRCUIT_BREAKER.record_failure()
+                    else:
+                        CIRCUIT_BREAKER.record_success()
+                if not policy.should_retry(status):
+                    # 400（検証エラー）などは同じリクエストを送り直しても結果が変わらない
+                    print(f"❌ {status} はリクエストの内容によるエラーのため、リトライしません。")
+                    METRICS.increment("not_retried")
+                    record_request_failure(description, *failure)
+                    return None
+
+        attempt += 1
+        if attempt > policy.max_retries:
+            print(f"❌ 最大リトライ回数({policy.max_retries}回)に達しました。処理を中止します。")
+            record_request_failure(description, *failure)
+            return None
+        if delay is None:
+            delay = policy.backoff(attempt)
+            print(f"⚠️ {attempt}/{policy.max_retries}回目のリトライを{delay:.1f}秒後に行います...")
+        METRICS.increment("retries")
+        if delay > 0:
+            with METRICS.timer("retry_sleep"):
+                time.sleep(delay)
+
+# ------------- ページの内容を組み立てる関数 -------------
+TITLE_PROPERTY_NAME = "タイトル"
+CREATED_PROPERTY_NAME = "作成日"
+UPDATED_PROPERTY_NAME = "更新日"
+
+def build_page_properties(note):
+    """
+    ノートからページのプロパティ・アイコン・カバー画像を組み立てる（作成と更新で共通）
+    スキーマを確認済みのデータベースでは、プロパティをプロパティIDで指定する
+    """
+    page_data = {
+        "properties": {
+            TITLE_PROPERTY_NAME: {"title": [{"text": {"content": note["title"]}}]},
+            CREATED_PROPERTY_NAME: {"date": {"start": note["created"]}},
+            UPDATED_PROPERTY_NAME: {"date": {"start": note["updated"]}},
+        }
+    }
+
+    # 振り分けのルールで指定されたマルチセレクトのプロパティ（ハッシュタグ・カテゴリー）
+    if note.get("route"):
+        page_data["properties"].update(note["route"]["properties"])
+
+    # アイコンを設定
+    if note["icon"] and USE_ICON:
+        page_data["icon"] = {
+            "type": "emoji",
+            "emoji": note["icon"]
+        }
+
+    # 画像がある場合の処理（Notionにアップロード済みの画像はファイルアップロードIDで参照する）
+    if note["images"]:
+        uploads = note.get("image_uploads")
+
+        # 画像プロパティを設定（すべての画像を含める）
+        if USE_IMAGE_PROPERTY:
+            image_files = []
+            for img in note["images"]:
+                image_file = {"name": img}
+                image_file.update(image_file_object(img, uploads))
+                image_files.append(image_file)
+
+            # Notionのデータベースに画像プロパティを設定
+            page_data["properties"][IMAGE_PROPERTY_NAME] = {
+                "files": image_files
             }
 
-            # アイコンを設定
-            if note["icon"] and USE_ICON:
-                new_page_data["icon"] = {
-                    "type": "emoji",
-                    "emoji": note["icon"]
-                }
+        # ページのカバー画像を設定（最初の画像のみ）
+        if USE_COVER_IMAGE and note["cover_image"]:
+            page_data["cover"] = {"type": "external"}
+            page_data["cover"].update(image_file_object(note["cover_image"], uploads, variant="cover"))
+
+    page_data["properties"] = property_keys(note_database_id(note), page_data["properties"])
+    return page_data
+
+def build_page_children(note):
+    """ノートの本文と画像からページの子ブロックを組み立てる"""
+    # マークダウンをNotionブロックに変換し、画像を本文内に追加
+    return convert_markdown_to_notion_blocks(note["tokens"]) + build_image_blocks(note)
+
+def build_image_blocks(note):
+    """ノートの画像を本文に挿入する画像ブロックを組み立てる"""
+    uploads = note.get("image_uploads")
+    return [{
+        "object": "block",
+        "type": "image",
+        "image": image_file_object(filename, uploads)
+    } for filename in note["images"]]
+
+def build_create_requests(note, children):
+    """
+    ページ作成のリクエスト（method・path・body の辞書）のリストを組み立てる
+    ページ作成時に送れる子ブロックは上限件数まで。残りは作成後に追記するリクエストにし、
+    path の {page_id} は作成されたページIDに置き換えて送る
+    """
+    new_page_data = {"parent": {"database_id": note_database_id(note)}}
+    new_page_data.update(build_page_properties(note))
+    new_page_data["children"] = children[:NOTION_MAX_CHILDREN]
+    page_requests = [{"method": "POST", "path": "/pages", "body": new_page_data}]
+    for start in range(NOTION_MAX_CHILDREN, len(children), NOTION_MAX_CHILDREN):
+        page_requests.append({"method": "PATCH", "path": "/blocks/{page_id}/children",
+                              "body": {"children": children[start:start + NOTION_MAX_CHILDREN]}})
+    return page_requests
+
+def block_fingerprint(block):
+    """
+    ブロックの内容から差分検出用の指紋（短いハッシュ）を作る
+    台帳に記録済みの指紋と一致させるため、JSONエンコーダーの設定によらず標準の json で作る
+    """
+    encoded = json.dumps(block, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+# ------------- リクエストの検証 -------------
+NOTION_MAX_PAYLOAD_BYTES = 500 * 1000  # 1リクエストのボディの上限
+NOTION_MAX_URL_LENGTH = 2000  # 外部ファイルのURLの文字数の上限
+NOTION_MAX_FILE_NAME_LENGTH = 100  # files プロパティのファイル名の文字数の上限
+NOTION_PROPERTY_TYPES = {"title", "rich_text", "number", "select", "multi_select", "status", "date",
+                         "people", "files", "checkbox", "url", "email", "phone_number", "relation"}
+ISO_DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:\d{2})?)?")
+
+def validate_rich_text(rich_text, where, problems):
+    """rich text の要素数と各要素の文字数（UTF-16換算）を確認する"""
+    if len(rich_text) > NOTION_MAX_RICH_TEXT_ITEMS:
+        problems.append(f"{where}: rich text の要素数が上限を超えています（{len(rich_text)} > {NOTION_MAX_RICH_TEXT_ITEMS}）")
+    for item in rich_text:
+        length = len(item.get("text", {}).get("content", "").encode("utf-16-le")) // 2
+        if length > NOTION_MAX_TEXT_LENGTH:
+            problems.append(f"{where}: テキストの文字数が上限を超えています（{length} > {NOTION_MAX_TEXT_LENGTH}）")
+
+def validate_file_object(file_object, where, problems):
+    """画像の参照（外部URLまたはファイルアップロードID）を確認する"""
+    if "external" in file_object:
+        url = file_object["external"].get("url") or ""
+        if not url.startswith(("http://", "https://")):
+            problems.append(f"{where}: 画像のURLが http(s) ではありません（{url}）")
+        elif len(url) > NOTION_MAX_URL_LENGTH:
+            problems.append(f"{where}: 画像のURLが{NOTION_MAX_URL_LENGTH}文字を超えています")
+    elif "file_upload" in file_object:
+        if not file_object["file_upload"].get("id"):
+            problems.append(f"{where}: ファイルアップロードIDがありません")
+    else:
+        problems.append(f"{where}: 画像の参照がありません")
+
+def validate_children(children, where, problems):
+    """子ブロックの件数と、各ブロックの内容を確認する"""
+    if len(children) > NOTION_MAX_CHILDREN:
+        problems.append(f"{where}: 子ブロックの件数が上限を超えています（{len(children)} > {NOTION_MAX_CHILDREN}）")
+    for number, block in enumerate(children, 1):
+        kind = block.get("type")
+        if not kind or not isinstance(block.get(kind), dict):
+            problems.append(f"{where}の{number}番目のブロック: 種類 {kind} の内容がありません")
+            continue
+        content = block[kind]
+        if "rich_text" in content:
+            validate_rich_text(content["rich_text"], f"{where}の{number}番目のブロック", problems)
+        if kind == "image":
+            validate_file_object(content, f"{where}の{number}番目のブロック", problems)
+
+def validate_properties(properties, problems):
+    """プロパティの型（値に含まれる型のキー）と、型ごとの値の形式を確認する"""
+    titles = 0
+    for name, value in properties.items():
+        kinds = [key for key in value if key in NOTION_PROPERTY_TYPES]
+        if len(kinds) != 1:
+            problems.append(f"プロパティ「{name}」: 型を判別できません（{', '.join(value) or '空'}）")
+            continue
+        kind = kinds[0]
+        if kind == "title":
+            titles += 1
+            validate_rich_text(value["title"], f"プロパティ「{name}」", problems)
+        elif kind == "rich_text":
+            validate_rich_text(value["rich_text"], f"プロパティ「{name}」", problems)
+        elif kind == "date":
+            start = (value["date"] or {}).get("start") or ""
+            if not ISO_DATE_PATTERN.fullmatch(start):
+                problems.append(f"プロパティ「{name}」: 日付が ISO 8601 形式ではありません（{start}）")
+        elif kind == "files":
+            for file_object in value["files"]:
+                if len(file_object.get("name") or "") > NOTION_MAX_FILE_NAME_LENGTH:
+                    problems.append(f"プロパティ「{name}」: ファイル名が{NOTION_MAX_FILE_NAME_LENGTH}文字を超えています（{file_object['name']}）")
+                validate_file_object(file_object, f"プロパティ「{name}」", problems)
+    if titles != 1:
+        problems.append(f"タイトルのプロパティが{titles}個あります（1個だけ必要です）")
+
+def validate_page_requests(page_requests):
+    """
+    組み立てたリクエストが Notion API の制限（ボディのサイズ・ブロック数・文字数・プロパティの型）に
+    収まっているかを確認し、問題点のリストを返す（問題がなければ空のリスト）
+    """
+    problems = []
+    for number, request in enumerate(page_requests, 1):
+        body = request["body"]
+        where = f"{number}件目のリクエスト"
+        size = len(encode_payload(body))
+        if size > NOTION_MAX_PAYLOAD_BYTES:
+            problems.append(f"{where}: ボディのサイズが上限を超えています（{size:,} > {NOTION_MAX_PAYLOAD_BYTES:,}バイト）")
+        if "children" in body:
+            validate_children(body["children"], where, problems)
+        if "properties" in body:
+            validate_properties(body["properties"], problems)
+        if body.get("icon") and not body["icon"].get("emoji"):
+            problems.append(f"{where}: アイコンの絵文字がありません")
+        if body.get("cover"):
+            validate_file_object(body["cover"], f"{where}のカバー画像", problems)
+    return problems
+
+# ------------- Notionにデータをアップロードする関数 -------------
+def upload_to_notion(note, children=None):
+    """
+    Notionにノートデータをアップロードする関数（リトライは RETRY_POLICY に従う）
+    children: 組み立て済みの子ブロック（省略時はノートから組み立てる）
+    成功した場合は作成されたページIDを、失敗した場合は False を返す
+    """
+    print(f"🚀 Notionへアップロード開始: {note['title']}")
 
-            # 画像がある場合の処理
-            if note["images"]:
-                # 最初の画像をカバー画像として使用
-                cover_url = generate_image_url(note["cover_image"]) if note["cover_image"] else None
-
-                # 画像プロパティを設定（すべての画像を含める）
-                if USE_IMAGE_PROPERTY:
-                    image_files = []
-                    for img in note["images"]:
-                        img_url = generate_image_url(img)
-                        image_files.append({
-                            "name": img,
-                            "external": {"url": img_url}
-                        })
-
-                    # Notionのデータベースに画像プロパティを設定
-                    new_page_data["properties"][IMAGE_PROPERTY_NAME] = {
-                        "files": image_files
-                    }
-
-                # ページのカバー画像を設定（最初の画像のみ）
-                if USE_COVER_IMAGE and cover_url:
-                    new_page_data["cover"] = {
-                        "type": "external",
-                        "external": {"url": cover_url}
-                    }
-
-            # マークダウンをNotionブロックに変換
-            blocks = convert_markdown_to_notion_blocks(note["paragraphs"])
-            new_page_data["children"] = blocks
-
-            # 画像を本文内に追加
-            for filename in note["images"]:
-                image_url = generate_image_url(filename)
-                new_page_data["children"].append({
-                    "object": "block",
-                    "type": "image",
-                    "image": {"external": {"url": image_url}}
-                })
-
-            response = requests.post(url, headers=headers, data=json.dumps(new_page_data), timeout=30)
-
-            # レート制限対応
-            if response.status_code == 429:
-                retry_after = int(response.headers.get('Retry-After', retry_delay))
-                print(f"⚠️ レート制限に達しました。{retry_after}秒後にリトライします...")
-                time.sleep(retry_after)
-                retries += 1
+    try:
+        if children is None:
+            children = build_page_children(note)
+        page_requests = build_create_requests(note, children)
+    except Exception as e:
+        print(f"❌ エラー: {note['title']} のアップロードに失敗しました。 {e}")
+        return False
+
+    return send_create_requests(page_requests, note["title"])
+
+def send_create_requests(page_requests, title):
+    """
+    build_create_requests で組み立てたリクエストを順に送り、ページを作成する
+    成功した場合は作成されたページIDを、失敗した場合は False を返す
+    """
+    response = send_notion_request("POST", "/pages", page_requests[0]["body"], f"{title} の追加")
+    if response is None:
+        return False
+    page_id = response.json()["id"]
+
+    remaining_requests = page_requests[1:]
+    if remaining_requests:
+        print(f"📎 残り{sum(len(request['body']['children']) for request in remaining_requests)}ブロックを追記します")
+        for request in remaining_requests:
+            try:
+                response = send_notion_request(request["method"], request["path"].format(page_id=page_id),
+                                               request["body"], f"{title} のブロック追加")
+            except NotionAuthError:
+                # 認証エラーでアップロード全体を中止する場合も、本文が欠けたページは残さない
+                archive_incomplete_page(page_id, title)
+                raise
+            if response is None:
+                archive_incomplete_page(page_id, title)
+                return False
+
+    print(f"✅ {title} をNotionに追加できたでござる！🎉")
+    return page_id
+
+def archive_incomplete_page(page_id, title):
+    """本文を最後まで追加できなかったページをアーカイブする（次回は最初から作り直す）"""
+    print(f"❌ {title} の本文を最後まで追加できなかったため、作成したページをアーカイブします")
+    try:
+        send_notion_request("PATCH", f"/pages/{page_id}", {"archived": True}, f"{title} のアーカイブ")
+    except NotionAuthError as e:
+        # 権限がなくアーカイブもできない場合は、残ったページを手で削除できるように知らせる
+        print(f"⚠️ {title} のページ（{page_id}）をアーカイブできませんでした: {e}")
+
+# ------------- 既存ページを差分同期する関数 -------------
+def list_child_block_ids(block_id, description):
+    """ブロック（ページ）直下の子ブロックIDを順番どおりにすべて取得する（失敗時は None）"""
+    block_ids = []
+    cursor = None
+    while True:
+        path = f"/blocks/{block_id}/children?page_size={NOTION_MAX_CHILDREN}"
+        if cursor:
+            path += f"&start_cursor={cursor}"
+        response = send_notion_request("GET", path, description=description)
+        if response is None:
+            return None
+        data = response.json()
+        block_ids.extend(block["id"] for block in data["results"])
+        if not data.get("has_more"):
+            return block_ids
+        cursor = data["next_cursor"]
+
+def append_child_blocks(block_id, children, after=None, description="ブロックの追加"):
+    """
+    子ブロックを上限件数ずつに分けて追加する
+    after: 指定した場合はそのブロックの直後に挿入する（省略時は末尾に追加）
+    成功した場合は True を返す
+    """
+    for start in range(0, len(children), NOTION_MAX_CHILDREN):
+        payload = {"children": children[start:start + NOTION_MAX_CHILDREN]}
+        if after:
+            payload["after"] = after
+        response = send_notion_request("PATCH", f"/blocks/{block_id}/children", payload, description)
+        if response is None:
+            return False
+        # 次のバッチは今回追加した最後のブロックの直後に挿入する
+        if after:
+            results = response.json().get("results") or []
+            if results:
+                after = results[-1]["id"]
+    return True
+
+def sync_note_to_notion(note, entry, children):
+    """
+    台帳に記録された既存ページをノートの内容で更新する関数
+    プロパティは PATCH で更新し、本文は前回の内容と比べて変わったブロックの範囲だけを置き換える
+    成功した場合はページIDを、失敗した場合は False を返す
+    """
+    page_id = entry["page_id"]
+    title = note["title"]
+    print(f"🔄 Notionのページを同期開始: {title}")
+
+    # プロパティ・アイコン・カバー画像を更新
+    if send_notion_request("PATCH", f"/pages/{page_id}", build_page_properties(note), f"{title} のプロパティ更新") is None:
+        return False
+
+    return sync_page_blocks(page_id, title, children, entry.get("blocks"))
+
+def sync_page_blocks(page_id, title, children, old_fingerprints):
+    """
+    ページの本文を前回の内容（old_fingerprints: 台帳に記録された本文ブロックの指紋）と比べ、
+    変わったブロックの範囲だけを置き換える。成功した場合はページIDを、失敗した場合は False を返す
+    """
+    new_fingerprints = [block_fingerprint(block) for block in children]
+    if old_fingerprints == new_fingerprints:
+        print(f"✅ {title} の本文に変更はありません（プロパティのみ更新）")
+        return page_id
+
+    block_ids = list_child_block_ids(page_id, f"{title} のブロック一覧の取得")
+    if block_ids is None:
+        return False
+
+    # 前後で一致するブロックは残し、間の範囲だけを置き換える
+    prefix = suffix = 0
+    if old_fingerprints is not None and len(old_fingerprints) == len(block_ids):
+        limit = min(len(old_fingerprints), len(new_fingerprints))
+        while prefix < limit and old_fingerprints[prefix] == new_fingerprints[prefix]:
+            prefix += 1
+        # 先頭への挿入は指定できないため、先頭が変わった場合は後方の一致も使わない
+        if prefix > 0:
+            while (suffix < limit - prefix and
+                   old_fingerprints[-1 - suffix] == new_fingerprints[-1 - suffix]):
+                suffix += 1
+    else:
+        print(f"⚠️ {title} は台帳の記録とページのブロック構成が一致しないため、本文をすべて置き換えます")
+
+    removed_ids = block_ids[prefix:len(block_ids) - suffix]
+    added_blocks = children[prefix:len(children) - suffix]
+    print(f"📝 本文の差分: {len(removed_ids)}ブロック削除, {len(added_blocks)}ブロック追加")
+
+    for removed_id in removed_ids:
+        if send_notion_request("DELETE", f"/blocks/{removed_id}", description=f"{title} のブロック削除") is None:
+            return False
+
+    if added_blocks:
+        after = block_ids[prefix - 1] if prefix > 0 and suffix > 0 else None
+        if not append_child_blocks(page_id, added_blocks, after=after, description=f"{title} のブロック追加"):
+            return False
+
+    print(f"✅ {title} をNotionで更新できたでござる！🎉")
+    return page_id
+
+def upload_or_sync_note(note, entry=None, children=None):
+    """
+    ノートを新しいページとしてアップロードする（entry を渡した場合は既存ページを同期する）
+    (ページID, 本文ブロックの指紋リスト) を返す（失敗時のページIDは False）
+    """
+    if children is None:
+        children = build_page_children(note)
+    if entry:
+        page_id = sync_note_to_notion(note, entry, children)
+    else:
+        page_id = upload_to_notion(note, children=children)
+    return page_id, [block_fingerprint(block) for block in children]
+
+# ------------- ドライランのスプールと再送 -------------
+SPOOL_FILE = os.path.expanduser("~/src/up_note_to_notion/dry_run_spool.jsonl")
+
+def build_spool_record(filename, content_hash, note, children, entry=None):
+    """
+    ノートをアップロードするリクエストを組み立て、スプールに書き出す記録（辞書）を返す
+    新規作成は送るリクエストをそのまま記録する（path の {page_id} は送信時に作成されたページIDに置き換える）
+    同期はプロパティの更新リクエストと本文のブロックを記録し、本文の差分は再送時の台帳と比べて求める
+    """
+    record = {
+        "file": filename,
+        "hash": content_hash,
+        "database_id": note_database_id(note),
+        "title": note["title"],
+        "action": "sync" if entry else "create",
+        "prepared_at": datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    }
+    if entry:
+        record["requests"] = [{"method": "PATCH", "path": "/pages/{page_id}", "body": build_page_properties(note)}]
+        record["children"] = children
+    else:
+        record["requests"] = build_create_requests(note, children)
+    record["blocks"] = [block_fingerprint(block) for block in children]
+    return record
+
+def open_spool(path):
+    """スプールを書き出すために開く（前回のスプールは上書きする）"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return open(path, "w", encoding="utf-8")
+
+def validate_spool_record(record):
+    """スプールの記録のリクエストを検証し、問題点のリストを返す"""
+    problems = validate_page_requests(record["requests"])
+    # 同期の本文は差分だけを送るが、どの範囲になっても送れるよう上限件数ずつに分けて確認する
+    children = record.get("children", [])
+    for start in range(0, len(children), NOTION_MAX_CHILDREN):
+        validate_children(children[start:start + NOTION_MAX_CHILDREN], f"本文の{start + 1}番目からのブロック", problems)
+    return problems
+
+def send_spooled_note(record, entry=None):
+    """
+    スプールの記録のリクエストを送る（entry: 同期の場合の台帳の記録）
+    (ページID, 本文ブロックの指紋リスト) を返す（失敗時のページIDは False）
+    """
+    title = record["title"]
+    if record["action"] == "create":
+        print(f"🚀 Notionへアップロード開始: {title}")
+        return send_create_requests(record["requests"], title), record["blocks"]
+
+    if not entry or not entry.get("page_id"):
+        raise ValueError(f"{record['file']} の同期先のページが台帳にありません")
+    page_id = entry["page_id"]
+    print(f"🔄 Notionのページを同期開始: {title}")
+    request = record["requests"][0]
+    if send_notion_request(request["method"], request["path"].format(page_id=page_id), request["body"],
+                           f"{title} のプロパティ更新") is None:
+        return False, record["blocks"]
+    return sync_page_blocks(page_id, title, record["children"], entry.get("blocks")), record["blocks"]
+
+# ------------- デッドレター（送れなかったノートのリクエスト） -------------
+DEAD_LETTER_FILE = os.path.expanduser("~/src/up_note_to_notion/dead_letter.jsonl")
+DEAD_LETTER_MAX_ERROR_LENGTH = 10000  # 記録するエラー本文の最大文字数
+REQUEST_FAILURE = threading.local()  # ワーカーごとの、最後に送れなかったリクエストの記録
+
+def record_request_failure(description, status, error):
+    """send_notion_request が送れなかったリクエストの内容とエラーを、呼び出したスレッドに記録する"""
+    REQUEST_FAILURE.last = {
+        "request": description,
+        "status": status,
+        "error": (error or "")[:DEAD_LETTER_MAX_ERROR_LENGTH]
+    }
+
+class DeadLetterQueue:
+    """
+    リトライしても送れなかったノートのリクエストを、失敗の理由（ステータスコード・エラー本文）とともに書き出す（JSONL）
+    記録はスプールと同じ形式のため、--retry-failed で失敗したノートだけを再送できる
+    書き出しは一時ファイルに行い、実行が最後まで終わったときにデッドレターを置き換える
+    （再送中に読んでいるデッドレターを壊さず、中断した場合は前回のデッドレターを残す）
+    """
+    def __init__(self, path):
+        self.path = path
+        self.temp_path = path + ".tmp"
+        self.count = 0
+        self.kept = 0  # 再送せずに引き継いだ記録の数
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(self.temp_path, "w", encoding="utf-8")
+
+    def add(self, record, failure):
+        """ノートの記録（build_spool_record の形式）に失敗の理由を加えて1行書き出す"""
+        record = dict(record, failed_at=datetime.now().strftime("%Y-%m-%dT%H:%M:%S"), **failure)
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.count += 1
+
+    def keep(self, line):
+        """再送しなかった前回の記録を、そのまま新しいデッドレターに引き継ぐ"""
+        self.file.write(line if line.endswith("\n") else line + "\n")
+        self.file.flush()
+        self.count += 1
+        self.kept += 1
+
+    def commit(self):
+        """書き出した記録でデッドレターを置き換える（失敗がなければ空になる）"""
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def close(self):
+        """置き換えずに閉じる（commit 済みなら何もしない）"""
+        if not self.file.closed:
+            self.file.close()
+            os.remove(self.temp_path)
+
+# ------------- ストリーミング処理パイプライン -------------
+PIPELINE_DONE = object()  # ワーカーの終了を知らせる目印
+
+def count_markdown_files(notes_dir):
+    """ディレクトリ内のマークダウンファイルの数を数える（ファイル名の一覧は保持しない）"""
+    with os.scandir(notes_dir) as entries:
+        return sum(1 for entry in entries if entry.name.endswith(".md") and entry.is_file())
+
+def scan_markdown_files(notes_dir):
+    """走査段：ディレクトリ内のマークダウンファイルを1件ずつジョブとして返す"""
+    with os.scandir(notes_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(".md") and entry.is_file():
+                yield {"filename": entry.name, "path": entry.path}
+
+def count_spool_records(path):
+    """スプールの記録の件数を数える"""
+    with open(path, "r", encoding="utf-8") as f:
+        return sum(1 for line in f if line.strip())
+
+def spool_stage(path, database_ids):
+    """
+    再送用の読み込み段：スプールの記録を1件ずつジョブとして返す
+    database_ids: 送信してよいデータベースID（--database-id と振り分け先）
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield {"filename": f"{os.path.basename(path)}:{line_number}", "error": e, "stage": "read", "line": line}
                 continue
+            print(f"\n📝 再送: {record['file']}")
+            if record.get("database_id") not in database_ids:
+                # 台帳には記録しない（このデータベースの記録を上書きしないため）
+                yield {"filename": record["file"], "stage": "read", "line": line,
+                       "error": ValueError(f"スプールは別のデータベース（{record.get('database_id')}）用に作成されています")}
+                continue
+            yield {"filename": record["file"], "hash": record["hash"], "record": record,
+                   "target": record["database_id"], "stage": "read"}
 
-            # 成功
-            if response.status_code == 200:
-                print(f"✅ {note['title']} をNotionに追加できたでござる！🎉")
-                return True
-            # その他のエラー
+def replay_ledger_stage(jobs, ledgers, force=False):
+    """
+    再送用の台帳照合段：送信済みの記録にスキップの印を付け、同期の記録には台帳の記録を加える
+    ledgers: データベースIDごとの台帳
+    """
+    for job in jobs:
+        if "error" not in job:
+            entry = ledgers[job["target"]].get(job["filename"])
+            if not force and entry and entry.get("status") == "success" and entry.get("hash") == job["hash"]:
+                print(f"⏭️ 送信済みのためスキップ: {job['filename']}")
+                job["skip"] = True
+            job["entry"] = entry if job["record"]["action"] == "sync" else None
+        yield job
+
+def read_note_file(job):
+    """ファイルを読み込み、内容と SHA-256 ハッシュをジョブに加える"""
+    with METRICS.timer("read"):
+        with open(job["path"], "rb") as f:
+            raw = f.read()
+        job["hash"] = hashlib.sha256(raw).hexdigest()
+        job["content"] = raw.decode("utf-8")
+    METRICS.increment("bytes_read", len(raw))
+
+def read_stage(jobs, notes_dir, parse_cache=None):
+    """
+    読み込み段：ファイルを1回だけ読み込み、内容と SHA-256 ハッシュをジョブに加える
+    parse_cache を渡した場合、サイズと更新日時が前回と同じファイルは読み込まず、前回のハッシュを使う
+    """
+    for job in jobs:
+        print(f"\n📝 処理中: {job['filename']}")
+        try:
+            cached_hash = None
+            if parse_cache is not None:
+                stat = os.stat(job["path"])
+                job["size"], job["mtime_ns"] = stat.st_size, stat.st_mtime_ns
+                cached_hash = parse_cache.lookup_stat(job["path"], stat.st_size, stat.st_mtime_ns)
+            if cached_hash:
+                job["hash"] = cached_hash
+                METRICS.increment("files_unchanged")
             else:
-                print(f"❌ {note['title']} の追加に失敗: {response.status_code}")
-                print(response.text)
+                read_note_file(job)
+        except Exception as e:
+            job["error"] = e
+        job["stage"] = "read"
+        yield job
 
-                # 認証エラーなど致命的なエラーの場合はすぐに終了
-                if response.status_code in [401, 403]:
-                    print("❌ 認証エラーが発生しました。APIキーを確認してください。")
-                    sys.exit(1)
+def ledger_stage(jobs, check_ledger):
+    """
+    台帳照合段：アップロード済みのノートにスキップの印を付ける
+    振り分け段の後に置いた場合は、ノートのアップロード先のデータベースの台帳と照合する
+    """
+    for job in jobs:
+        if "error" not in job:
+            action, job["entry"] = check_ledger(job["filename"], job["hash"], job.get("target"))
+            job["skip"] = action == "skip"
+        yield job
+
+def route_stage(jobs, router):
+    """振り分け段：カテゴリーとハッシュタグから、ノートのアップロード先とマルチセレクトの値を決める"""
+    for job in jobs:
+        if "error" not in job and not job.get("skip"):
+            note = job["note"]
+            route = router.route(note)
+            note["route"] = {"name": route["name"], "database_id": route["database_id"],
+                             "properties": router.properties(route, note)}
+            job["target"] = route["database_id"]
+            router.counts[route["name"]] += 1
+        yield job
+
+def existing_page_stage(jobs, existing_pages):
+    """
+    既存ページの照合段：同じタイトル・作成日のページがアップロード先のデータベースにあるノートにスキップの印を付ける
+    existing_pages: データベースIDごとの ExistingPageIndex
+    台帳で同期先が決まっているノートは照合しない。既存ページを取得できなかったノートは、重複を避けるため失敗として扱う
+    """
+    for job in jobs:
+        if "error" not in job and not job.get("skip") and not job.get("entry"):
+            note = job["note"]
+            try:
+                page_id = existing_pages[note_database_id(note)].get(existing_page_key(note["title"], note["created"]))
+            except RuntimeError as e:
+                job["error"] = e
+                job["stage"] = "existing"
+                yield job
+                continue
+            if page_id:
+                print(f"⏭️ 同じタイトル・作成日のページがデータベースにあるためスキップ: {job['filename']}")
+                job["skip"] = True
+                job["existing_page_id"] = page_id
+        yield job
+
+def parse_cache_stage(jobs, parse_cache):
+    """
+    キャッシュ照合段：内容のハッシュが前回と同じノートは、保存済みの解析結果とブロックを使う
+    （見つかったノートは解析段と変換段の解析・変換を省く）
+    """
+    for job in jobs:
+        if "error" not in job and not job.get("skip"):
+            try:
+                with METRICS.timer("parse_cache"):
+                    cached = parse_cache.get(job["path"], job["hash"])
+                if cached:
+                    job["note"], job["blocks"] = cached
+                    job["cache_hit"] = True
+                    if "content" in job:
+                        # 更新日時だけが変わったノートは、次回は読み込みも省けるようにする
+                        parse_cache.touch(job["path"], job["size"], job["mtime_ns"])
+                        del job["content"]
+                    METRICS.increment("parse_cache_hits")
+                else:
+                    METRICS.increment("parse_cache_misses")
+                    if "content" not in job:
+                        # 読み込みを省いた直後に記録が消えた場合（別の実行と重なったときなど）
+                        read_note_file(job)
+            except Exception as e:
+                job["error"] = e
+        yield job
+
+def parse_stage(jobs):
+    """解析段：ノートを解析する（解析が済んだら元の文字列は手放す）"""
+    for job in jobs:
+        if "error" not in job and not job.get("skip") and "note" not in job:
+            try:
+                with METRICS.timer("parse"):
+                    job["note"] = parse_markdown(job["path"], content=job["content"])
+            except Exception as e:
+                job["error"] = e
+            job["stage"] = "parse"
+        job.pop("content", None)
+        yield job
+
+def init_parse_worker(settings):
+    """解析用プロセスの初期化：メインプロセスの設定を引き継ぐ"""
+    global USE_ICON, ICON_KEYWORDS_FILE, METRICS
+    USE_ICON = settings["use_icon"]
+    ICON_KEYWORDS_FILE = settings["icon_keywords_file"]
+    METRICS = RunMetrics()
+
+def parse_notes_in_worker(items):
+    """
+    （解析用プロセスで実行）ノートをまとめて解析して本文をブロックに変換する
+    items: [(パス, 内容)]。ノートごとに (ノート, ブロック) または例外を並べたリストと計測値を返す
+    """
+    results = []
+    for path, content in items:
+        try:
+            with METRICS.timer("parse"):
+                note = parse_markdown(path, content=content)
+            with METRICS.timer("convert"):
+                # トークンは変換済みで不要なため、メインプロセスへは送らない
+                blocks = convert_markdown_to_notion_blocks(note.pop("tokens"))
+            results.append((note, blocks))
+        except Exception as e:
+            results.append(e)
+    return results, METRICS.take_stages()
 
-                retries += 1
-                if retries <= max_retries:
-                    print(f"⚠️ {retries}/{max_retries}回目のリトライを{retry_delay}秒後に行います...")
-                    time.sleep(retry_delay)
+def parallel_parse_stage(jobs, executor, window=4, batch_size=8):
+    """
+    解析段（複数プロセス版）：解析と本文の変換をプロセスプールで並列に行い、元の順番どおりに返す
+    window: 同時に解析中にしておくバッチの上限（プロセス数より多くしないと、手の空くプロセスが出る。
+            先読みしすぎてメモリを使わないように、window × batch_size 件までしか読み込まない）
+    batch_size: 1回のプロセス間のやり取りで送るノート数（やり取りの回数を減らす）
+    画像ブロックは画像の一覧（公開先のURLなど）を持つメインプロセスの変換段で追加する
+    """
+    pending = collections.deque()
+    batch = []
+
+    def submit(batch):
+        targets = [job for job in batch if "error" not in job and not job.get("skip") and "note" not in job]
+        future = None
+        if targets:
+            future = executor.submit(parse_notes_in_worker, [(job["path"], job["content"]) for job in targets])
+        for job in batch:
+            job.pop("content", None)
+        pending.append((batch, targets, future))
+
+    def finish(batch, targets, future):
+        if future is not None:
+            try:
+                results, stages = future.result()
+                METRICS.merge_stages(stages)
+            except Exception as e:
+                results = [e] * len(targets)
+            for job, result in zip(targets, results):
+                if isinstance(result, Exception):
+                    job["error"] = result
                 else:
-                    print(f"❌ 最大リトライ回数({max_retries}回)に達しました。処理を中止します。")
-                    return False
+                    job["note"], job["blocks"] = result
+                job["stage"] = "parse"
+        return batch
+
+    for job in jobs:
+        batch.append(job)
+        if len(batch) >= batch_size:
+            submit(batch)
+            batch = []
+            if len(pending) >= window:
+                yield from finish(*pending.popleft())
+    if batch:
+        submit(batch)
+    while pending:
+        yield from finish(*pending.popleft())
+
+def image_upload_stage(jobs, uploader):
+    """
+    画像送信段：ノートの画像のアップロードを予約する（完了は待たない）
+    画像の送信はページ作成と並行して進み、アップロード段で完了を待ってから参照する
+    """
+    for job in jobs:
+        if "error" not in job and not job.get("skip") and job["note"]["images"]:
+            note = job["note"]
+            job["image_futures"] = {(filename, "inline"): uploader.submit(filename)
+                                    for filename in note["images"]}
+            # カバー用の縮小版があれば別に送る（なければ本文用の画像をカバーにも使う）
+            if note["cover_image"] and uploader.manifest.has_variant(note["cover_image"], "cover"):
+                job["image_futures"][(note["cover_image"], "cover")] = uploader.submit(note["cover_image"], "cover")
+        yield job
+
+def convert_stage(jobs, parse_cache=None):
+    """
+    変換段：ノートをNotionの子ブロックに変換する
+    本文のブロックは解析用プロセスで変換済み（またはキャッシュにある）ならそれを使う。画像の送信待ちのノートは、
+    画像ブロックだけをアップロード段で追加する
+    parse_cache を渡した場合、新しく解析したノートの解析結果と本文のブロックを保存する
+    """
+    for job in jobs:
+        if "error" not in job and not job.get("skip"):
+            try:
+                with METRICS.timer("convert"):
+                    if "blocks" not in job:
+                        job["blocks"] = convert_markdown_to_notion_blocks(job["note"]["tokens"])
+                    blocks = job["blocks"]
+                    if "image_futures" not in job:
+                        job["children"] = job.pop("blocks") + build_image_blocks(job["note"])
+                if parse_cache is not None and not job.get("cache_hit"):
+                    with METRICS.timer("parse_cache"):
+                        parse_cache.put(job["path"], job["size"], job["mtime_ns"], job["hash"], job["note"], blocks)
+            except Exception as e:
+                job["error"] = e
+            job["stage"] = "convert"
+        yield job
+
+def run_upload_pipeline(jobs, upload_job, handle_result, workers=1, queue_size=16, targets=(None,)):
+    """
+    ジョブを上限付きのキューでアップロード用のワーカーに渡し、結果をメインスレッドで処理する
+    jobs: 走査〜変換段をつないだジェネレーター（別スレッドで1件ずつ取り出すため、解析と通信が並行する）
+    upload_job(job): ワーカースレッドで呼ばれ、アップロード結果を返す
+    handle_result(job, result, error): 各ジョブの完了時にメインスレッドで呼ばれる
+    targets: アップロード先（ジョブの "target"）の一覧。アップロード先ごとにキューと workers 個のワーカーを用意し、
+             遅いデータベースがあっても他のデータベースへの送信が止まらないようにする
+             （レート制限はインテグレーション単位のため、リミッターは全アップロード先で共有する）
+    途中で失敗したジョブやスキップするジョブはワーカーに渡さずそのまま結果として扱う
+    """
+    upload_queues = {target: queue.Queue(maxsize=queue_size) for target in targets}
+    default_queue = upload_queues[targets[0]]
+    result_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
 
-        except requests.exceptions.RequestException as e:
-            print(f"❌ ネットワークエラー: {e}")
-            retries += 1
-            if retries <= max_retries:
-                print(f"⚠️ {retries}/{max_retries}回目のリトライを{retry_delay}秒後に行います...")
-                time.sleep(retry_delay)
-            else:
-                print(f"❌ 最大リトライ回数({max_retries}回)に達しました。処理を中止します。")
-                return False
+    def produce():
+        try:
+            for job in jobs:
+                if stop.is_set():
+                    break
+                if "error" in job or job.get("skip"):
+                    result_queue.put((job, None, job.get("error")))
+                else:
+                    upload_queues.get(job.get("target"), default_queue).put(job)
         except Exception as e:
-            print(f"❌ エラー: {note['title']} のアップロードに失敗しました。 {e}")
-            return False
+            print(f"❌ ノートの読み込み中に予期せぬエラーが発生しました: {e}")
+        finally:
+            for upload_queue in upload_queues.values():
+                for _ in range(workers):
+                    upload_queue.put(PIPELINE_DONE)
+
+    def consume(upload_queue):
+        while True:
+            job = upload_queue.get()
+            if job is PIPELINE_DONE:
+                result_queue.put(PIPELINE_DONE)
+                return
+            if stop.is_set():
+                continue
+            job["stage"] = "upload"
+            try:
+                with METRICS.timer("upload"):
+                    result = upload_job(job)
+                result_queue.put((job, result, None))
+            except Exception as e:
+                result_queue.put((job, None, e))
+
+    threads = [threading.Thread(target=produce, daemon=True)]
+    threads += [threading.Thread(target=consume, args=(upload_queue,), daemon=True)
+                for upload_queue in upload_queues.values() for _ in range(workers)]
+    for thread in threads:
+        thread.start()
 
-    return False
+    try:
+        finished_workers = 0
+        while finished_workers < workers * len(upload_queues):
+            item = result_queue.get()
+            if item is PIPELINE_DONE:
+                finished_workers += 1
+            else:
+                handle_result(*item)
+    except BaseException:
+        # 中断された場合は新しいジョブを始めないようにワーカーへ知らせる
+        stop.set()
+        raise
+
+# ------------- 処理時間の内訳の表示 -------------
+METRICS_SUMMARY_STAGES = [
+    ("read", "ファイルの読み込み"),
+    ("parse_cache", "解析結果のキャッシュ"),
+    ("parse", "解析"),
+    ("validate", "リクエストの検証"),
+    ("existing_pages", "既存ページの取得"),
+    ("icon", "  うちアイコン推測"),
+    ("convert", "ブロックへの変換"),
+    ("json_encode", "JSONエンコード"),
+    ("http", "HTTP通信"),
+    ("rate_limit_wait", "レート制限の待機"),
+    ("retry_sleep", "リトライの待機"),
+    ("circuit_wait", "サーキットブレーカーによる停止"),
+]
+
+def show_metrics_summary(metrics):
+    """段ごとの処理時間とカウンターを表示する（時間は全スレッドの合計）"""
+    report = metrics.to_dict()
+    print(f"⏱ 処理時間の内訳（経過時間 {report['elapsed_seconds']:.2f}秒、各段は全スレッドの合計）:")
+    for stage, label in METRICS_SUMMARY_STAGES:
+        if stage in report["stages"]:
+            print(f"  - {label}: {report['stages'][stage]['seconds']:.2f}秒")
+    counters = report["counters"]
+    if "parse_cache_hits" in counters or "parse_cache_misses" in counters:
+        print(f"  - 解析結果のキャッシュ: {counters.get('parse_cache_hits', 0)}件を再利用、"
+              f"{counters.get('parse_cache_misses', 0)}件を解析（読み込みを省いたファイル {counters.get('files_unchanged', 0)}件）")
+    print(f"  - リクエスト数: {counters.get('requests', 0)}（リトライ {counters.get('retries', 0)}回、"
+          f"429 {counters.get('rate_limited', 0)}回、送信 {counters.get('bytes_sent', 0):,}バイト）")
 
 # ------------- 進捗表示関数 -------------
 def show_progress(current, total, bar_length=50):